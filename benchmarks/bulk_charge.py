@@ -0,0 +1,63 @@
+"""Single vs bulk charges against a running payment service.
+
+Sends the same number of charges through POST /api/payment/charge one at a
+time and through POST /api/payment/charge/bulk, and prints charges/s for
+both. With PAYMENT_SETTLEMENT=async (the default) the single path only
+accepts the charges, while bulk also settles them; run the service with
+PAYMENT_SETTLEMENT=sync to compare like with like. Bulk counters are also
+under ``bulk_charge`` on /health.
+
+    python benchmarks/bulk_charge.py --url http://localhost:5004 --charges 2000 --user-ids 1,2
+"""
+import argparse
+import time
+
+import requests
+
+
+def make_items(user_ids, total):
+    return [{'user_id': user_ids[i % len(user_ids)], 'amount': round(5 + i % 100 * 0.5, 2), 'currency': 'USD'}
+            for i in range(total)]
+
+
+def bench_single(session, base, items):
+    started = time.perf_counter()
+    accepted = 0
+    for item in items:
+        resp = session.post(f"{base}/api/payment/charge", json=item)
+        accepted += resp.status_code in (201, 202, 402)
+    return accepted, time.perf_counter() - started
+
+
+def bench_bulk(session, base, items, per_request):
+    started = time.perf_counter()
+    accepted = 0
+    for start in range(0, len(items), per_request):
+        resp = session.post(f"{base}/api/payment/charge/bulk", json=items[start:start + per_request])
+        resp.raise_for_status()
+        counts = resp.json()['counts']
+        accepted += sum(counts.get(status, 0) for status in ('completed', 'failed', 'pending'))
+    return accepted, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:5004', help='payment service base URL')
+    parser.add_argument('--charges', type=int, default=2000, help='charges per path')
+    parser.add_argument('--user-ids', default='1,2', help='existing auth_users ids to charge')
+    parser.add_argument('--per-request', type=int, default=5000, help='charges per bulk request')
+    args = parser.parse_args()
+
+    items = make_items([int(user_id) for user_id in args.user_ids.split(',')], args.charges)
+    session = requests.Session()
+    results = [
+        ('single', *bench_single(session, args.url, items)),
+        ('bulk', *bench_bulk(session, args.url, items, args.per_request))
+    ]
+    print(f"{'path':<10}{'charges':>10}{'seconds':>10}{'charges/s':>12}")
+    for path, accepted, elapsed in results:
+        print(f"{path:<10}{accepted:>10}{elapsed:>10.2f}{accepted / elapsed:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
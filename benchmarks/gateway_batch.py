@@ -0,0 +1,56 @@
+"""Separate GETs vs one /api/batch request against a running gateway.
+
+Loads the same "screen" (a set of gateway paths) ``--rounds`` times: once
+with one GET per path, one after the other as the dashboard used to, and
+once with a single POST /api/batch. Prints the time per screen for both.
+The gap grows with the client's round-trip time to the gateway, so run it
+from where the clients are rather than on the gateway host.
+
+    python benchmarks/gateway_batch.py --url http://localhost:8000 --rounds 50 \\
+        --paths /api/auth/users,/api/user/profiles,/api/payment/payments,/api/survey/stats
+"""
+import argparse
+import time
+
+import requests
+
+
+def bench_separate(session, base, paths, rounds):
+    started = time.perf_counter()
+    failed = 0
+    for _ in range(rounds):
+        for path in paths:
+            failed += session.get(f"{base}{path}").status_code >= 400
+    return failed, time.perf_counter() - started
+
+
+def bench_batch(session, base, paths, rounds):
+    body = {'requests': {f"part{i}": path for i, path in enumerate(paths)}}
+    started = time.perf_counter()
+    failed = 0
+    for _ in range(rounds):
+        resp = session.post(f"{base}/api/batch", json=body)
+        resp.raise_for_status()
+        failed += sum(part['status'] >= 400 for part in resp.json()['responses'].values())
+    return failed, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:8000', help='gateway base URL')
+    parser.add_argument('--paths', default='/api/auth/users,/api/user/profiles,/api/payment/payments,/api/survey/surveys',
+                        help='comma-separated gateway paths that make up one screen')
+    parser.add_argument('--rounds', type=int, default=50, help='screens to load per mode')
+    args = parser.parse_args()
+    paths = [path.strip() for path in args.paths.split(',') if path.strip()]
+    base = args.url.rstrip('/')
+
+    print(f"🔧 {args.rounds} screens of {len(paths)} requests against {base}")
+    with requests.Session() as session:
+        for label, bench in (('separate', bench_separate), ('batch', bench_batch)):
+            failed, elapsed = bench(session, base, paths, args.rounds)
+            print(f"{label:<10}{elapsed / args.rounds * 1000:>10.1f} ms/screen{failed:>8} failed parts")
+
+
+if __name__ == '__main__':
+    main()
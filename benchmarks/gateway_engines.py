@@ -0,0 +1,152 @@
+"""Side-by-side load test of the Flask and asyncio gateway engines.
+
+Starts a deliberately slow fake upstream, then runs the API gateway once per
+engine in front of it and fires the same burst of concurrent requests at
+each. Needs aiohttp (already in src/api-gateway/requirements.txt).
+
+    python benchmarks/gateway_engines.py --requests 2000 --concurrency 500 --delay 0.5
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+GATEWAY_DIR = os.path.join(ROOT, 'src', 'api-gateway')
+
+
+def run_upstream(port):
+    """Fake backend: answers every path after sleeping ``?delay=`` seconds."""
+    async def handle(request):
+        await asyncio.sleep(float(request.query.get('delay', '0')))
+        return web.json_response({'surveys': [{'id': 1, 'title': 'Benchmark'}]})
+
+    app = web.Application()
+    app.router.add_route('*', '/{tail:.*}', handle)
+    web.run_app(app, host='127.0.0.1', port=port, access_log=None, print=None)
+
+
+def start_process(args, env=None, cwd=None):
+    return subprocess.Popen(args, cwd=cwd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def wait_until_up(url, timeout=15):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url) as resp:
+                    if resp.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+async def load(url, total, concurrency):
+    """Send ``total`` GETs with at most ``concurrency`` in flight; return latencies and errors."""
+    latencies = []
+    errors = 0
+    queue = iter(range(total))
+
+    async def worker(session):
+        nonlocal errors
+        for _ in queue:
+            started = time.perf_counter()
+            try:
+                async with session.get(url) as resp:
+                    await resp.read()
+                    if resp.status != 200:
+                        errors += 1
+                        continue
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=60)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return latencies, errors, elapsed
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def bench_engine(engine, args):
+    env = dict(os.environ)
+    upstream_url = f"http://127.0.0.1:{args.upstream_port}"
+    for name in ('AUTH', 'USER', 'SURVEY', 'PAYMENT'):
+        env[f'{name}_SERVICE_URL'] = upstream_url
+    env.update({
+        'GATEWAY_ENGINE': engine,
+        'API_GATEWAY_HOST': '127.0.0.1',
+        'API_GATEWAY_PORT': str(args.gateway_port),
+        # Let both engines hold every benchmark request in flight at once
+        'UPSTREAM_MAX_CONCURRENCY': str(args.concurrency),
+        'UPSTREAM_POOL_SIZE': str(args.concurrency),
+        'UPSTREAM_QUEUE_TIMEOUT': '30'
+    })
+    gateway = start_process([sys.executable, 'app.py'], env=env, cwd=GATEWAY_DIR)
+    try:
+        base = f"http://127.0.0.1:{args.gateway_port}"
+        asyncio.run(wait_until_up(f"{base}/health"))
+        url = f"{base}/api/survey/surveys?delay={args.delay}"
+        latencies, errors, elapsed = asyncio.run(load(url, args.requests, args.concurrency))
+    finally:
+        gateway.terminate()
+        gateway.wait()
+    return {
+        'engine': engine,
+        'ok': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / elapsed if elapsed else 0.0,
+        'p50': percentile(latencies, 50) * 1000,
+        'p99': percentile(latencies, 99) * 1000
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000, help='requests per engine')
+    parser.add_argument('--concurrency', type=int, default=500, help='requests in flight at once')
+    parser.add_argument('--delay', type=float, default=0.5, help='seconds the fake upstream sleeps per request')
+    parser.add_argument('--engines', default='flask,asyncio', help='comma-separated engines to compare')
+    parser.add_argument('--upstream-port', type=int, default=5999)
+    parser.add_argument('--gateway-port', type=int, default=8999)
+    parser.add_argument('--upstream', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.upstream:
+        run_upstream(args.upstream_port)
+        return
+
+    print(f"🔧 {args.requests} requests, {args.concurrency} concurrent, upstream delay {args.delay}s")
+    upstream = start_process([sys.executable, __file__, '--upstream', '--upstream-port', str(args.upstream_port)])
+    try:
+        asyncio.run(wait_until_up(f"http://127.0.0.1:{args.upstream_port}/health"))
+        results = [bench_engine(engine.strip(), args) for engine in args.engines.split(',')]
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+    print(f"{'engine':<10}{'ok':>8}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for r in results:
+        print(f"{r['engine']:<10}{r['ok']:>8}{r['errors']:>8}{r['rps']:>10.1f}{r['p50']:>10.1f}{r['p99']:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""Gateway throughput with request logging off, written inline and queued.
+
+Runs the Flask gateway in front of a fast fake upstream three times and
+fires the same load at it:
+
+    off     LOG_REQUESTS=false
+    sync    the same JSON lines, but written to stdout by the request thread,
+            as the old print() calls were
+    queued  the default: records go through common/logs.py's queue to its
+            writer thread
+
+The gateway's stdout is a pipe drained at ``--drain-kbps``, like a container
+log driver that can't keep up. Once the pipe is full, inline writes block
+the request threads; queued records are dropped instead (the "dropped"
+column, from log_records_total). Needs aiohttp.
+
+    python benchmarks/gateway_logging.py --requests 5000 --concurrency 50 --drain-kbps 64
+"""
+import argparse
+import asyncio
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+import aiohttp
+from aiohttp import web
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+GATEWAY_DIR = os.path.join(ROOT, 'src', 'api-gateway')
+
+
+def run_upstream(port):
+    """Fake backend answering every path at once."""
+    async def handle(request):
+        return web.json_response({'surveys': [{'id': 1, 'title': 'Benchmark'}]})
+
+    app = web.Application()
+    app.router.add_route('*', '/{tail:.*}', handle)
+    web.run_app(app, host='127.0.0.1', port=port, access_log=None, print=None)
+
+
+def run_sync_gateway(port):
+    """The gateway with its log records written inline instead of through the queue."""
+    import logging
+    sys.path.insert(0, GATEWAY_DIR)
+    os.chdir(GATEWAY_DIR)
+    import app as gateway
+    from common.logs import JsonFormatter
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter('api-gateway'))
+    logging.getLogger().handlers = [handler]
+    gateway.app.run(host='127.0.0.1', port=port, threaded=True)
+
+
+def drain(pipe, kbps):
+    """Read a pipe no faster than ``kbps`` KiB/s."""
+    chunk = 4096
+    pause = chunk / (kbps * 1024)
+    while pipe.read(chunk):
+        time.sleep(pause)
+
+
+async def wait_until_up(url, timeout=15):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url) as resp:
+                    if resp.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+async def load(url, total, concurrency):
+    """Send ``total`` GETs with at most ``concurrency`` in flight; return latencies and errors."""
+    latencies = []
+    errors = 0
+    queue = iter(range(total))
+
+    async def worker(session):
+        nonlocal errors
+        for _ in queue:
+            started = time.perf_counter()
+            try:
+                async with session.get(url) as resp:
+                    await resp.read()
+                    if resp.status != 200:
+                        errors += 1
+                        continue
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=60)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return latencies, errors, elapsed
+
+
+async def dropped_records(base):
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{base}/metrics") as resp:
+            match = re.search(r'^log_records_total\{outcome="dropped"\} (\d+)', await resp.text(), re.M)
+    return int(match.group(1)) if match else 0
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def bench_mode(mode, args):
+    env = dict(os.environ)
+    upstream_url = f"http://127.0.0.1:{args.upstream_port}"
+    for name in ('AUTH', 'USER', 'SURVEY', 'PAYMENT'):
+        env[f'{name}_SERVICE_URL'] = upstream_url
+    env.update({
+        'API_GATEWAY_HOST': '127.0.0.1',
+        'API_GATEWAY_PORT': str(args.gateway_port),
+        'GATEWAY_CACHE_ENABLED': 'false',
+        'LOG_REQUESTS': 'false' if mode == 'off' else 'true',
+        'LOG_LEVEL': 'INFO'
+    })
+    if mode == 'sync':
+        cmd = [sys.executable, os.path.abspath(__file__), '--sync-gateway', '--gateway-port', str(args.gateway_port)]
+    else:
+        cmd = [sys.executable, 'app.py']
+    gateway = subprocess.Popen(cmd, cwd=GATEWAY_DIR, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    threading.Thread(target=drain, args=(gateway.stdout, args.drain_kbps), daemon=True).start()
+    try:
+        base = f"http://127.0.0.1:{args.gateway_port}"
+        asyncio.run(wait_until_up(f"{base}/health"))
+        latencies, errors, elapsed = asyncio.run(load(f"{base}/api/survey/surveys", args.requests, args.concurrency))
+        dropped = asyncio.run(dropped_records(base)) if mode == 'queued' else 0
+    finally:
+        gateway.terminate()
+        gateway.wait()
+    return {
+        'mode': mode,
+        'ok': len(latencies),
+        'errors': errors,
+        'dropped': dropped,
+        'rps': len(latencies) / elapsed if elapsed else 0.0,
+        'p50': percentile(latencies, 50) * 1000,
+        'p99': percentile(latencies, 99) * 1000
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=5000, help='requests per mode')
+    parser.add_argument('--concurrency', type=int, default=50, help='requests in flight at once')
+    parser.add_argument('--drain-kbps', type=float, default=64, help='KiB/s read from the gateway\'s stdout')
+    parser.add_argument('--modes', default='off,sync,queued', help='comma-separated modes to compare')
+    parser.add_argument('--upstream-port', type=int, default=5998)
+    parser.add_argument('--gateway-port', type=int, default=8998)
+    parser.add_argument('--upstream', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--sync-gateway', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.upstream:
+        run_upstream(args.upstream_port)
+        return
+    if args.sync_gateway:
+        run_sync_gateway(args.gateway_port)
+        return
+
+    print(f"🔧 {args.requests} requests, {args.concurrency} concurrent, stdout drained at {args.drain_kbps:g} KiB/s")
+    upstream = subprocess.Popen([sys.executable, __file__, '--upstream', '--upstream-port', str(args.upstream_port)],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        asyncio.run(wait_until_up(f"http://127.0.0.1:{args.upstream_port}/health"))
+        results = [bench_mode(mode.strip(), args) for mode in args.modes.split(',')]
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+    print(f"{'mode':<8}{'ok':>8}{'errors':>8}{'dropped':>9}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for r in results:
+        print(f"{r['mode']:<8}{r['ok']:>8}{r['errors']:>8}{r['dropped']:>9}{r['rps']:>10.1f}"
+              f"{r['p50']:>10.1f}{r['p99']:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
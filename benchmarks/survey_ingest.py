@@ -0,0 +1,93 @@
+"""Single-row vs bulk survey response ingestion against a running survey service.
+
+Creates fresh surveys (each existing user can answer a survey once), then
+submits the same number of responses through POST /api/survey/responses one
+at a time and through POST /api/survey/responses/bulk, and prints rows/s
+for both. The service also keeps these counters under ``ingest`` on /health.
+
+    python benchmarks/survey_ingest.py --url http://localhost:5003 --responses 2000 --user-ids 1,2
+"""
+import argparse
+import json
+import math
+import time
+
+import requests
+
+
+def create_surveys(session, base, count):
+    ids = []
+    for i in range(count):
+        resp = session.post(f"{base}/api/survey/surveys",
+                            json={'title': f"Ingest benchmark {time.time():.0f}-{i}", 'created_by': 1})
+        resp.raise_for_status()
+        ids.append(resp.json()['survey_id'])
+    return ids
+
+
+def make_items(survey_ids, user_ids, total):
+    items = []
+    for survey_id in survey_ids:
+        for user_id in user_ids:
+            if len(items) == total:
+                return items
+            items.append({
+                'survey_id': survey_id,
+                'user_id': user_id,
+                'response_data': {'rating': len(items) % 5 + 1, 'recommend': len(items) % 3 != 0}
+            })
+    return items
+
+
+def bench_single(session, base, items):
+    started = time.perf_counter()
+    created = 0
+    for item in items:
+        resp = session.post(f"{base}/api/survey/responses", json=item)
+        created += resp.status_code == 201
+    return created, time.perf_counter() - started
+
+
+def bench_bulk(session, base, items, per_request, ndjson):
+    started = time.perf_counter()
+    created = 0
+    for start in range(0, len(items), per_request):
+        chunk = items[start:start + per_request]
+        if ndjson:
+            resp = session.post(f"{base}/api/survey/responses/bulk",
+                                data=''.join(json.dumps(item) + '\n' for item in chunk),
+                                headers={'Content-Type': 'application/x-ndjson'})
+        else:
+            resp = session.post(f"{base}/api/survey/responses/bulk", json=chunk)
+        resp.raise_for_status()
+        created += resp.json()['created']
+    return created, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:5003', help='survey service base URL')
+    parser.add_argument('--responses', type=int, default=2000, help='responses per path')
+    parser.add_argument('--user-ids', default='1,2', help='existing auth_users ids to answer as')
+    parser.add_argument('--per-request', type=int, default=5000, help='responses per bulk request')
+    parser.add_argument('--ndjson', action='store_true', help='upload bulk requests as NDJSON')
+    args = parser.parse_args()
+
+    user_ids = [int(user_id) for user_id in args.user_ids.split(',')]
+    session = requests.Session()
+    surveys_needed = math.ceil(args.responses / len(user_ids))
+    print(f"🔧 Creating {2 * surveys_needed} surveys for {args.responses} responses per path")
+    single_items = make_items(create_surveys(session, args.url, surveys_needed), user_ids, args.responses)
+    bulk_items = make_items(create_surveys(session, args.url, surveys_needed), user_ids, args.responses)
+
+    results = [
+        ('single', *bench_single(session, args.url, single_items)),
+        ('bulk', *bench_bulk(session, args.url, bulk_items, args.per_request, args.ndjson))
+    ]
+    print(f"{'path':<10}{'created':>10}{'seconds':>10}{'rows/s':>12}")
+    for path, created, elapsed in results:
+        print(f"{path:<10}{created:>10}{elapsed:>10.2f}{created / elapsed:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Compare /api/auth/verify cost for opaque and signed tokens.
+
+Runs each verification path in-process, single-threaded, and reports
+verifications per second:
+
+    opaque-db      the auth_sessions/auth_users JOIN (needs DB_* env vars and --db)
+    opaque-cached  a token cache hit (token_cache.py)
+    signed         HMAC check + expiry + revocation list (common/signed_tokens.py)
+
+    python benchmarks/token_verify.py --iterations 200000
+    python benchmarks/token_verify.py --db --db-iterations 2000
+"""
+import argparse
+import os
+import secrets
+import sys
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+sys.path.insert(0, os.path.join(ROOT, 'src', 'auth-service'))
+
+from common.signed_tokens import RevocationList, SignedTokenVerifier, TokenCodec  # noqa: E402
+from token_cache import TokenCache  # noqa: E402
+
+VERIFY_SQL = ("SELECT s.*, u.username, u.email FROM auth_sessions s JOIN auth_users u ON s.user_id = u.id "
+              "WHERE s.token = %s AND s.expires_at > NOW()")
+
+
+def timed(label, iterations, verify):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        verify()
+    elapsed = time.perf_counter() - started
+    return label, iterations / elapsed, elapsed / iterations * 1e6
+
+
+def bench_signed(iterations):
+    codec = TokenCodec({'bench': secrets.token_bytes(32)})
+    revocations = RevocationList()
+    # A realistic list size; the lookup is a dict hit either way
+    for i in range(1000):
+        revocations.revoke(f"revoked-{i}", time.time() + 3600)
+    verifier = SignedTokenVerifier(codec, revocations)
+    token, _ = codec.issue(1, 'demo_user', 'demo@example.com')
+    assert verifier.verify(token) is not None
+    return timed('signed', iterations, lambda: verifier.verify(token))
+
+
+def bench_opaque_cached(iterations):
+    cache = TokenCache()
+    token = secrets.token_urlsafe(32)
+    cache.put(token, {'id': 1, 'username': 'demo_user', 'email': 'demo@example.com'},
+              datetime.now() + timedelta(hours=1))
+    return timed('opaque-cached', iterations, lambda: cache.get(token))
+
+
+def bench_opaque_db(iterations):
+    from dotenv import load_dotenv
+    load_dotenv(os.path.join(ROOT, '.env'))
+    from common.db import db_cursor
+
+    token = f"bench-{secrets.token_urlsafe(24)}"
+    with db_cursor() as (conn, cursor):
+        cursor.execute("SELECT id FROM auth_users LIMIT 1")
+        row = cursor.fetchone()
+        if row is None:
+            raise RuntimeError("auth_users is empty; load db.txt first")
+        cursor.execute("INSERT INTO auth_sessions (user_id, token, expires_at) VALUES (%s, %s, %s)",
+                       (row[0], token, datetime.now() + timedelta(hours=1)))
+        conn.commit()
+
+    def verify():
+        with db_cursor(dictionary=True) as (conn, cursor):
+            cursor.execute(VERIFY_SQL, (token,))
+            cursor.fetchone()
+
+    try:
+        return timed('opaque-db', iterations, verify)
+    finally:
+        with db_cursor() as (conn, cursor):
+            cursor.execute("DELETE FROM auth_sessions WHERE token = %s", (token,))
+            conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=200000, help='verifications for the in-memory paths')
+    parser.add_argument('--db', action='store_true', help='also time the database path')
+    parser.add_argument('--db-iterations', type=int, default=2000, help='verifications for the database path')
+    args = parser.parse_args()
+
+    results = []
+    if args.db:
+        results.append(bench_opaque_db(args.db_iterations))
+    results.append(bench_opaque_cached(args.iterations))
+    results.append(bench_signed(args.iterations))
+
+    print(f"{'mode':<16}{'verify/s':>14}{'us/verify':>12}")
+    for label, rate, micros in results:
+        print(f"{label:<16}{rate:>14,.0f}{micros:>12.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""Composite requests: several GETs through the gateway in one round trip.
+
+``POST /api/batch`` takes named sub-requests, runs them concurrently against
+the upstreams (through the response cache, balancing and circuit breakers)
+and answers with all their results at once::
+
+    {"requests": {"user": "/api/auth/users/7",
+                  "payments": {"path": "/api/payment/payments/user/7", "query": {"limit": 20}, "timeout": 2}},
+     "timeout": 3}
+
+    {"responses": {"user": {"status": 200, "body": {...}},
+                   "payments": {"status": 504, "error": "No answer within 2.0s"}},
+     "complete": false}
+
+Each part gets its own timeout (the batch ``timeout`` by default, never more
+than GATEWAY_BATCH_TIMEOUT). A part that fails or times out only affects its
+own entry. Only GETs are allowed, so parts can run in any order. The
+client's Authorization and Cookie headers are passed on to every part.
+
+Tuning (all optional):
+    GATEWAY_BATCH_MAX_PARTS  sub-requests allowed per batch (default 10)
+    GATEWAY_BATCH_TIMEOUT    default and longest per-part timeout in seconds (default 5)
+    GATEWAY_BATCH_WORKERS    threads running parts, Flask engine only (default 32)
+    GATEWAY_BATCH_MAX_BYTES  largest part body included in a batch (default 1 MiB)
+"""
+import json
+import os
+from urllib.parse import unquote, urlencode, urlsplit
+
+from streaming import filter_headers
+
+GATEWAY_BATCH_MAX_PARTS = int(os.getenv('GATEWAY_BATCH_MAX_PARTS', '10'))
+GATEWAY_BATCH_TIMEOUT = float(os.getenv('GATEWAY_BATCH_TIMEOUT', '5'))
+GATEWAY_BATCH_WORKERS = int(os.getenv('GATEWAY_BATCH_WORKERS', '32'))
+GATEWAY_BATCH_MAX_BYTES = int(os.getenv('GATEWAY_BATCH_MAX_BYTES', str(1024 * 1024)))
+
+# Parts need a plain JSON body to embed; conditional headers would yield bodiless 304s
+DROPPED_PART_HEADERS = {
+    'host', 'content-length', 'content-type', 'accept', 'accept-encoding',
+    'if-none-match', 'if-modified-since'
+}
+
+
+class Part:
+    """One named sub-request of a batch."""
+
+    __slots__ = ('name', 'service', 'subpath', 'query', 'timeout')
+
+    def __init__(self, name, service, subpath, query, timeout):
+        self.name = name
+        self.service = service
+        self.subpath = subpath
+        self.query = query
+        self.timeout = timeout
+
+
+def _timeout(value, limit, label):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+        raise ValueError(f"{label}: timeout must be a positive number of seconds")
+    return min(float(value), limit)
+
+
+def parse_batch(data, max_parts=GATEWAY_BATCH_MAX_PARTS, max_timeout=GATEWAY_BATCH_TIMEOUT):
+    """The ``Part`` list of a batch body; raises ``ValueError`` with a message for the client."""
+    requests = data.get('requests') if isinstance(data, dict) else None
+    if not isinstance(requests, dict) or not requests:
+        raise ValueError('Body must be {"requests": {"<name>": "/api/<service>/<path>", ...}}')
+    if len(requests) > max_parts:
+        raise ValueError(f"At most {max_parts} requests per batch")
+    default_timeout = _timeout(data.get('timeout', max_timeout), max_timeout, 'batch')
+
+    parts = []
+    for name, spec in requests.items():
+        if isinstance(spec, str):
+            spec = {'path': spec}
+        if not isinstance(spec, dict) or not isinstance(spec.get('path'), str):
+            raise ValueError(f"{name}: expected a path or {{\"path\": ...}}")
+        url = urlsplit(spec['path'])
+        segments = url.path.split('/', 3)
+        if url.scheme or url.netloc or len(segments) < 3 or segments[0] or segments[1] != 'api' or not segments[2]:
+            raise ValueError(f"{name}: path must look like /api/<service>/<path>")
+        query = url.query
+        if spec.get('query') is not None:
+            if not isinstance(spec['query'], dict):
+                raise ValueError(f"{name}: query must be an object")
+            query = '&'.join(q for q in (query, urlencode(spec['query'])) if q)
+        timeout = _timeout(spec['timeout'], max_timeout, name) if 'timeout' in spec else default_timeout
+        parts.append(Part(name, segments[2], unquote(segments[3]) if len(segments) > 3 else '', query, timeout))
+    return parts
+
+
+def part_headers(headers):
+    """Headers sent upstream for every part, derived from the batch request's."""
+    forwarded = filter_headers(headers, exclude=DROPPED_PART_HEADERS)
+    forwarded.update({'Accept': 'application/json', 'Accept-Encoding': 'identity'})
+    return forwarded
+
+
+def content_type(header_items):
+    return next((value for name, value in header_items if name.lower() == 'content-type'), '')
+
+
+def part_result(status, content_type, body):
+    """A part's entry in the batch response; JSON bodies are embedded as JSON."""
+    if 'json' in content_type:
+        try:
+            return {'status': status, 'body': json.loads(body)}
+        except ValueError:
+            pass
+    return {'status': status, 'body': body.decode('utf-8', 'replace')}
+
+
+def part_error(status, message):
+    return {'status': status, 'error': message}
+
+
+def batch_response(results):
+    return {
+        'responses': results,
+        'complete': all(200 <= result['status'] < 300 for result in results.values())
+    }
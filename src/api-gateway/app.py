@@ -1,16 +1,41 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 import requests
+import urllib3
+import contextvars
+import logging
 import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 from dotenv import load_dotenv
 
-# Load .env from project root (two levels up from src/api-gateway/)
+# Load .env from project root (two levels up from src/api-gateway/) before
+# importing the modules below, which read their settings at import time
 load_dotenv(os.path.join(os.path.dirname(__file__), '..', '..', '.env'))
 
+# Shared modules live in src/common/ (one level up from src/api-gateway/)
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from common.metrics import instrument_flask
+from common.tracing import trace_flask
+from common.logs import log_flask
+from common.signed_tokens import RevocationList, SignedTokenVerifier, TokenCodec, claims_user, is_signed_token, keys_from_env
+from upstream import UpstreamRegistry, UpstreamBusy
+from breaker import CircuitOpen
+from balancer import RETRY_METHODS, retryable
+from streaming import PROXY_CHUNK_SIZE, filter_headers, read_up_to, request_body, ResponseRelay
+from cache import CONDITIONAL_HEADERS, WRITE_METHODS, cache_from_env, is_storable, response_parts, wants_stream
+from coalesce import coalescer_from_env, shared_headers
+from aggregate import (GATEWAY_BATCH_MAX_BYTES, GATEWAY_BATCH_WORKERS, batch_response, content_type,
+                       parse_batch, part_error, part_headers, part_result)
+from assets import static_assets_from_env
+from compress import CompressedBody, compression_from_env, route_for, weak_etag
+
 app = Flask(__name__)
 CORS(app)
 
-# Service URLs - all must be set via environment variables
+# Service URLs - all must be set via environment variables; each may list
+# several comma-separated instances of the service (see balancer.py)
 SERVICE_URLS = {
     'auth': os.getenv("AUTH_SERVICE_URL"),
     'user': os.getenv("USER_SERVICE_URL"),
@@ -24,52 +49,295 @@ if missing_services:
     raise ValueError(f"Missing required environment variables for services: {', '.join([f'{s.upper()}_SERVICE_URL' for s in missing_services])}")
 
 
-def proxy_request(service_name, subpath=""):
-    """Core logic to proxy the request to the correct microservice."""
-    if service_name not in SERVICE_URLS:
+def metrics_route(req):
+    """Route label for request metrics: the URL rule, with the service filled in for proxied calls."""
+    if req.url_rule is None:
+        return 'unmatched'
+    service = (req.view_args or {}).get('service_name')
+    if service in SERVICE_URLS:
+        return req.url_rule.rule.replace('<service_name>', service)
+    return req.url_rule.rule
+
+
+# Per-route request metrics and upstream timings on /metrics (see common/metrics.py)
+instrument_flask(app, route_label=metrics_route)
+# Assigns or accepts X-Request-ID and traces sampled requests into the services (see common/tracing.py)
+trace_flask(app, 'api-gateway')
+# One JSON log line per request, written by a background thread (see common/logs.py)
+log_flask(app, 'api-gateway', route_label=metrics_route)
+log = logging.getLogger('gateway')
+
+# Persistent keep-alive pools, one per upstream instance, each behind a
+# circuit breaker fed by traffic and active health checks (see breaker.py)
+UPSTREAMS = UpstreamRegistry(SERVICE_URLS)
+
+# Stream bodies through the gateway instead of buffering them (set to false
+# to fall back to reading whole request/response bodies into memory)
+PROXY_STREAMING = os.getenv('PROXY_STREAMING', 'true').lower() == 'true'
+
+# Besides hop-by-hop headers, let requests recompute framing for the upstream
+EXCLUDED_REQUEST_HEADERS = {'host', 'content-length'}
+# The gateway's own server sets these on the way out
+EXCLUDED_RESPONSE_HEADERS = {'server', 'date'}
+
+# Short-lived cache for read-heavy GET routes (see cache.py)
+RESPONSE_CACHE = cache_from_env()
+
+# Identical concurrent GETs share one upstream call (see coalesce.py)
+COALESCER = coalescer_from_env()
+
+# Runs the parts of /api/batch requests (see aggregate.py)
+BATCH_EXECUTOR = ThreadPoolExecutor(max_workers=GATEWAY_BATCH_WORKERS, thread_name_prefix='batch')
+
+# Response compression negotiated from Accept-Encoding (see compress.py)
+COMPRESSION = compression_from_env()
+
+# The dashboard's files, loaded once with precompressed copies (see assets.py)
+STATIC_ASSETS = static_assets_from_env(COMPRESSION)
+
+
+def load_revocations():
+    """Fetch revoked signed-token ids from the auth service."""
+    resp, _ = UPSTREAMS.get('auth').request('GET', 'revoked', timeout=2, retry=True)
+    resp.raise_for_status()
+    return [(item['jti'], item['exp']) for item in resp.json()['revoked']]
+
+
+# With the auth service's signing keys the gateway verifies signed tokens
+# itself (see common/signed_tokens.py); opaque tokens still go upstream
+TOKEN_KEYS = keys_from_env()
+TOKEN_VERIFIER = None
+if TOKEN_KEYS:
+    TOKEN_VERIFIER = SignedTokenVerifier(
+        TokenCodec(TOKEN_KEYS),
+        RevocationList(load_revocations, refresh_interval=float(os.getenv('AUTH_REVOCATION_REFRESH', '5')))
+    )
+
+
+def cached_response(entry, cache_state):
+    """Build the Flask response for a cache entry, answering 304 when the ETag matches."""
+    status, headers, body = response_parts(entry, request.headers.get('If-None-Match'), cache_state)
+    if status == 304:
+        RESPONSE_CACHE.count('not_modified')
+    return Response(body, status=status, headers=headers)
+
+
+def proxy_request(service_name, subpath="", body=None):
+    """Core logic to proxy the request to the correct microservice.
+
+    ``body`` replaces the inbound body when the handler already consumed it.
+    """
+    upstream = UPSTREAMS.get(service_name)
+    if upstream is None:
         return jsonify({'error': 'Service not found'}), 404
     
-    service_url = SERVICE_URLS[service_name]
+    target = f"{service_name}/{subpath}"
     
-    # Remove trailing slash from service_url
-    service_url = service_url.rstrip('/')
+    log.debug("Proxying request to %s", target)
     
-    # Construct the target URL properly
-    if subpath:
-        target_url = f"{service_url}/{subpath}"
-    else:
-        target_url = service_url
-    
-    print(f"🔄 Proxying request to: {target_url}")
+    cache_ttl = 0
+    coalesce = False
+    if request.method == 'GET' and not wants_stream(request.args, request.headers):
+        cache_ttl = RESPONSE_CACHE.ttl_for(service_name, subpath)
+        coalesce = COALESCER.applies(service_name, subpath)
+    excluded_headers = EXCLUDED_REQUEST_HEADERS
+    if cache_ttl:
+        cache_key = RESPONSE_CACHE.make_key(service_name, subpath, request.query_string, request.headers)
+        entry = RESPONSE_CACHE.get(cache_key)
+        if entry is not None:
+            return cached_response(entry, 'HIT')
+        generation = RESPONSE_CACHE.generation(service_name)
+        # Always fetch a full body to cache; If-None-Match is answered here
+        excluded_headers = EXCLUDED_REQUEST_HEADERS | CONDITIONAL_HEADERS
+    flight = None
+    if coalesce:
+        flight_key = COALESCER.make_key(service_name, subpath, request.query_string, request.headers)
+        flight, leader = COALESCER.join(flight_key)
+        if flight is not None and not leader:
+            shared = COALESCER.wait(flight)
+            if shared is not None:
+                status, headers, body = shared
+                return Response(body, status=status, headers=shared_headers(headers))
+            # Nothing to share (or the leader is too slow): make our own call
+            flight = None
+    # Cacheable responses are read raw so the stored bytes match the upstream's
+    stream = PROXY_STREAMING or bool(cache_ttl) or flight is not None
+    if body is None:
+        # Small bodies of retryable requests are read whole so a retry can resend them
+        small = request.content_length is not None and request.content_length <= PROXY_CHUNK_SIZE
+        if PROXY_STREAMING and not (small and request.method in RETRY_METHODS):
+            body = request_body(request)
+        else:
+            body = request.get_data()
+    tried = []
     
     try:
-        resp = requests.request(
+        resp, instance = upstream.request(
             method=request.method,
-            url=target_url,
-            headers={key: value for key, value in request.headers if key.lower() != 'host'},
-            data=request.get_data(),
+            subpath=subpath,
+            headers=filter_headers(request.headers, exclude=excluded_headers),
+            data=body,
             params=request.args,
             cookies=request.cookies,
-            timeout=5
+            timeout=5,
+            stream=stream,
+            retry=retryable(request.method, body),
+            tried=tried
         )
         
-        print(f"✅ Success: {resp.status_code} from {target_url}")
+        log.debug("%s from %s", resp.status_code, instance.url_for(subpath))
+        
+        headers = filter_headers(resp.headers, exclude=EXCLUDED_RESPONSE_HEADERS)
+        
+        storable = cache_ttl and is_storable(resp.status_code, resp.headers)
+        if storable or flight is not None:
+            limit = max(RESPONSE_CACHE.max_entry_bytes if storable else 0,
+                        COALESCER.max_bytes if flight is not None else 0)
+            try:
+                chunks, rest = read_up_to(resp, limit)
+            except Exception:
+                resp.close()
+                instance.release()
+                raise
+            if rest is None:
+                resp.close()
+                instance.release()
+                content = b''.join(chunks)
+                shareable = flight is not None and len(content) <= COALESCER.max_bytes
+                if storable:
+                    entry = RESPONSE_CACHE.put(cache_key, service_name, resp.status_code,
+                                               list(headers.items()), content, cache_ttl, generation)
+                    if shareable:
+                        COALESCER.finish(flight_key, flight, response_parts(entry, None, 'MISS'))
+                    return cached_response(entry, 'MISS')
+                if shareable:
+                    COALESCER.finish(flight_key, flight, (resp.status_code, list(headers.items()), content))
+                return Response(content, status=resp.status_code, headers=headers)
+            # Too big to cache or share: relay what was read and stream the rest
+            if storable:
+                RESPONSE_CACHE.count('too_large')
+            return Response(ResponseRelay(resp, on_close=instance.release, prefix=chunks, rest=rest),
+                            status=resp.status_code, headers=headers, direct_passthrough=True)
+        
+        if stream:
+            # Relay the raw upstream bytes chunk by chunk; Content-Length and
+            # Content-Encoding from the upstream still describe them exactly
+            return Response(ResponseRelay(resp, on_close=instance.release), status=resp.status_code,
+                            headers=headers, direct_passthrough=True)
         
-        # Return response content, status code, and headers
-        headers = dict(resp.headers)
         # Remove content-length header as it might not match after processing
         headers.pop('Content-Length', None)
         headers.pop('content-length', None)
         
         return (resp.content, resp.status_code, headers)
             
-    except requests.exceptions.RequestException as e:
-        print(f"❌ Failed: {target_url} - {str(e)}")
+    except CircuitOpen as e:
+        # Refused without a network call, so this costs microseconds
+        return jsonify({
+            'error': f'Service {service_name} unavailable',
+            'detail': str(e)
+        }), 503, {'Retry-After': str(e.retry_after)}
+    except UpstreamBusy as e:
+        log.warning("Rejected %s: %s", target, e)
+        return jsonify({
+            'error': f'Service {service_name} busy',
+            'detail': str(e)
+        }), 503
+    except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+        log.warning("Failed %s: %s", target, e)
         return jsonify({
             'error': f'Service {service_name} unavailable',
             'detail': str(e),
-            'tried_url': target_url
+            'tried_urls': [instance.url_for(subpath) for instance in tried]
         }), 503
+    finally:
+        if flight is not None:
+            # No-op when the response was already shared; otherwise waiters go upstream themselves
+            COALESCER.finish(flight_key, flight)
+        # Even a failed or timed-out write may have reached the service
+        if request.method in WRITE_METHODS:
+            RESPONSE_CACHE.invalidate_service(service_name)
+
+def fetch_part(part, headers):
+    """Run one GET of a batch, from the response cache or an upstream instance."""
+    upstream = UPSTREAMS.get(part.service)
+    if upstream is None:
+        return part_error(404, 'Service not found')
+    
+    cache_ttl = RESPONSE_CACHE.ttl_for(part.service, part.subpath)
+    if cache_ttl:
+        cache_key = RESPONSE_CACHE.make_key(part.service, part.subpath, part.query.encode(), headers)
+        entry = RESPONSE_CACHE.get(cache_key)
+        if entry is not None:
+            return part_result(entry.status, content_type(entry.headers), entry.body)
+        generation = RESPONSE_CACHE.generation(part.service)
+    
+    try:
+        # The part's deadline is enforced by batch(), so a short one can't count against the instance
+        resp, instance = upstream.request('GET', part.subpath, headers=headers, params=part.query,
+                                          timeout=5, stream=True, retry=True)
+        try:
+            chunks, rest = read_up_to(resp, GATEWAY_BATCH_MAX_BYTES)
+        finally:
+            resp.close()
+            instance.release()
+    except CircuitOpen as e:
+        return part_error(503, str(e))
+    except UpstreamBusy as e:
+        return part_error(503, str(e))
+    except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+        return part_error(503, f"Service {part.service} unavailable: {e}")
+    if rest is not None:
+        return part_error(502, f"Response larger than {GATEWAY_BATCH_MAX_BYTES} bytes; request it on its own")
+    
+    content = b''.join(chunks)
+    if cache_ttl and is_storable(resp.status_code, resp.headers):
+        headers = filter_headers(resp.headers, exclude=EXCLUDED_RESPONSE_HEADERS)
+        RESPONSE_CACHE.put(cache_key, part.service, resp.status_code, list(headers.items()),
+                           content, cache_ttl, generation)
+    return part_result(resp.status_code, resp.headers.get('Content-Type', ''), content)
+
+@app.route('/api/batch', methods=['POST'])
+def batch():
+    """Run several GETs concurrently and answer with all their results (see aggregate.py)."""
+    try:
+        parts = parse_batch(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    headers = part_headers(request.headers)
+    started = time.monotonic()
+    # Each part runs in a copy of this request's context, so its upstream calls join the trace
+    futures = {part.name: BATCH_EXECUTOR.submit(contextvars.copy_context().run, fetch_part, part, headers)
+               for part in parts}
+    results = {}
+    # Soonest deadline first, so every part is held to its own timeout
+    for part in sorted(parts, key=lambda part: part.timeout):
+        future = futures[part.name]
+        try:
+            results[part.name] = future.result(timeout=max(0, started + part.timeout - time.monotonic()))
+        except FutureTimeout:
+            # Still queued parts are dropped; running ones end with their upstream timeout
+            future.cancel()
+            results[part.name] = part_error(504, f"No answer within {part.timeout}s")
+    return jsonify(batch_response({part.name: results[part.name] for part in parts}))
+
+@app.route('/api/auth/verify', methods=['POST'])
+def verify_token():
+    """Verify signed tokens locally; anything else is proxied to the auth service."""
+    if TOKEN_VERIFIER is None:
+        return proxy_request('auth', 'verify')
+    
+    body = request.get_data()
+    data = request.get_json(silent=True)
+    token = data.get('token') if isinstance(data, dict) else None
+    if not is_signed_token(token):
+        return proxy_request('auth', 'verify', body=body)
+    
+    claims = TOKEN_VERIFIER.verify(token)
+    if claims is not None:
+        return jsonify({'valid': True, 'user': claims_user(claims)}), 200
+    return jsonify({'valid': False, 'message': 'Invalid or expired token'}), 401
 
 @app.route('/api/<service_name>', methods=['GET', 'POST', 'PUT', 'DELETE'])
 def proxy_service_root(service_name):
@@ -83,33 +351,50 @@ def proxy_api(service_name, subpath):
 
 @app.route('/')
 def serve_home():
-    """Serve the main dashboard page."""
-    try:
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        # Go up one level from src/api-gateway/ to src/, then to frontend/
-        frontend_path = os.path.join(current_dir, '..', 'frontend', 'index.html')
-        frontend_path = os.path.abspath(frontend_path)
-        
-        print(f"📁 Serving frontend from: {frontend_path}")
-        print(f"📁 File exists: {os.path.exists(frontend_path)}")
-        
-        if os.path.exists(frontend_path):
-            return send_file(frontend_path)
-        else:
-            return jsonify({
-                'message': 'API Gateway is running but frontend not found',
-                'frontend_path': frontend_path,
-                'available_endpoints': {
-                    'gateway_health': '/health',
-                    'auth_service': '/api/auth',
-                    'user_service': '/api/user', 
-                    'survey_service': '/api/survey',
-                    'payment_service': '/api/payment'
-                }
-            }), 404
-            
-    except Exception as e:
-        return f"Error loading frontend: {str(e)}", 500
+    """Serve the main dashboard page from memory (see assets.py)."""
+    parts = STATIC_ASSETS.response_parts('index.html', request.headers.get('Accept-Encoding'),
+                                         request.headers.get('If-None-Match'))
+    if parts is None:
+        return jsonify({
+            'message': 'API Gateway is running but frontend not found',
+            'frontend_path': os.path.join(STATIC_ASSETS.directory, 'index.html'),
+            'available_endpoints': {
+                'gateway_health': '/health',
+                'gateway_metrics': '/metrics',
+                'auth_service': '/api/auth',
+                'user_service': '/api/user', 
+                'survey_service': '/api/survey',
+                'payment_service': '/api/payment'
+            }
+        }), 404
+    status, headers, body = parts
+    return Response(body, status=status, headers=headers)
+
+@app.after_request
+def compress_response(response):
+    """Compress the body for clients that accept it; streamed bodies chunk by chunk."""
+    content_type = response.headers.get('Content-Type', '')
+    if COMPRESSION.varies(content_type):
+        response.vary.add('Accept-Encoding')
+    length = response.content_length if response.is_streamed else len(response.get_data())
+    encoding = COMPRESSION.choose(request.method, request.headers.get('Accept-Encoding'), response.status_code,
+                                  content_type, response.headers.get('Content-Encoding'), length)
+    if encoding is None:
+        return response
+
+    route = route_for(request.path)
+    etag = response.headers.get('ETag')
+    if response.is_streamed:
+        # Closing the wrapper still closes the relay, which frees the upstream slot
+        response.response = CompressedBody(response.response, COMPRESSION.stream(route, encoding))
+        response.headers.pop('Content-Length', None)
+    else:
+        key = (request.full_path, etag) if etag and not etag.startswith('W/') else None
+        response.set_data(COMPRESSION.compress(route, encoding, response.get_data(), key))
+    response.headers['Content-Encoding'] = encoding
+    if etag:
+        response.headers['ETag'] = weak_etag(etag)
+    return response
 
 @app.route('/health')
 def health():
@@ -117,17 +402,38 @@ def health():
     return jsonify({
         'status': 'healthy', 
         'service': 'api-gateway',
-        'port': 8000
+        'engine': 'flask',
+        'port': 8000,
+        'upstreams': UPSTREAMS.stats(),
+        'cache': RESPONSE_CACHE.stats(),
+        'coalescing': COALESCER.stats(),
+        'compression': COMPRESSION.stats(),
+        'static': STATIC_ASSETS.stats(),
+        'revocations': TOKEN_VERIFIER.revocations.stats() if TOKEN_VERIFIER else None
     })
 
 if __name__ == '__main__':
     host = os.getenv('API_GATEWAY_HOST', '0.0.0.0')
     port = int(os.getenv('API_GATEWAY_PORT', '8000'))
     debug = os.getenv('FLASK_DEBUG', 'False').lower() == 'true'
+    # 'flask' (threaded WSGI, default) or 'asyncio' (aiohttp, see async_app.py)
+    engine = os.getenv('GATEWAY_ENGINE', 'flask').lower()
     
-    print(f"🚀 Starting API Gateway on {host}:{port}...")
+    print(f"🚀 Starting API Gateway ({engine} engine) on {host}:{port}...")
     print("📋 Available services:")
     for service, url in SERVICE_URLS.items():
         print(f"   - {service}: {url}")
     
-    app.run(host=host, port=port, debug=debug)
\ No newline at end of file
+    if engine == 'asyncio':
+        # Imported lazily so the Flask engine doesn't need aiohttp installed
+        from async_app import run
+        run(SERVICE_URLS, host, port)
+    elif engine == 'flask':
+        UPSTREAMS.start_reloading()
+        UPSTREAMS.start_health_checks()
+        if TOKEN_VERIFIER:
+            # Refreshed on a background thread, so verifying never waits for auth
+            TOKEN_VERIFIER.revocations.start()
+        app.run(host=host, port=port, debug=debug)
+    else:
+        raise ValueError(f"Unknown GATEWAY_ENGINE '{engine}' (expected 'flask' or 'asyncio')")
\ No newline at end of file
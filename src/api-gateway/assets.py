@@ -0,0 +1,154 @@
+"""The dashboard's static files, served from memory.
+
+Every file in STATIC_DIR with a known web content type is read once. It is
+kept with a copy compressed at the highest level for each encoding
+compress.py offers, and every copy has its own strong ETag. Serving a file
+is a dict lookup: no stat, no open and no compression per request.
+
+HTML is sent with ``Cache-Control: no-cache``: the file names aren't
+fingerprinted, so browsers keep the page but revalidate it, and get a 304
+until it changes. Other files may be cached for STATIC_MAX_AGE seconds.
+
+With STATIC_RELOAD on (the default when FLASK_DEBUG is true), the directory
+is checked for changes at most every STATIC_RELOAD_INTERVAL seconds, on the
+next request, so frontend edits show up without a restart.
+
+Tuning (all optional):
+    STATIC_DIR              directory served (default src/frontend)
+    STATIC_RELOAD           "true" reloads files that change on disk
+    STATIC_RELOAD_INTERVAL  seconds between checks for changes (default 1)
+    STATIC_MAX_AGE          browser cache lifetime of non-HTML files in seconds (default 86400)
+"""
+import logging
+import mimetypes
+import os
+import threading
+import time
+
+from cache import etag_matches, make_etag
+from compress import MAX_LEVELS
+
+log = logging.getLogger(__name__)
+
+DEFAULT_STATIC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'frontend'))
+
+
+class Asset:
+    """One file's bytes, compressed copies and response headers."""
+
+    __slots__ = ('content_type', 'cache_control', 'body', 'etag', 'variants')
+
+    def __init__(self, content_type, cache_control, body, variants):
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.body = body
+        self.etag = make_etag(body)
+        # {encoding: (body, etag)}, only for encodings that actually shrink the file
+        self.variants = variants
+
+
+class StaticAssets:
+    """Files of a directory loaded into memory, optionally reloaded when they change."""
+
+    def __init__(self, directory, compression, max_age=86400, reload=False, reload_interval=1.0):
+        self.directory = directory
+        self.compression = compression
+        self.max_age = max_age
+        self.reload = reload
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._mtimes = {}
+        self._assets = {}
+        self._checked = 0.0
+        self._refresh()
+
+    def _scan(self):
+        """``{name: mtime}`` of the servable files in the directory."""
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return {}
+        mtimes = {}
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if mimetypes.guess_type(name)[0] and os.path.isfile(path):
+                mtimes[name] = os.stat(path).st_mtime
+        return mtimes
+
+    def _load(self, name):
+        with open(os.path.join(self.directory, name), 'rb') as f:
+            body = f.read()
+        content_type = mimetypes.guess_type(name)[0]
+        if content_type.startswith('text/') or content_type in ('application/javascript', 'application/json'):
+            content_type += '; charset=utf-8'
+        cache_control = 'no-cache' if content_type.startswith('text/html') else f"public, max-age={self.max_age}"
+        variants = {}
+        if self.compression.enabled and self.compression.compressible(content_type):
+            for encoding in self.compression.encodings:
+                encoder = self.compression.encoder(encoding, MAX_LEVELS[encoding])
+                compressed = encoder.compress(body) + encoder.finish()
+                if len(compressed) < len(body):
+                    variants[encoding] = (compressed, make_etag(compressed))
+        return Asset(content_type, cache_control, body, variants)
+
+    def _refresh(self):
+        mtimes = self._scan()
+        if mtimes == self._mtimes:
+            return
+        assets = {}
+        for name, mtime in mtimes.items():
+            unchanged = self._mtimes.get(name) == mtime and name in self._assets
+            try:
+                assets[name] = self._assets[name] if unchanged else self._load(name)
+            except OSError as e:
+                log.warning("Static file %s unreadable: %s", name, e)
+        if self._mtimes:
+            log.info("Static files reloaded from %s", self.directory)
+        self._mtimes = mtimes
+        self._assets = assets
+
+    def get(self, name):
+        if self.reload and time.monotonic() - self._checked >= self.reload_interval:
+            with self._lock:
+                if time.monotonic() - self._checked >= self.reload_interval:
+                    self._refresh()
+                    self._checked = time.monotonic()
+        return self._assets.get(name)
+
+    def response_parts(self, name, accept_encoding, if_none_match):
+        """Status, headers and body to send for a file, or ``None`` when there's no such file."""
+        asset = self.get(name)
+        if asset is None:
+            return None
+        encoding = self.compression.choose('GET', accept_encoding, 200, asset.content_type, None, len(asset.body))
+        body, etag = asset.variants.get(encoding, (asset.body, asset.etag))
+        headers = [('ETag', etag), ('Cache-Control', asset.cache_control)]
+        if asset.variants:
+            headers.append(('Vary', 'Accept-Encoding'))
+        if etag_matches(if_none_match, etag):
+            return 304, headers, b''
+        if encoding in asset.variants:
+            headers.append(('Content-Encoding', encoding))
+            self.compression.record(name, encoding, len(asset.body), len(body), 0.0, reused=True)
+        return 200, headers + [('Content-Type', asset.content_type)], body
+
+    def stats(self):
+        assets = self._assets
+        return {
+            'directory': self.directory,
+            'reload': self.reload,
+            'files': {name: {'bytes': len(asset.body),
+                             'variants': {encoding: len(body) for encoding, (body, _) in asset.variants.items()}}
+                      for name, asset in assets.items()}
+        }
+
+
+def static_assets_from_env(compression):
+    debug = os.getenv('FLASK_DEBUG', 'False').lower() == 'true'
+    return StaticAssets(
+        os.path.abspath(os.getenv('STATIC_DIR', DEFAULT_STATIC_DIR)),
+        compression,
+        max_age=int(os.getenv('STATIC_MAX_AGE', '86400')),
+        reload=os.getenv('STATIC_RELOAD', str(debug)).lower() == 'true',
+        reload_interval=float(os.getenv('STATIC_RELOAD_INTERVAL', '1'))
+    )
@@ -0,0 +1,759 @@
+"""asyncio gateway engine built on aiohttp.
+
+Serves the same routes as the Flask app (``/api/<service_name>[/<subpath>]``,
+``/health`` and the frontend) but proxies upstream calls without tying up a
+thread per request, so thousands of slow in-flight requests fit in one
+process. Selected with ``GATEWAY_ENGINE=asyncio``.
+
+Each in-flight request holds one upstream connection, so raise
+UPSTREAM_MAX_CONCURRENCY when running this engine under heavy fan-in.
+Instances, balancing and retries work as in the Flask engine (balancer.py).
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector, TraceConfig, web
+from multidict import CIMultiDict
+
+from streaming import PROXY_CHUNK_SIZE, filter_header_items, filter_headers
+from common.metrics import CONTENT_TYPE, IN_FLIGHT, REGISTRY, REQUEST_ERRORS, REQUEST_SECONDS, REQUESTS
+from common import logs, tracing
+from common.signed_tokens import RevocationList, SignedTokenVerifier, TokenCodec, claims_user, is_signed_token, keys_from_env
+from cache import CONDITIONAL_HEADERS, WRITE_METHODS, cache_from_env, is_storable, response_parts, wants_stream
+from coalesce import AsyncCoalescer, coalescer_from_env, shared_headers
+from upstream import (UPSTREAM_MAX_CONCURRENCY, UPSTREAM_MAX_IDLE, UPSTREAM_QUEUE_TIMEOUT, UPSTREAM_SECONDS,
+                      UpstreamBusy, outcome, trace_call)
+from breaker import CircuitOpen, breaker_from_env, health_settings_from_env, health_url
+from balancer import (GATEWAY_RETRIES, RETRY_METHODS, RETRY_STATUSES, InstanceSet, instances_file_from_env,
+                      parse_instances, retryable)
+from aggregate import GATEWAY_BATCH_MAX_BYTES, batch_response, content_type, parse_batch, part_error, part_headers, part_result
+from assets import static_assets_from_env
+from compress import add_vary, compression_from_env, route_for, weak_etag
+
+# Same framing rules as the Flask engine, except that Content-Length is kept:
+# aiohttp streams the body as-is when the client declared its length
+EXCLUDED_REQUEST_HEADERS = {'host'}
+EXCLUDED_RESPONSE_HEADERS = {'server', 'date'}
+
+# Larger bodies are compressed in a worker thread so the event loop keeps serving
+COMPRESS_IN_THREAD_BYTES = 64 * 1024
+
+log = logging.getLogger('gateway')
+
+
+class AsyncInstance:
+    """aiohttp session, concurrency limit, circuit breaker and counters for one instance of a service."""
+
+    def __init__(self, name, base_url, weight=1, max_concurrency=UPSTREAM_MAX_CONCURRENCY,
+                 max_idle=UPSTREAM_MAX_IDLE, queue_timeout=UPSTREAM_QUEUE_TIMEOUT):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.weight = weight
+        self.max_concurrency = max_concurrency
+        self.max_idle = max_idle
+        self.queue_timeout = queue_timeout
+        self.session = None
+        self.breaker = breaker_from_env(f"{name} at {self.base_url}")
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self.in_flight = 0
+        self._stats = {
+            'requests': 0,
+            'rejected': 0,
+            'new_connections': 0,
+            'reused_connections': 0
+        }
+
+    def url_for(self, subpath=""):
+        return f"{self.base_url}/{subpath}" if subpath else self.base_url
+
+    def start(self):
+        trace = TraceConfig()
+        trace.on_connection_create_end.append(self._on_new_connection)
+        trace.on_connection_reuseconn.append(self._on_reused_connection)
+        self.session = ClientSession(
+            connector=TCPConnector(limit=self.max_concurrency, keepalive_timeout=self.max_idle),
+            timeout=ClientTimeout(total=None, connect=5, sock_read=5),
+            # Relay bytes exactly as the upstream encoded them
+            auto_decompress=False,
+            trace_configs=[trace]
+        )
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    async def _on_new_connection(self, session, ctx, params):
+        self._stats['new_connections'] += 1
+
+    async def _on_reused_connection(self, session, ctx, params):
+        self._stats['reused_connections'] += 1
+
+    async def acquire(self):
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._stats['rejected'] += 1
+            raise UpstreamBusy(f"Too many in-flight requests to {self.name} at {self.base_url} (limit {self.max_concurrency})")
+        self.in_flight += 1
+        self._stats['requests'] += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self._slots.release()
+
+    async def request(self, method, url, **kwargs):
+        """Send a request and return the response once its headers arrived.
+
+        The concurrency slot stays held: the caller must ``release()`` both
+        the response and this instance. Raises ``CircuitOpen`` without
+        sending anything while the circuit is open.
+        """
+        await self.acquire()
+        try:
+            ticket = self.breaker.allow()
+        except CircuitOpen:
+            self.release()
+            raise
+        ctx = tracing.current()
+        span_id = tracing.new_id()
+        if ctx is not None:
+            kwargs['headers'] = tracing.inject(kwargs.get('headers'), ctx, span_id)
+        wall_started = time.time()
+        started = time.perf_counter()
+        try:
+            resp = await self.session.request(method, url, **kwargs)
+        except asyncio.CancelledError:
+            # The client went away (or a batch part timed out): says nothing about the instance
+            self.breaker.discard(ticket)
+            self.release()
+            raise
+        except BaseException:
+            elapsed = time.perf_counter() - started
+            self.breaker.record(ticket, False, elapsed)
+            UPSTREAM_SECONDS.observe(elapsed, self.name, 'error')
+            trace_call(ctx, span_id, self, method, url, wall_started, elapsed, 'error')
+            self.release()
+            raise
+        # Time to headers, as in the Flask engine
+        elapsed = time.perf_counter() - started
+        self.breaker.record(ticket, resp.status < 500, elapsed)
+        UPSTREAM_SECONDS.observe(elapsed, self.name, outcome(resp.status))
+        trace_call(ctx, span_id, self, method, url, wall_started, elapsed, resp.status)
+        return resp
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats.update({
+            'url': self.base_url,
+            'weight': self.weight,
+            'in_flight': self.in_flight,
+            'circuit': self.breaker.stats()
+        })
+        return stats
+
+
+class AsyncUpstream:
+    """All instances of one backend service; same balancing and retries as ``upstream.Upstream``."""
+
+    def __init__(self, name, specs, retries=GATEWAY_RETRIES):
+        self.name = name
+        self.retries = retries
+        self._started = False
+        self.instances = InstanceSet(name, specs, self._new_instance)
+        self._stats = {'retries': 0}
+
+    def _new_instance(self, url, weight):
+        instance = AsyncInstance(self.name, url, weight)
+        if self._started:
+            instance.start()
+        return instance
+
+    def start(self):
+        self._started = True
+        for instance in self.instances.instances:
+            instance.start()
+
+    async def close(self):
+        for instance in self.instances.all_instances():
+            await instance.close()
+
+    async def request(self, method, subpath="", retry=False, tried=None, **kwargs):
+        """Send a request to the best instance; returns ``(resp, instance)``.
+
+        The caller must ``release()`` both. With ``retry=True`` failures and
+        RETRY_STATUSES answers are sent again to another instance.
+        Instances tried are appended to ``tried``.
+        """
+        tried = [] if tried is None else tried
+        sent = 0
+        failure = previous = None
+        while True:
+            try:
+                instance = self.instances.choose(tried)
+            except CircuitOpen:
+                if failure is None and previous is None:
+                    raise
+                instance = None
+            if instance is None:
+                if previous is not None:
+                    return previous
+                if failure is not None:
+                    raise failure
+                raise UpstreamBusy(f"No instances of {self.name} are accepting requests")
+            if previous is not None:
+                resp, previous_instance = previous
+                resp.release()
+                previous_instance.release()
+                previous = None
+            tried.append(instance)
+            if sent:
+                self._stats['retries'] += 1
+            try:
+                resp = await instance.request(method, instance.url_for(subpath), **kwargs)
+            except (CircuitOpen, UpstreamBusy) as e:
+                # Nothing was sent, so any request may move on to another instance
+                failure = e
+                continue
+            except (ClientError, asyncio.TimeoutError) as e:
+                sent += 1
+                if not retry or sent > self.retries:
+                    raise
+                log.warning("Retrying %s %s/%s: %s", method, self.name, subpath, e or type(e).__name__)
+                failure = e
+                continue
+            sent += 1
+            if retry and sent <= self.retries and resp.status in RETRY_STATUSES:
+                previous = (resp, instance)
+                continue
+            return resp, instance
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats.update({
+            'policy': self.instances.policy,
+            'instances': [instance.stats() for instance in self.instances.instances]
+        })
+        return stats
+
+
+def cached_response(request, entry, cache_state):
+    """Build the aiohttp response for a cache entry, answering 304 when the ETag matches."""
+    cache = request.app['cache']
+    status, headers, body = response_parts(entry, request.headers.get('If-None-Match'), cache_state)
+    if status == 304:
+        cache.count('not_modified')
+    # aiohttp sets Content-Length from the body itself
+    headers = CIMultiDict((k, v) for k, v in headers if k.lower() != 'content-length')
+    return web.Response(body=body, status=status, headers=headers)
+
+
+async def proxy_request(request):
+    """Handle /api/<service_name>[/<subpath>]."""
+    return await proxy(request, request.match_info['service_name'], request.match_info.get('subpath', ''))
+
+
+async def proxy(request, service_name, subpath, body=None):
+    """Stream the request to the matching upstream and relay its response.
+
+    ``body`` replaces the inbound body when the handler already consumed it.
+    """
+    upstream = request.app['upstreams'].get(service_name)
+    if upstream is None:
+        return web.json_response({'error': 'Service not found'}, status=404)
+
+    cache = request.app['cache']
+    coalescer = request.app['coalescer']
+    cache_ttl = 0
+    coalesce = False
+    if request.method == 'GET' and not wants_stream(request.query, request.headers):
+        cache_ttl = cache.ttl_for(service_name, subpath)
+        coalesce = coalescer.applies(service_name, subpath)
+    excluded_headers = EXCLUDED_REQUEST_HEADERS
+    if cache_ttl:
+        cache_key = cache.make_key(service_name, subpath, request.query_string, request.headers)
+        entry = cache.get(cache_key)
+        if entry is not None:
+            return cached_response(request, entry, 'HIT')
+        generation = cache.generation(service_name)
+        excluded_headers = EXCLUDED_REQUEST_HEADERS | CONDITIONAL_HEADERS
+    flight = None
+    if coalesce:
+        flight_key = coalescer.make_key(service_name, subpath, request.query_string, request.headers)
+        flight, leader = coalescer.join(flight_key)
+        if flight is not None and not leader:
+            shared = await coalescer.wait(flight)
+            if shared is not None:
+                status, headers, body = shared
+                return web.Response(body=body, status=status, headers=CIMultiDict(shared_headers(headers)))
+            # Nothing to share (or the leader is too slow): make our own call
+            flight = None
+
+    if body is None and request.body_exists:
+        # Small bodies of retryable requests are read whole so a retry can resend them
+        small = request.content_length is not None and request.content_length <= PROXY_CHUNK_SIZE
+        body = await request.read() if small and request.method in RETRY_METHODS else request.content
+    tried = []
+
+    resp = instance = response = None
+    try:
+        resp, instance = await upstream.request(
+            request.method,
+            subpath,
+            headers=filter_headers(request.headers, exclude=excluded_headers),
+            params=request.query,
+            data=body,
+            allow_redirects=False,
+            retry=retryable(request.method, body),
+            tried=tried
+        )
+        headers = filter_header_items(resp.headers, exclude=EXCLUDED_RESPONSE_HEADERS)
+        chunks = []
+        storable = cache_ttl and is_storable(resp.status, resp.headers)
+        if storable or flight is not None:
+            limit = max(cache.max_entry_bytes if storable else 0,
+                        coalescer.max_bytes if flight is not None else 0)
+            size = 0
+            complete = True
+            async for chunk in resp.content.iter_chunked(PROXY_CHUNK_SIZE):
+                chunks.append(chunk)
+                size += len(chunk)
+                if size > limit:
+                    complete = False
+                    break
+            if complete:
+                content = b''.join(chunks)
+                shareable = flight is not None and size <= coalescer.max_bytes
+                if storable:
+                    entry = cache.put(cache_key, service_name, resp.status, headers,
+                                      content, cache_ttl, generation)
+                    if shareable:
+                        coalescer.finish(flight_key, flight, response_parts(entry, None, 'MISS'))
+                    return cached_response(request, entry, 'MISS')
+                if shareable:
+                    coalescer.finish(flight_key, flight, (resp.status, headers, content))
+                return web.Response(body=content, status=resp.status, headers=CIMultiDict(
+                    (k, v) for k, v in headers if k.lower() != 'content-length'))
+            # Too big to cache or share: relay what was read and stream the rest
+            if storable:
+                cache.count('too_large')
+
+        response = web.StreamResponse(status=resp.status, headers=CIMultiDict(headers))
+        encoding = choose_encoding(request, resp.status, response.headers, resp.content_length)
+        compressor = request.app['compression'].stream(route_for(request.path), encoding) if encoding else None
+        await response.prepare(request)
+        for chunk in chunks:
+            await response.write(compressor.compress(chunk) if compressor else chunk)
+        async for chunk in resp.content.iter_chunked(PROXY_CHUNK_SIZE):
+            await response.write(compressor.compress(chunk) if compressor else chunk)
+        if compressor:
+            await response.write(compressor.finish())
+        await response.write_eof()
+        return response
+    except CircuitOpen as e:
+        # Refused without a network call, so this costs microseconds
+        return web.json_response({
+            'error': f'Service {service_name} unavailable',
+            'detail': str(e)
+        }, status=503, headers={'Retry-After': str(e.retry_after)})
+    except UpstreamBusy as e:
+        return web.json_response({
+            'error': f'Service {service_name} busy',
+            'detail': str(e)
+        }, status=503)
+    except (ClientError, asyncio.TimeoutError) as e:
+        if response is not None and response.prepared:
+            # Headers already went out; all we can do is drop the connection
+            raise
+        return web.json_response({
+            'error': f'Service {service_name} unavailable',
+            'detail': str(e) or type(e).__name__,
+            'tried_urls': [instance.url_for(subpath) for instance in tried]
+        }, status=503)
+    finally:
+        if resp is not None:
+            resp.release()
+            instance.release()
+        if flight is not None:
+            # No-op when the response was already shared; otherwise waiters go upstream themselves
+            coalescer.finish(flight_key, flight)
+        # Even a failed or timed-out write may have reached the service
+        if request.method in WRITE_METHODS:
+            cache.invalidate_service(service_name)
+
+
+async def fetch_part(app, part, headers):
+    """Run one GET of a batch, from the response cache or an upstream instance."""
+    upstream = app['upstreams'].get(part.service)
+    if upstream is None:
+        return part_error(404, 'Service not found')
+
+    cache = app['cache']
+    cache_ttl = cache.ttl_for(part.service, part.subpath)
+    if cache_ttl:
+        cache_key = cache.make_key(part.service, part.subpath, part.query, headers)
+        entry = cache.get(cache_key)
+        if entry is not None:
+            return part_result(entry.status, content_type(entry.headers), entry.body)
+        generation = cache.generation(part.service)
+
+    try:
+        # The part's deadline is enforced by run_part, so a short one can't count against the instance
+        resp, instance = await upstream.request('GET', part.subpath, retry=True, headers=headers, params=part.query)
+        try:
+            chunks = []
+            size = 0
+            async for chunk in resp.content.iter_chunked(PROXY_CHUNK_SIZE):
+                chunks.append(chunk)
+                size += len(chunk)
+                if size > GATEWAY_BATCH_MAX_BYTES:
+                    return part_error(502, f"Response larger than {GATEWAY_BATCH_MAX_BYTES} bytes; request it on its own")
+        finally:
+            resp.release()
+            instance.release()
+    except CircuitOpen as e:
+        return part_error(503, str(e))
+    except UpstreamBusy as e:
+        return part_error(503, str(e))
+    except (ClientError, asyncio.TimeoutError) as e:
+        return part_error(503, f"Service {part.service} unavailable: {str(e) or type(e).__name__}")
+
+    content = b''.join(chunks)
+    if cache_ttl and is_storable(resp.status, resp.headers):
+        cache.put(cache_key, part.service, resp.status,
+                  filter_header_items(resp.headers, exclude=EXCLUDED_RESPONSE_HEADERS),
+                  content, cache_ttl, generation)
+    return part_result(resp.status, resp.headers.get('Content-Type', ''), content)
+
+
+async def run_part(app, part, headers):
+    try:
+        return await asyncio.wait_for(fetch_part(app, part, headers), timeout=part.timeout)
+    except asyncio.TimeoutError:
+        return part_error(504, f"No answer within {part.timeout}s")
+
+
+async def batch(request):
+    """Run several GETs concurrently and answer with all their results (see aggregate.py)."""
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    try:
+        parts = parse_batch(data)
+    except ValueError as e:
+        return web.json_response({'error': str(e)}, status=400)
+
+    headers = part_headers(request.headers)
+    results = await asyncio.gather(*(run_part(request.app, part, headers) for part in parts))
+    return web.json_response(batch_response({part.name: result for part, result in zip(parts, results)}))
+
+
+async def verify_token(request):
+    """Verify signed tokens locally; anything else is proxied to the auth service."""
+    verifier = request.app['token_verifier']
+    if verifier is None:
+        return await proxy(request, 'auth', 'verify')
+
+    body = await request.read()
+    try:
+        data = json.loads(body)
+    except ValueError:
+        data = None
+    token = data.get('token') if isinstance(data, dict) else None
+    if not is_signed_token(token):
+        return await proxy(request, 'auth', 'verify', body=body)
+
+    claims = verifier.verify(token)
+    if claims is not None:
+        return web.json_response({'valid': True, 'user': claims_user(claims)})
+    return web.json_response({'valid': False, 'message': 'Invalid or expired token'}, status=401)
+
+
+async def refresh_revocations(app, interval):
+    """Keep the signed-token revocation list in sync with the auth service."""
+    revocations = app['token_verifier'].revocations
+    auth = app['upstreams']['auth']
+    while True:
+        try:
+            resp, instance = await auth.request('GET', 'revoked', retry=True, timeout=ClientTimeout(total=2))
+            try:
+                resp.raise_for_status()
+                payload = await resp.json()
+            finally:
+                resp.release()
+                instance.release()
+            revocations.merge((item['jti'], item['exp']) for item in payload['revoked'])
+        except (ClientError, asyncio.TimeoutError, CircuitOpen, UpstreamBusy, ValueError, KeyError) as e:
+            log.warning("Revocation list refresh failed: %s", e)
+        await asyncio.sleep(interval)
+
+
+async def check_health(app, interval, timeout):
+    """Poll every upstream instance's health endpoint and report to its circuit breaker."""
+    while True:
+        for upstream in list(app['upstreams'].values()):
+            for instance in upstream.instances.all_instances():
+                started = time.perf_counter()
+                try:
+                    async with instance.session.get(health_url(instance.base_url),
+                                                    timeout=ClientTimeout(total=timeout)) as resp:
+                        ok = resp.status == 200
+                except (ClientError, asyncio.TimeoutError):
+                    ok = False
+                instance.breaker.record_health(ok, time.perf_counter() - started)
+        await asyncio.sleep(interval)
+
+
+async def reload_instances(app, instances_file, interval):
+    """Apply GATEWAY_INSTANCES_FILE whenever it changes and close instances that finished draining."""
+    upstreams = app['upstreams']
+    while True:
+        try:
+            for name, specs in (instances_file.poll() or {}).items():
+                if name in upstreams:
+                    upstreams[name].instances.update(specs)
+                else:
+                    upstreams[name] = AsyncUpstream(name, specs)
+                    upstreams[name].start()
+            for upstream in upstreams.values():
+                for instance in upstream.instances.drained():
+                    await instance.close()
+        except Exception as e:
+            log.error("Instance reload failed: %s", e)
+        await asyncio.sleep(interval)
+
+
+async def serve_home(request):
+    """Serve the main dashboard page from memory (see assets.py)."""
+    assets = request.app['static_assets']
+    parts = assets.response_parts('index.html', request.headers.get('Accept-Encoding'),
+                                  request.headers.get('If-None-Match'))
+    if parts is not None:
+        status, headers, body = parts
+        return web.Response(body=body, status=status, headers=CIMultiDict(headers))
+    return web.json_response({
+        'message': 'API Gateway is running but frontend not found',
+        'frontend_path': os.path.join(assets.directory, 'index.html'),
+        'available_endpoints': {
+            'gateway_health': '/health',
+            'gateway_metrics': '/metrics',
+            'auth_service': '/api/auth',
+            'user_service': '/api/user',
+            'survey_service': '/api/survey',
+            'payment_service': '/api/payment'
+        }
+    }, status=404)
+
+
+async def health(request):
+    """Health check endpoint"""
+    return web.json_response({
+        'status': 'healthy',
+        'service': 'api-gateway',
+        'engine': 'asyncio',
+        'port': 8000,
+        'upstreams': {name: upstream.stats() for name, upstream in request.app['upstreams'].items()},
+        'cache': request.app['cache'].stats(),
+        'coalescing': request.app['coalescer'].stats(),
+        'compression': request.app['compression'].stats(),
+        'static': request.app['static_assets'].stats(),
+        'revocations': request.app['token_verifier'].revocations.stats() if request.app['token_verifier'] else None
+    })
+
+
+async def metrics(request):
+    """Request, upstream and cache metrics in the Prometheus text format (see common/metrics.py)."""
+    return web.Response(body=REGISTRY.render().encode(), headers={'Content-Type': CONTENT_TYPE})
+
+
+def metrics_route(request):
+    """Route label for request metrics, as in the Flask engine: the service is filled in for proxied calls."""
+    resource = request.match_info.route.resource
+    if resource is None:
+        return 'unmatched'
+    route = resource.canonical
+    service = request.match_info.get('service_name')
+    if service in request.app['upstreams']:
+        return route.replace('{service_name}', service)
+    return route
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    """Per-route request count, errors, latency and in-flight requests."""
+    route = metrics_route(request)
+    started = time.perf_counter()
+    status = 500
+    IN_FLIGHT.add()
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        REQUEST_SECONDS.observe(time.perf_counter() - started, route, request.method)
+        REQUESTS.inc(route, request.method, str(status))
+        if status >= 500:
+            REQUEST_ERRORS.inc(route, request.method)
+        IN_FLIGHT.add(value=-1)
+
+
+@web.middleware
+async def tracing_middleware(request, handler):
+    """Request ID and handler span, as trace_flask() does for the Flask engine (see common/tracing.py)."""
+    ctx = request['trace'] = tracing.incoming(request.headers)
+    token = tracing.activate(ctx)
+    resource = request.match_info.route.resource
+    wall_started = time.time()
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        tracing.record(ctx, f"{request.method} {resource.canonical if resource else 'unmatched'}", wall_started,
+                       time.perf_counter() - started, kind='SERVER', span_id=ctx.span_id,
+                       tags={'http.method': request.method, 'http.path': request.path, 'http.status_code': status})
+        tracing.deactivate(token)
+
+
+@web.middleware
+async def logging_middleware(request, handler):
+    """One JSON log line per request, as log_flask() writes for the Flask engine (see common/logs.py)."""
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        ctx = request.get('trace')
+        logs.log_request(request.method, request.path, metrics_route(request), status, time.perf_counter() - started,
+                         ctx.request_id if ctx is not None else None)
+
+
+@web.middleware
+async def cors_middleware(request, handler):
+    """Mirror Flask-CORS defaults: allow any origin and answer preflights."""
+    if request.method == 'OPTIONS':
+        return web.Response(headers={
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
+            'Access-Control-Allow-Headers': request.headers.get('Access-Control-Request-Headers', '*')
+        })
+    return await handler(request)
+
+
+def choose_encoding(request, status, headers, length):
+    """Negotiate compression for a response and adjust its headers; returns the encoding or ``None``."""
+    compression = request.app['compression']
+    content_type = headers.get('Content-Type', '')
+    if compression.varies(content_type):
+        headers['Vary'] = add_vary(headers.get('Vary'))
+    encoding = compression.choose(request.method, request.headers.get('Accept-Encoding'), status,
+                                  content_type, headers.get('Content-Encoding'), length)
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding
+        headers.pop('Content-Length', None)
+        if 'ETag' in headers:
+            headers['ETag'] = weak_etag(headers['ETag'])
+    return encoding
+
+
+@web.middleware
+async def compression_middleware(request, handler):
+    """Compress whole bodies for clients that accept it; proxy() compresses streamed ones itself."""
+    response = await handler(request)
+    if type(response) is not web.Response or not isinstance(response.body, bytes):
+        return response
+    etag = response.headers.get('ETag')
+    encoding = choose_encoding(request, response.status, response.headers, len(response.body))
+    if encoding is None:
+        return response
+    key = (request.path_qs, etag) if etag and not etag.startswith('W/') else None
+    args = (route_for(request.path), encoding, response.body, key)
+    if len(response.body) > COMPRESS_IN_THREAD_BYTES:
+        response.body = await asyncio.get_running_loop().run_in_executor(None, request.app['compression'].compress, *args)
+    else:
+        response.body = request.app['compression'].compress(*args)
+    return response
+
+
+async def _add_cors_header(request, response):
+    # Runs before headers are sent, so it also covers streamed responses
+    response.headers.setdefault('Access-Control-Allow-Origin', '*')
+
+
+async def _add_request_id(request, response):
+    ctx = request.get('trace')
+    if ctx is not None:
+        response.headers[tracing.REQUEST_ID_HEADER] = ctx.request_id
+
+
+def create_app(service_urls):
+    tracing.configure('api-gateway')
+    logs.configure('api-gateway')
+    app = web.Application(middlewares=[metrics_middleware, tracing_middleware, logging_middleware, cors_middleware,
+                                       compression_middleware])
+    app['upstreams'] = {name: AsyncUpstream(name, parse_instances(urls)) for name, urls in service_urls.items()}
+    app['cache'] = cache_from_env()
+    app['coalescer'] = coalescer_from_env(AsyncCoalescer)
+    app['compression'] = compression_from_env()
+    app['static_assets'] = static_assets_from_env(app['compression'])
+
+    keys = keys_from_env()
+    # Refreshed by a background task instead of inline, so no loader here
+    app['token_verifier'] = SignedTokenVerifier(TokenCodec(keys), RevocationList()) if keys else None
+
+    async def start_upstreams(app):
+        for upstream in app['upstreams'].values():
+            upstream.start()
+        instances_file, reload_interval = instances_file_from_env()
+        if instances_file is not None:
+            app['reload_task'] = asyncio.create_task(reload_instances(app, instances_file, reload_interval))
+        if app['token_verifier'] is not None:
+            interval = float(os.getenv('AUTH_REVOCATION_REFRESH', '5'))
+            app['revocation_task'] = asyncio.create_task(refresh_revocations(app, interval))
+        interval, timeout = health_settings_from_env()
+        if interval > 0:
+            app['health_task'] = asyncio.create_task(check_health(app, interval, timeout))
+
+    async def close_upstreams(app):
+        for task in ('reload_task', 'revocation_task', 'health_task'):
+            if task in app:
+                app[task].cancel()
+        for upstream in app['upstreams'].values():
+            await upstream.close()
+
+    app.on_startup.append(start_upstreams)
+    app.on_cleanup.append(close_upstreams)
+    app.on_response_prepare.append(_add_cors_header)
+    app.on_response_prepare.append(_add_request_id)
+
+    # Registered before the catch-all proxy routes so they take precedence
+    app.router.add_post('/api/auth/verify', verify_token)
+    app.router.add_post('/api/batch', batch)
+    methods = ['GET', 'POST', 'PUT', 'DELETE']
+    for method in methods:
+        app.router.add_route(method, '/api/{service_name}', proxy_request)
+        app.router.add_route(method, '/api/{service_name}/{subpath:.*}', proxy_request)
+    app.router.add_get('/health', health)
+    app.router.add_get('/metrics', metrics)
+    app.router.add_get('/', serve_home)
+    return app
+
+
+def run(service_urls, host, port):
+    web.run_app(create_app(service_urls), host=host, port=port, access_log=None)
@@ -0,0 +1,175 @@
+"""Spreading each service's traffic over several instances.
+
+Every ``*_SERVICE_URL`` may list several instances of the service, comma
+separated, each optionally weighted::
+
+    USER_SERVICE_URL=http://user-1:5002/api/user,http://user-2:5002/api/user;weight=2
+
+Each instance has its own keep-alive pool, concurrency limit and circuit
+breaker (see breaker.py). An instance whose breaker is open is ejected: it
+gets no traffic until the breaker lets trial requests through again. Weight
+0 drains an instance without dropping its in-flight requests.
+
+Idempotent requests that fail to connect, time out or get a
+GATEWAY_RETRY_STATUSES answer are retried on a different instance, up to
+GATEWAY_RETRIES times. Requests refused by an instance before anything was
+sent (circuit open, no free slot) move on to another instance whatever
+their method.
+
+GATEWAY_INSTANCES_FILE names a JSON file such as
+``{"user": ["http://user-1:5002/api/user", "http://user-3:5002/api/user;weight=2"]}``.
+It is checked every GATEWAY_INSTANCES_RELOAD seconds and, when it changes,
+replaces the instance lists of the services it names; instances that stay
+keep their connections and breaker state.
+
+Tuning (all optional):
+    GATEWAY_LB_POLICY         least_outstanding or round_robin (default least_outstanding)
+    GATEWAY_RETRIES           extra attempts on another instance (default 1)
+    GATEWAY_RETRY_METHODS     methods that are retried (default GET,HEAD,OPTIONS,PUT,DELETE)
+    GATEWAY_RETRY_STATUSES    upstream statuses that are retried (default 502,503,504)
+    GATEWAY_INSTANCES_FILE    JSON file of instance lists, reloaded when it changes
+    GATEWAY_INSTANCES_RELOAD  seconds between checks of that file (default 5)
+"""
+import json
+import logging
+import os
+import random
+import threading
+
+from breaker import CircuitOpen
+
+log = logging.getLogger(__name__)
+
+LEAST_OUTSTANDING = 'least_outstanding'
+ROUND_ROBIN = 'round_robin'
+POLICIES = (LEAST_OUTSTANDING, ROUND_ROBIN)
+
+GATEWAY_LB_POLICY = os.getenv('GATEWAY_LB_POLICY', LEAST_OUTSTANDING).lower()
+GATEWAY_RETRIES = int(os.getenv('GATEWAY_RETRIES', '1'))
+RETRY_METHODS = {m.strip().upper() for m in os.getenv('GATEWAY_RETRY_METHODS', 'GET,HEAD,OPTIONS,PUT,DELETE').split(',') if m.strip()}
+RETRY_STATUSES = {int(s) for s in os.getenv('GATEWAY_RETRY_STATUSES', '502,503,504').split(',') if s.strip()}
+
+
+def parse_instances(value):
+    """``[(url, weight), ...]`` from a comma-separated instance list."""
+    instances = []
+    for item in value.split(','):
+        url, _, option = item.strip().partition(';')
+        if not url:
+            continue
+        weight = 1
+        if option:
+            key, _, number = option.partition('=')
+            if key.strip() != 'weight' or not number.strip().isdigit():
+                raise ValueError(f"Bad instance option '{option}' (expected weight=<n>)")
+            weight = int(number)
+        instances.append((url.strip().rstrip('/'), weight))
+    return instances
+
+
+class InstancesFile:
+    """GATEWAY_INSTANCES_FILE, re-read only when its modification time changes."""
+
+    def __init__(self, path):
+        self.path = path
+        self._mtime = None
+
+    def poll(self):
+        """``{service: [(url, weight), ...]}`` if the file changed since the last call, else ``None``."""
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError as e:
+            log.warning("Instance list %s unreadable: %s", self.path, e)
+            return None
+        if mtime == self._mtime:
+            return None
+        self._mtime = mtime
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            return {name: parse_instances(value if isinstance(value, str) else ','.join(value))
+                    for name, value in data.items()}
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            # Keep routing to the current instances until the file is fixed
+            log.warning("Instance list %s ignored: %s", self.path, e)
+            return None
+
+
+def instances_file_from_env():
+    path = os.getenv('GATEWAY_INSTANCES_FILE')
+    return (InstancesFile(path) if path else None), float(os.getenv('GATEWAY_INSTANCES_RELOAD', '5'))
+
+
+class InstanceSet:
+    """The instances of one service and the policy that picks between them.
+
+    ``new_instance(url, weight)`` builds an engine-specific instance, which
+    must provide ``base_url``, ``weight``, ``in_flight`` and ``breaker``.
+    """
+
+    def __init__(self, name, specs, new_instance, policy=GATEWAY_LB_POLICY):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown GATEWAY_LB_POLICY '{policy}' (expected {' or '.join(POLICIES)})")
+        self.name = name
+        self.policy = policy
+        self._new_instance = new_instance
+        self._lock = threading.Lock()
+        self._rr_weights = {}
+        self.instances = []
+        self._retired = []
+        self.update(specs)
+
+    def update(self, specs):
+        """Switch to a new instance list; instances that stay keep their connections and state."""
+        with self._lock:
+            current = {instance.base_url: instance for instance in self.instances}
+            instances = []
+            for url, weight in specs:
+                instance = current.pop(url, None) or self._new_instance(url, weight)
+                instance.weight = weight
+                instances.append(instance)
+            self.instances = instances
+            self._rr_weights = {instance: self._rr_weights.get(instance, 0) for instance in instances}
+            self._retired.extend(current.values())
+        if current:
+            log.info("%s: %d instance(s), retiring %s", self.name, len(instances), ', '.join(current))
+
+    def drained(self):
+        """Remove and return retired instances that no longer have requests in flight."""
+        with self._lock:
+            drained = [instance for instance in self._retired if not instance.in_flight]
+            self._retired = [instance for instance in self._retired if instance.in_flight]
+        return drained
+
+    def all_instances(self):
+        with self._lock:
+            return self.instances + self._retired
+
+    def choose(self, tried=()):
+        """The instance for the next attempt, ``None`` once every instance was tried.
+
+        Raises ``CircuitOpen`` when all untried instances are ejected.
+        """
+        with self._lock:
+            instances = [instance for instance in self.instances if instance.weight > 0 and instance not in tried]
+            candidates = [instance for instance in instances if instance.breaker.available()]
+            if not candidates:
+                if not instances:
+                    return None
+                raise CircuitOpen(self.name, min(instance.breaker.retry_after() for instance in instances))
+            if self.policy == ROUND_ROBIN:
+                # Smooth weighted round robin: interleaves instead of bursting the heaviest
+                for instance in candidates:
+                    self._rr_weights[instance] += instance.weight
+                chosen = max(candidates, key=self._rr_weights.get)
+                self._rr_weights[chosen] -= sum(instance.weight for instance in candidates)
+                return chosen
+            load = {instance: instance.in_flight / instance.weight for instance in candidates}
+            lowest = min(load.values())
+            # Random among equally loaded instances so idle ones share the work
+            return random.choice([instance for instance in candidates if load[instance] == lowest])
+
+
+def retryable(method, body):
+    """Whether a request may be sent again: an idempotent method and a body that can be replayed."""
+    return GATEWAY_RETRIES > 0 and method in RETRY_METHODS and (body is None or isinstance(body, bytes))
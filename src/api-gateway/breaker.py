@@ -0,0 +1,265 @@
+"""Per-instance circuit breakers and active health checks.
+
+Each upstream instance keeps the outcome of its last GATEWAY_BREAKER_WINDOW
+calls. A call fails if it raised, answered 5xx or took longer than
+GATEWAY_BREAKER_SLOW_SECONDS to produce its headers. Once at least
+GATEWAY_BREAKER_MIN_CALLS are recorded and the failure share reaches
+GATEWAY_BREAKER_FAILURE_RATE, the circuit opens: the instance is ejected and
+requests go to the service's other instances, or are refused on the spot
+(503, ``Retry-After``) when none is left, instead of waiting out the
+upstream timeout, so a dead backend can't tie up gateway workers.
+
+After GATEWAY_BREAKER_OPEN_SECONDS the circuit goes half-open and lets
+GATEWAY_BREAKER_HALF_OPEN_CALLS real requests through; if they all succeed
+it closes, a single failure opens it again.
+
+A health checker polls every instance's ``/health`` (at the root of its URL)
+every GATEWAY_HEALTH_INTERVAL seconds. GATEWAY_HEALTH_FAILURES failed checks
+in a row open the circuit even without traffic, and it stays open until a
+check passes again, at which point it goes half-open straight away.
+
+Tuning (all optional):
+    GATEWAY_BREAKER_ENABLED          "false" turns breakers off (default true)
+    GATEWAY_BREAKER_WINDOW           recent calls considered (default 20)
+    GATEWAY_BREAKER_MIN_CALLS        calls needed before the circuit may open (default 10)
+    GATEWAY_BREAKER_FAILURE_RATE     failure share that opens the circuit (default 0.5)
+    GATEWAY_BREAKER_SLOW_SECONDS     slower calls count as failures (default 2)
+    GATEWAY_BREAKER_OPEN_SECONDS     seconds before an open circuit is retried (default 10)
+    GATEWAY_BREAKER_HALF_OPEN_CALLS  trial requests let through when half-open (default 3)
+    GATEWAY_HEALTH_INTERVAL          seconds between health checks, 0 disables them (default 5)
+    GATEWAY_HEALTH_TIMEOUT           seconds a health check may take (default 1)
+    GATEWAY_HEALTH_FAILURES          failed checks in a row that open the circuit (default 2)
+    GATEWAY_HEALTH_PATH              health endpoint on each service (default /health)
+"""
+import logging
+import os
+import threading
+import time
+from collections import deque
+from urllib.parse import urljoin
+
+from common.latency import LatencyWindow
+
+log = logging.getLogger('gateway')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# allow() tickets; a probe is a trial call made while half-open
+CALL = 'call'
+PROBE = 'probe'
+
+
+class CircuitOpen(Exception):
+    """The upstream's circuit is open; the request was not sent."""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"Circuit for {name} is open")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Closed/open/half-open state machine for one upstream."""
+
+    def __init__(self, name, window=20, min_calls=10, failure_rate=0.5, slow_seconds=2.0,
+                 open_seconds=10.0, half_open_calls=3, health_failures=2, enabled=True):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_seconds = slow_seconds
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.health_failures = health_failures
+        self.enabled = enabled
+
+        self.latency = LatencyWindow()
+        self._outcomes = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+        self._probe_successes = 0
+        self._health_failed = 0
+        self._last_health = None
+        self._stats = {'opened': 0, 'rejected': 0, 'failures': 0, 'slow_calls': 0}
+
+    def _open_wait(self):
+        """Seconds until an open circuit lets trial calls through, or ``None`` if they may go now."""
+        wait = self._opened_at + self.open_seconds - time.monotonic()
+        # While health checks fail, only a passing check reopens the door
+        if wait > 0 or self._health_failed >= self.health_failures:
+            return max(1, int(wait + 0.999))
+        return None
+
+    def available(self):
+        """Whether ``allow()`` would let a call through right now (without claiming a trial slot)."""
+        if not self.enabled:
+            return True
+        with self._lock:
+            if self._state == OPEN:
+                return self._open_wait() is None
+            return self._state == CLOSED or self._probes < self.half_open_calls
+
+    def retry_after(self):
+        """Seconds a refused client should wait before retrying."""
+        with self._lock:
+            return (self._open_wait() or 1) if self._state == OPEN else 1
+
+    def allow(self):
+        """A ticket to pass to ``record()``, or ``CircuitOpen`` when the call must not be made."""
+        if not self.enabled:
+            return CALL
+        with self._lock:
+            if self._state == CLOSED:
+                return CALL
+            if self._state == OPEN:
+                wait = self._open_wait()
+                if wait is not None:
+                    self._stats['rejected'] += 1
+                    raise CircuitOpen(self.name, wait)
+                self._half_open()
+            if self._probes >= self.half_open_calls:
+                self._stats['rejected'] += 1
+                raise CircuitOpen(self.name, 1)
+            self._probes += 1
+            return PROBE
+
+    def record(self, ticket, ok, seconds):
+        """Report the outcome of a call made with ``ticket`` from ``allow()``."""
+        self.latency.add(seconds)
+        if not self.enabled:
+            return
+        slow = seconds > self.slow_seconds
+        failed = not ok or slow
+        with self._lock:
+            if slow:
+                self._stats['slow_calls'] += 1
+            if failed:
+                self._stats['failures'] += 1
+            if ticket == PROBE:
+                if self._state != HALF_OPEN:
+                    return
+                if failed:
+                    self._open(time.monotonic())
+                    return
+                self._probe_successes += 1
+                if self._probe_successes >= self.half_open_calls:
+                    self._state = CLOSED
+                    self._outcomes.clear()
+                return
+            if self._state != CLOSED:
+                return
+            self._outcomes.append(failed)
+            if len(self._outcomes) >= self.min_calls and \
+                    sum(self._outcomes) >= self.failure_rate * len(self._outcomes):
+                self._open(time.monotonic())
+
+    def discard(self, ticket):
+        """Give back a ticket whose call was abandoned before it had an outcome."""
+        if ticket != PROBE:
+            return
+        with self._lock:
+            if self._state == HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+    def record_health(self, ok, seconds):
+        """Report an active health check."""
+        with self._lock:
+            self._last_health = {'ok': ok, 'latency_ms': round(seconds * 1000, 1), 'checked_at': time.time()}
+            if ok:
+                # A circuit the health checks opened (or held open) is retried at once
+                held_by_health = self._health_failed >= self.health_failures
+                self._health_failed = 0
+                if self.enabled and self._state == OPEN and held_by_health:
+                    self._half_open()
+                return
+            self._health_failed += 1
+            if self.enabled and self._health_failed >= self.health_failures and self._state != OPEN:
+                self._open(time.monotonic())
+
+    def _open(self, now):
+        self._state = OPEN
+        self._opened_at = now
+        self._stats['opened'] += 1
+        log.warning("Circuit for %s opened", self.name)
+
+    def _half_open(self):
+        self._state = HALF_OPEN
+        self._probes = 0
+        self._probe_successes = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            outcomes = list(self._outcomes)
+            stats.update({
+                'state': self._state if self.enabled else 'disabled',
+                'recent_calls': len(outcomes),
+                'recent_failure_rate': round(sum(outcomes) / len(outcomes), 3) if outcomes else 0,
+                'health': self._last_health
+            })
+        stats['latency'] = self.latency.summary()
+        return stats
+
+
+def health_url(base_url):
+    """The service's health endpoint: GATEWAY_HEALTH_PATH at the root of its URL."""
+    return urljoin(base_url, os.getenv('GATEWAY_HEALTH_PATH', '/health'))
+
+
+class HealthChecker:
+    """Background thread polling each upstream instance's health endpoint (Flask engine).
+
+    ``instances`` is called before every pass, so instances added at runtime are checked too.
+    """
+
+    def __init__(self, instances, interval=5.0, timeout=1.0):
+        self.instances = instances
+        self.interval = interval
+        self.timeout = timeout
+        self._thread = None
+
+    def start(self):
+        if self._thread is None and self.interval > 0:
+            self._thread = threading.Thread(target=self._run, name='health-checker', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            for instance in self.instances():
+                self.check(instance)
+            time.sleep(self.interval)
+
+    def check(self, instance):
+        started = time.perf_counter()
+        try:
+            # Straight on the session: health checks must get through an open circuit
+            resp = instance.session.get(health_url(instance.base_url), timeout=self.timeout)
+            ok = resp.status_code == 200
+        except Exception:
+            ok = False
+        instance.breaker.record_health(ok, time.perf_counter() - started)
+
+
+def breaker_from_env(name):
+    return CircuitBreaker(
+        name,
+        window=int(os.getenv('GATEWAY_BREAKER_WINDOW', '20')),
+        min_calls=int(os.getenv('GATEWAY_BREAKER_MIN_CALLS', '10')),
+        failure_rate=float(os.getenv('GATEWAY_BREAKER_FAILURE_RATE', '0.5')),
+        slow_seconds=float(os.getenv('GATEWAY_BREAKER_SLOW_SECONDS', '2')),
+        open_seconds=float(os.getenv('GATEWAY_BREAKER_OPEN_SECONDS', '10')),
+        half_open_calls=int(os.getenv('GATEWAY_BREAKER_HALF_OPEN_CALLS', '3')),
+        health_failures=int(os.getenv('GATEWAY_HEALTH_FAILURES', '2')),
+        enabled=os.getenv('GATEWAY_BREAKER_ENABLED', 'true').lower() == 'true'
+    )
+
+
+def health_settings_from_env():
+    return float(os.getenv('GATEWAY_HEALTH_INTERVAL', '5')), float(os.getenv('GATEWAY_HEALTH_TIMEOUT', '1'))
@@ -0,0 +1,251 @@
+"""In-memory TTL/LRU cache for proxied GET responses.
+
+Only routes with a TTL are cached. A route covers the paths under it, and
+a ``<id>`` segment matches any numeric one; the most specific route wins, so
+``payment/payments/<id>=0`` keeps single payments (polled for their status
+after a 202) out of the cache while the ``payment/payments`` list stays in
+it. Entries are keyed on service, path, query
+string and the request headers in ``GATEWAY_CACHE_VARY``, carry a strong
+ETag, and are evicted least-recently-used once ``GATEWAY_CACHE_MAX_BYTES`` is
+reached. Any write (POST/PUT/DELETE) to a service drops that service's
+entries.
+
+Tuning (all optional):
+    GATEWAY_CACHE_ENABLED          turn the cache off with "false" (default true)
+    GATEWAY_CACHE_TTLS             per-route TTLs, e.g. "survey/surveys=30,payment/payments=5" (0 = never)
+    GATEWAY_CACHE_MAX_BYTES        memory budget for all entries (default 64 MiB)
+    GATEWAY_CACHE_MAX_ENTRY_BYTES  larger responses are streamed, not cached (default 1 MiB)
+    GATEWAY_CACHE_VARY             request headers that are part of the key
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Read-heavy routes polled by the dashboard, as "<service>/<subpath prefix>": seconds
+DEFAULT_ROUTE_TTLS = {
+    'auth/users': 10,
+    'user/profiles': 10,
+    'survey/surveys': 30,
+    'survey/stats': 10,
+    'payment/payments': 5,
+    # Status of a single payment: settlement updates it without going
+    # through the gateway, so nothing would invalidate a cached copy
+    'payment/payments/<id>': 0,
+    'payment/stats': 5
+}
+
+ID_SEGMENT = '<id>'
+
+# Per-user or per-format representations must never be shared
+DEFAULT_VARY_HEADERS = 'Accept,Accept-Encoding,Authorization,Cookie'
+
+# Stripped before going upstream so the cache always receives a full body
+CONDITIONAL_HEADERS = {'if-none-match', 'if-modified-since'}
+
+WRITE_METHODS = {'POST', 'PUT', 'PATCH', 'DELETE'}
+
+
+def wants_stream(args, headers):
+    """Full-table NDJSON/JSON dumps (``?stream=``) go straight through, uncached."""
+    return bool(args.get('stream')) or 'application/x-ndjson' in headers.get('Accept', '')
+
+
+def parse_route_ttls(value):
+    """Parse "route=seconds,route=seconds" into a dict."""
+    ttls = {}
+    for item in value.split(','):
+        if '=' in item:
+            route, ttl = item.split('=', 1)
+            ttls[route.strip().strip('/')] = float(ttl)
+    return ttls
+
+
+def route_matches(pattern, route):
+    """Whether ``route`` is ``pattern`` or lies under it; an ``<id>`` segment matches any number."""
+    pattern_parts, route_parts = pattern.split('/'), route.split('/')
+    if len(route_parts) < len(pattern_parts):
+        return False
+    return all(p == r or (p == ID_SEGMENT and r.isdigit()) for p, r in zip(pattern_parts, route_parts))
+
+
+def most_specific_first(patterns):
+    """Deeper routes first; at the same depth literal segments beat ``<id>``."""
+    return sorted(patterns, key=lambda pattern: (pattern.count('/'), -pattern.count(ID_SEGMENT)), reverse=True)
+
+
+def make_etag(body):
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(if_none_match, etag):
+    """Weak comparison as required for If-None-Match (RFC 7232 section 3.2)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    wanted = etag[2:] if etag.startswith('W/') else etag
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == wanted:
+            return True
+    return False
+
+
+def is_storable(status, headers):
+    """Only plain 200s that the upstream didn't mark private or no-store."""
+    if status != 200:
+        return False
+    cache_control = headers.get('Cache-Control', '').lower()
+    return 'no-store' not in cache_control and 'private' not in cache_control
+
+
+class CacheEntry:
+    __slots__ = ('service', 'status', 'headers', 'body', 'etag', 'expires_at', 'size')
+
+    def __init__(self, service, status, headers, body, ttl):
+        self.service = service
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.etag = make_etag(body)
+        self.expires_at = time.monotonic() + ttl
+        self.size = len(body) + sum(len(k) + len(v) for k, v in headers)
+
+
+class ResponseCache:
+    """Thread-safe, memory-bounded LRU of upstream responses."""
+
+    def __init__(self, route_ttls, max_bytes, max_entry_bytes, vary_headers, enabled=True):
+        # Most specific first so "payment/payments/<id>" can override "payment/payments"
+        self.route_ttls = [(route, route_ttls[route]) for route in most_specific_first(route_ttls)]
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.vary_headers = vary_headers
+        self.enabled = enabled
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        # Bumped on every write to a service; a miss that started before the
+        # write must not store what it fetched
+        self._generations = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'invalidations': 0,
+            'not_modified': 0,
+            'too_large': 0
+        }
+
+    def ttl_for(self, service_name, subpath):
+        if not self.enabled:
+            return 0
+        route = f"{service_name}/{subpath}".strip('/')
+        for pattern, ttl in self.route_ttls:
+            if route_matches(pattern, route):
+                return ttl
+        return 0
+
+    def make_key(self, service_name, subpath, query_string, headers):
+        return (service_name, subpath, query_string) + tuple(headers.get(name, '') for name in self.vary_headers)
+
+    def count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            if entry.expires_at <= time.monotonic():
+                self._remove(key)
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return entry
+
+    def generation(self, service_name):
+        with self._lock:
+            return self._generations.get(service_name, 0)
+
+    def put(self, key, service_name, status, headers, body, ttl, generation):
+        """Store a response; returns the entry (also when it was too stale to keep)."""
+        entry = CacheEntry(service_name, status, headers, body, ttl)
+        if entry.size > self.max_entry_bytes:
+            self.count('too_large')
+            return entry
+        with self._lock:
+            if self._generations.get(service_name, 0) != generation:
+                return entry
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._bytes += entry.size
+            self._stats['stores'] += 1
+            while self._bytes > self.max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+                self._stats['evictions'] += 1
+        return entry
+
+    def invalidate_service(self, service_name):
+        with self._lock:
+            self._generations[service_name] = self._generations.get(service_name, 0) + 1
+            keys = [key for key, entry in self._entries.items() if entry.service == service_name]
+            for key in keys:
+                self._remove(key)
+            self._stats['invalidations'] += len(keys)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                'enabled': self.enabled,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes
+            })
+        return stats
+
+
+def response_parts(entry, if_none_match, cache_state):
+    """Status, headers and body to send for a cached entry, honouring If-None-Match."""
+    validators = [
+        ('ETag', entry.etag),
+        # Let browsers keep the body but revalidate every time, so writes
+        # through the gateway are visible immediately
+        ('Cache-Control', 'no-cache'),
+        ('X-Cache', cache_state)
+    ]
+    if etag_matches(if_none_match, entry.etag):
+        return 304, validators, b''
+    headers = [(k, v) for k, v in entry.headers if k.lower() not in ('etag', 'cache-control')]
+    return entry.status, headers + validators, entry.body
+
+
+def cache_from_env():
+    route_ttls = dict(DEFAULT_ROUTE_TTLS)
+    route_ttls.update(parse_route_ttls(os.getenv('GATEWAY_CACHE_TTLS', '')))
+    vary = os.getenv('GATEWAY_CACHE_VARY', DEFAULT_VARY_HEADERS)
+    return ResponseCache(
+        # Zero TTLs stay in: they override broader routes
+        route_ttls=route_ttls,
+        max_bytes=int(os.getenv('GATEWAY_CACHE_MAX_BYTES', str(64 * 1024 * 1024))),
+        max_entry_bytes=int(os.getenv('GATEWAY_CACHE_MAX_ENTRY_BYTES', str(1024 * 1024))),
+        vary_headers=[name.strip() for name in vary.split(',') if name.strip()],
+        enabled=os.getenv('GATEWAY_CACHE_ENABLED', 'true').lower() == 'true'
+    )
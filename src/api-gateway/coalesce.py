@@ -0,0 +1,188 @@
+"""Single-flight coalescing of identical concurrent GETs.
+
+On the routes listed in GATEWAY_COALESCE_ROUTES, a GET that arrives while an
+identical one (same service, path, query string and ``GATEWAY_CACHE_VARY``
+headers) is already upstream doesn't make its own call: it waits for that
+request and gets a copy of its response (``X-Coalesced: true``). Only
+responses that fit in GATEWAY_COALESCE_MAX_BYTES are shared. A request that
+would exceed GATEWAY_COALESCE_MAX_WAITERS, waits longer than
+GATEWAY_COALESCE_TIMEOUT, or whose leader got no shareable response, goes
+upstream itself.
+
+This complements the response cache: the cache absorbs repeats over its
+TTL, coalescing absorbs the burst that arrives before the first response
+(and works on routes that aren't cached at all).
+
+Tuning (all optional):
+    GATEWAY_COALESCE_ROUTES       routes to coalesce, matched as in cache.py; "!" excludes one,
+                                  e.g. "payment/payments,!payment/payments/<id>"
+    GATEWAY_COALESCE_MAX_WAITERS  requests that may wait on one upstream call (default 100)
+    GATEWAY_COALESCE_TIMEOUT      seconds a waiter waits before going upstream itself (default 5)
+    GATEWAY_COALESCE_MAX_BYTES    largest response shared with waiters (default 1 MiB)
+"""
+import asyncio
+import os
+import threading
+
+from cache import DEFAULT_VARY_HEADERS, most_specific_first, route_matches
+
+# The dashboard's list endpoints, but not single payments, whose status is
+# polled and must be fresh; set GATEWAY_COALESCE_ROUTES="" to turn off
+DEFAULT_COALESCE_ROUTES = 'auth/users,user/profiles,survey/surveys,payment/payments,!payment/payments/<id>'
+
+
+class Flight:
+    """One upstream call in progress and the requests waiting for its result."""
+
+    __slots__ = ('done', 'result', 'waiters')
+
+    def __init__(self, done):
+        self.done = done
+        self.result = None
+        self.waiters = 0
+
+
+class BaseCoalescer:
+    """Route matching, keys and counters shared by both gateway engines."""
+
+    def __init__(self, routes, vary_headers, max_waiters=100, timeout=5.0, max_bytes=1024 * 1024):
+        self.routes = routes
+        # pattern -> coalesce?, most specific first
+        self._rules = [(pattern, pattern in routes) for pattern in
+                       most_specific_first({route.lstrip('!') for route in routes})]
+        self.vary_headers = vary_headers
+        self.max_waiters = max_waiters
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self._flights = {}
+        self._stats = {
+            'leaders': 0,
+            'coalesced': 0,
+            'not_shared': 0,
+            'timeouts': 0,
+            'waiter_limit': 0
+        }
+
+    def applies(self, service_name, subpath):
+        route = f"{service_name}/{subpath}".strip('/')
+        for pattern, coalesce in self._rules:
+            if route_matches(pattern, route):
+                return coalesce
+        return False
+
+    def make_key(self, service_name, subpath, query_string, headers):
+        return (service_name, subpath, query_string) + tuple(headers.get(name, '') for name in self.vary_headers)
+
+    def _join(self, key):
+        """``(flight, True)`` for the leader, ``(flight, False)`` for a waiter, ``(None, False)`` when full."""
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = Flight(self._new_event())
+            self._stats['leaders'] += 1
+            return flight, True
+        if flight.waiters >= self.max_waiters:
+            self._stats['waiter_limit'] += 1
+            return None, False
+        flight.waiters += 1
+        return flight, False
+
+    def _finish(self, key, flight, result):
+        """Publish the leader's ``(status, headers, body)`` (or ``None``); later calls are no-ops."""
+        if self._flights.get(key) is not flight:
+            return False
+        del self._flights[key]
+        flight.result = result
+        if result is None and flight.waiters:
+            self._stats['not_shared'] += flight.waiters
+        return True
+
+    def _waited(self, flight, arrived):
+        if not arrived:
+            self._stats['timeouts'] += 1
+            return None
+        if flight.result is not None:
+            self._stats['coalesced'] += 1
+        return flight.result
+
+    def _stats_snapshot(self):
+        stats = dict(self._stats)
+        stats.update({
+            # Every coalesced request is an upstream call that didn't happen
+            'saved_upstream_calls': stats['coalesced'],
+            'in_flight': len(self._flights),
+            'routes': list(self.routes)
+        })
+        return stats
+
+
+class Coalescer(BaseCoalescer):
+    """Thread-based coalescer for the Flask engine."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+
+    def _new_event(self):
+        return threading.Event()
+
+    def join(self, key):
+        with self._lock:
+            return self._join(key)
+
+    def wait(self, flight):
+        """The leader's shared result, or ``None`` to go upstream yourself."""
+        arrived = flight.done.wait(self.timeout)
+        with self._lock:
+            return self._waited(flight, arrived)
+
+    def finish(self, key, flight, result=None):
+        with self._lock:
+            finished = self._finish(key, flight, result)
+        if finished:
+            flight.done.set()
+
+    def stats(self):
+        with self._lock:
+            return self._stats_snapshot()
+
+
+class AsyncCoalescer(BaseCoalescer):
+    """Coalescer for the asyncio engine; everything runs on the event loop, so no locking."""
+
+    def _new_event(self):
+        return asyncio.Event()
+
+    def join(self, key):
+        return self._join(key)
+
+    async def wait(self, flight):
+        try:
+            await asyncio.wait_for(flight.done.wait(), timeout=self.timeout)
+            arrived = True
+        except asyncio.TimeoutError:
+            arrived = False
+        return self._waited(flight, arrived)
+
+    def finish(self, key, flight, result=None):
+        if self._finish(key, flight, result):
+            flight.done.set()
+
+    def stats(self):
+        return self._stats_snapshot()
+
+
+def shared_headers(headers):
+    """Headers for a waiter's copy of the leader's response."""
+    return [(k, v) for k, v in headers if k.lower() != 'content-length'] + [('X-Coalesced', 'true')]
+
+
+def coalescer_from_env(cls=Coalescer):
+    routes = os.getenv('GATEWAY_COALESCE_ROUTES', DEFAULT_COALESCE_ROUTES)
+    vary = os.getenv('GATEWAY_CACHE_VARY', DEFAULT_VARY_HEADERS)
+    return cls(
+        routes=[route.strip().strip('/') for route in routes.split(',') if route.strip().strip('!')],
+        vary_headers=[name.strip() for name in vary.split(',') if name.strip()],
+        max_waiters=int(os.getenv('GATEWAY_COALESCE_MAX_WAITERS', '100')),
+        timeout=float(os.getenv('GATEWAY_COALESCE_TIMEOUT', '5')),
+        max_bytes=int(os.getenv('GATEWAY_COALESCE_MAX_BYTES', str(1024 * 1024)))
+    )
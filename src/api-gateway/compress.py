@@ -0,0 +1,322 @@
+"""Negotiated response compression: gzip, plus brotli and zstd when installed.
+
+A response is compressed when the client's Accept-Encoding allows one of
+GATEWAY_COMPRESSION_ENCODINGS, its content type is in
+GATEWAY_COMPRESSION_TYPES, it isn't already encoded and its body is at
+least GATEWAY_COMPRESSION_MIN_BYTES (streamed bodies of unknown length
+always qualify). Streamed bodies are compressed chunk by chunk, never
+buffered whole; every chunk is flushed so NDJSON dumps keep flowing.
+
+Compressed copies of bodies with a strong ETag (cached GETs, index.html)
+are kept in a small LRU, so repeated hits cost no CPU. brotli and zstd need
+the optional ``brotli`` and ``zstandard`` packages.
+
+Tuning (all optional):
+    GATEWAY_COMPRESSION_ENABLED         "false" turns compression off (default true)
+    GATEWAY_COMPRESSION_ENCODINGS       preference order (default br,zstd,gzip)
+    GATEWAY_COMPRESSION_MIN_BYTES       smaller bodies are sent as is (default 1024)
+    GATEWAY_COMPRESSION_LEVEL           gzip level, 1-9 (default 6)
+    GATEWAY_COMPRESSION_BROTLI_QUALITY  brotli quality, 0-11 (default 4)
+    GATEWAY_COMPRESSION_ZSTD_LEVEL      zstd level (default 3)
+    GATEWAY_COMPRESSION_TYPES           compressible content types; a trailing "/" matches the family
+    GATEWAY_COMPRESSION_CACHE_BYTES     memory for compressed copies (default 16 MiB)
+"""
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULT_TYPES = ('application/json,application/x-ndjson,application/javascript,application/xml,'
+                 'image/svg+xml,text/')
+
+# Statuses whose responses have no body to compress
+BODILESS_STATUSES = {204, 206, 304}
+
+# Levels for bodies compressed once and served many times (static files)
+MAX_LEVELS = {'gzip': 9, 'br': 11, 'zstd': 19}
+
+# Per-route counters stop growing here; later routes are counted under "other"
+MAX_ROUTES = 200
+
+
+class GzipEncoder:
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data, flush=False):
+        out = self._compressor.compress(data)
+        return out + self._compressor.flush(zlib.Z_SYNC_FLUSH) if flush else out
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class BrotliEncoder:
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data, flush=False):
+        out = self._compressor.process(data)
+        return out + self._compressor.flush() if flush else out
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+class ZstdEncoder:
+    def __init__(self, level):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data, flush=False):
+        out = self._compressor.compress(data)
+        return out + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK) if flush else out
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+def parse_accept_encoding(value):
+    """``{coding: q}`` from an Accept-Encoding header."""
+    accepted = {}
+    for item in value.split(','):
+        name, _, params = item.partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            key, _, number = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    q = float(number)
+                except ValueError:
+                    q = 0.0
+        accepted[name] = q
+    return accepted
+
+
+def route_for(path):
+    """Stats bucket for a request path: ``<service>/<first segment>`` for proxied calls."""
+    segments = [segment for segment in path.split('/') if segment]
+    if len(segments) > 1 and segments[0] == 'api':
+        return '/'.join(segments[1:3])
+    return path or '/'
+
+
+def add_vary(value, name='Accept-Encoding'):
+    """A Vary header value that also lists ``name``."""
+    names = [item.strip() for item in (value or '').split(',') if item.strip()]
+    if '*' in names or name.lower() in (item.lower() for item in names):
+        return value
+    return ', '.join(names + [name])
+
+
+def weak_etag(etag):
+    """A compressed body is a different representation, so it only weakly matches the original."""
+    return etag if not etag or etag.startswith('W/') else 'W/' + etag
+
+
+class Compression:
+    """Decides whether and how to compress a response, and keeps per-route counters."""
+
+    def __init__(self, encodings, min_bytes=1024, types=(), levels=None, cache_bytes=16 * 1024 * 1024,
+                 enabled=True):
+        available = {'gzip': True, 'br': brotli is not None, 'zstd': zstandard is not None}
+        self.encodings = [encoding for encoding in encodings if available.get(encoding)]
+        self.min_bytes = min_bytes
+        self.types = types
+        self.levels = levels or {}
+        self.cache_bytes = cache_bytes
+        self.enabled = enabled and bool(self.encodings)
+
+        self._lock = threading.Lock()
+        self._copies = OrderedDict()
+        self._copy_bytes = 0
+        self._routes = {}
+        self._skipped = {'not_accepted': 0, 'too_small': 0, 'encoded': 0, 'type': 0}
+
+    def compressible(self, content_type):
+        content_type = content_type.split(';', 1)[0].strip().lower()
+        return any(content_type.startswith(t) if t.endswith('/') else content_type == t for t in self.types)
+
+    def choose(self, method, accept_encoding, status, content_type, content_encoding, length):
+        """The encoding to apply, or ``None``; ``length`` is ``None`` when unknown (streamed)."""
+        if not self.enabled or method == 'HEAD' or status in BODILESS_STATUSES or status < 200:
+            return None
+        if content_encoding and content_encoding.lower() != 'identity':
+            return self._skip('encoded')
+        if not self.compressible(content_type):
+            return self._skip('type')
+        if length is not None and length < self.min_bytes:
+            return self._skip('too_small')
+        accepted = parse_accept_encoding(accept_encoding or '')
+        best, best_q = None, 0.0
+        for encoding in self.encodings:
+            q = accepted.get(encoding, accepted.get('*', 0.0))
+            # Ties go to the earlier (preferred) encoding
+            if q > best_q:
+                best, best_q = encoding, q
+        return best or self._skip('not_accepted')
+
+    def varies(self, content_type):
+        """Whether the response should carry ``Vary: Accept-Encoding``."""
+        return self.enabled and self.compressible(content_type)
+
+    def _skip(self, reason):
+        with self._lock:
+            self._skipped[reason] += 1
+        return None
+
+    def encoder(self, encoding, level=None):
+        if encoding == 'br':
+            return BrotliEncoder(self.levels.get('br', 4) if level is None else level)
+        if encoding == 'zstd':
+            return ZstdEncoder(self.levels.get('zstd', 3) if level is None else level)
+        return GzipEncoder(self.levels.get('gzip', 6) if level is None else level)
+
+    def compress(self, route, encoding, body, key=None):
+        """Compress a whole body; with a ``key`` (path and strong ETag) the result is reused."""
+        if key is not None:
+            with self._lock:
+                copy = self._copies.get((key, encoding))
+                if copy is not None:
+                    self._copies.move_to_end((key, encoding))
+            if copy is not None:
+                self.record(route, encoding, len(body), len(copy), 0.0, reused=True)
+                return copy
+        started = time.thread_time()
+        encoder = self.encoder(encoding)
+        copy = encoder.compress(body) + encoder.finish()
+        self.record(route, encoding, len(body), len(copy), time.thread_time() - started)
+        if key is not None and len(copy) <= self.cache_bytes // 16:
+            with self._lock:
+                if (key, encoding) not in self._copies:
+                    self._copies[(key, encoding)] = copy
+                    self._copy_bytes += len(copy)
+                while self._copy_bytes > self.cache_bytes:
+                    _, evicted = self._copies.popitem(last=False)
+                    self._copy_bytes -= len(evicted)
+        return copy
+
+    def stream(self, route, encoding):
+        return StreamCompressor(self, route, encoding)
+
+    def record(self, route, encoding, bytes_in, bytes_out, cpu_seconds, reused=False):
+        with self._lock:
+            if route not in self._routes and len(self._routes) >= MAX_ROUTES:
+                route = 'other'
+            stats = self._routes.get(route)
+            if stats is None:
+                stats = self._routes[route] = {'responses': 0, 'reused': 0, 'bytes_in': 0, 'bytes_out': 0,
+                                               'cpu_seconds': 0.0, 'encodings': {}}
+            stats['responses'] += 1
+            stats['reused'] += reused
+            stats['bytes_in'] += bytes_in
+            stats['bytes_out'] += bytes_out
+            stats['cpu_seconds'] += cpu_seconds
+            stats['encodings'][encoding] = stats['encodings'].get(encoding, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            routes = {}
+            for route, stats in self._routes.items():
+                routes[route] = {
+                    'responses': stats['responses'],
+                    'reused': stats['reused'],
+                    'bytes_in': stats['bytes_in'],
+                    'bytes_out': stats['bytes_out'],
+                    'ratio': round(stats['bytes_in'] / stats['bytes_out'], 2) if stats['bytes_out'] else None,
+                    'cpu_ms': round(stats['cpu_seconds'] * 1000, 1),
+                    'encodings': dict(stats['encodings'])
+                }
+            return {
+                'enabled': self.enabled,
+                'encodings': list(self.encodings),
+                'min_bytes': self.min_bytes,
+                'skipped': dict(self._skipped),
+                'cached_copies': len(self._copies),
+                'cached_bytes': self._copy_bytes,
+                'routes': routes
+            }
+
+
+class StreamCompressor:
+    """Compresses a streamed body chunk by chunk and records the totals when it ends."""
+
+    def __init__(self, compression, route, encoding):
+        self._compression = compression
+        self._encoder = compression.encoder(encoding)
+        self.route = route
+        self.encoding = encoding
+        self._in = 0
+        self._out = 0
+        self._cpu = 0.0
+        self._done = False
+
+    def compress(self, chunk):
+        started = time.thread_time()
+        out = self._encoder.compress(chunk, flush=True)
+        self._cpu += time.thread_time() - started
+        self._in += len(chunk)
+        self._out += len(out)
+        return out
+
+    def finish(self):
+        if self._done:
+            return b''
+        self._done = True
+        started = time.thread_time()
+        out = self._encoder.finish()
+        self._cpu += time.thread_time() - started
+        self._out += len(out)
+        self._compression.record(self.route, self.encoding, self._in, self._out, self._cpu)
+        return out
+
+
+class CompressedBody:
+    """WSGI body iterable that compresses another one; ``close()`` is passed through."""
+
+    def __init__(self, body, compressor):
+        self._body = body
+        self._compressor = compressor
+
+    def __iter__(self):
+        for chunk in self._body:
+            if chunk:
+                out = self._compressor.compress(chunk)
+                if out:
+                    yield out
+        yield self._compressor.finish()
+
+    def close(self):
+        close = getattr(self._body, 'close', None)
+        if close is not None:
+            close()
+
+
+def compression_from_env():
+    encodings = os.getenv('GATEWAY_COMPRESSION_ENCODINGS', 'br,zstd,gzip')
+    types = os.getenv('GATEWAY_COMPRESSION_TYPES', DEFAULT_TYPES)
+    return Compression(
+        encodings=[encoding.strip().lower() for encoding in encodings.split(',') if encoding.strip()],
+        min_bytes=int(os.getenv('GATEWAY_COMPRESSION_MIN_BYTES', '1024')),
+        types=tuple(t.strip().lower() for t in types.split(',') if t.strip()),
+        levels={
+            'gzip': int(os.getenv('GATEWAY_COMPRESSION_LEVEL', '6')),
+            'br': int(os.getenv('GATEWAY_COMPRESSION_BROTLI_QUALITY', '4')),
+            'zstd': int(os.getenv('GATEWAY_COMPRESSION_ZSTD_LEVEL', '3'))
+        },
+        cache_bytes=int(os.getenv('GATEWAY_COMPRESSION_CACHE_BYTES', str(16 * 1024 * 1024))),
+        enabled=os.getenv('GATEWAY_COMPRESSION_ENABLED', 'true').lower() == 'true'
+    )
@@ -0,0 +1,122 @@
+"""Helpers for relaying request and response bodies without buffering them.
+
+Tuning (optional):
+    PROXY_CHUNK_SIZE  bytes read/written per chunk while streaming (default 65536)
+"""
+import itertools
+import os
+
+PROXY_CHUNK_SIZE = int(os.getenv('PROXY_CHUNK_SIZE', '65536'))
+
+# Connection-level headers (RFC 7230 section 6.1) that only apply to a single hop
+HOP_BY_HOP_HEADERS = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailer', 'trailers', 'transfer-encoding', 'upgrade'
+}
+
+
+def filter_header_items(headers, exclude=()):
+    """List the ``(name, value)`` pairs that may cross the gateway hop.
+
+    Drops hop-by-hop headers, anything named in Connection, and ``exclude``.
+    Repeated headers such as Set-Cookie are kept as separate pairs.
+    """
+    dropped = HOP_BY_HOP_HEADERS | {name.lower() for name in exclude}
+    for value in headers.get('Connection', '').split(','):
+        if value.strip():
+            dropped.add(value.strip().lower())
+    return [(key, value) for key, value in headers.items() if key.lower() not in dropped]
+
+
+def filter_headers(headers, exclude=()):
+    """Like ``filter_header_items`` but as a dict."""
+    return dict(filter_header_items(headers, exclude))
+
+
+class RequestBodyStream:
+    """File-like view of an inbound body that reports its declared length.
+
+    ``requests`` sends a Content-Length for objects with ``__len__`` and
+    reads them in chunks, so the body is never held in memory whole.
+    """
+
+    def __init__(self, stream, length):
+        self._stream = stream
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        return self._stream.read(PROXY_CHUNK_SIZE if size is None or size < 0 else size)
+
+
+def iter_body(stream):
+    """Yield a body of unknown length chunk by chunk (sent upstream chunked)."""
+    while True:
+        chunk = stream.read(PROXY_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+def request_body(req):
+    """Pick a streaming body for the inbound Flask request, or ``None`` if it has none."""
+    if req.content_length:
+        return RequestBodyStream(req.stream, req.content_length)
+    if 'chunked' in req.headers.get('Transfer-Encoding', '').lower():
+        return iter_body(req.stream)
+    return None
+
+
+def read_up_to(resp, limit):
+    """Read raw upstream chunks until the body ends or passes ``limit`` bytes.
+
+    Returns ``(chunks, rest)`` where ``rest`` is ``None`` if the whole body
+    was read, or else the iterator to continue relaying from.
+    """
+    chunks = []
+    size = 0
+    stream = resp.raw.stream(PROXY_CHUNK_SIZE, decode_content=False)
+    for chunk in stream:
+        chunks.append(chunk)
+        size += len(chunk)
+        if size > limit:
+            return chunks, stream
+    return chunks, None
+
+
+class ResponseRelay:
+    """WSGI body that yields the upstream response as raw chunks.
+
+    The WSGI server calls ``close()`` when it is done with the body (including
+    on client disconnect), which frees the upstream connection and runs
+    ``on_close``.
+    """
+
+    def __init__(self, resp, on_close=None, prefix=(), rest=None):
+        self._resp = resp
+        self._on_close = on_close
+        if rest is None:
+            # decode_content=False keeps bytes identical to what the upstream sent,
+            # so its Content-Length and Content-Encoding stay valid
+            rest = resp.raw.stream(PROXY_CHUNK_SIZE, decode_content=False)
+        # ``prefix``/``rest`` continue a body partly consumed by read_up_to()
+        self._chunks = itertools.chain(prefix, rest)
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._chunks)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._resp.close()
+        finally:
+            if self._on_close is not None:
+                self._on_close()
@@ -0,0 +1,321 @@
+"""Persistent keep-alive connection pools from the gateway to each backend.
+
+One ``requests.Session`` per upstream instance, so proxied calls reuse warm
+TCP connections instead of paying a connect on every gateway hop. A service
+may run several instances; see balancer.py for how one is picked.
+
+Tuning (all optional):
+    UPSTREAM_POOL_SIZE        keep-alive connections kept per instance (default 20)
+    UPSTREAM_MAX_IDLE         drop pooled connections after this many idle seconds (default 60)
+    UPSTREAM_MAX_CONCURRENCY  in-flight requests allowed per instance (default 100)
+    UPSTREAM_QUEUE_TIMEOUT    seconds to wait for a concurrency slot (default 1)
+"""
+import logging
+import os
+import threading
+import time
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from balancer import GATEWAY_RETRIES, RETRY_STATUSES, InstanceSet, instances_file_from_env, parse_instances
+from breaker import CircuitOpen, HealthChecker, breaker_from_env, health_settings_from_env
+from common import tracing
+from common.metrics import REGISTRY
+
+log = logging.getLogger('gateway')
+
+UPSTREAM_POOL_SIZE = int(os.getenv('UPSTREAM_POOL_SIZE', '20'))
+UPSTREAM_MAX_IDLE = float(os.getenv('UPSTREAM_MAX_IDLE', '60'))
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv('UPSTREAM_MAX_CONCURRENCY', '100'))
+UPSTREAM_QUEUE_TIMEOUT = float(os.getenv('UPSTREAM_QUEUE_TIMEOUT', '1'))
+
+# Per attempt, so retries show up as separate observations
+UPSTREAM_SECONDS = REGISTRY.histogram('gateway_upstream_seconds', 'Time from sending a request to an instance until '
+                                      'its response headers arrived', ('service', 'outcome'))
+
+
+def outcome(status):
+    """``2xx``, ``5xx``, ... for upstream metrics."""
+    return f"{status // 100}xx"
+
+
+def trace_call(ctx, span_id, instance, method, url, started, elapsed, status):
+    """Record an upstream attempt as a client span of the request being proxied."""
+    tracing.record(ctx, f"{method} {instance.name}", started, elapsed, kind='CLIENT', span_id=span_id,
+                   tags={'http.url': url, 'http.status_code': status, 'instance': instance.base_url})
+
+
+class UpstreamBusy(Exception):
+    """The upstream already has its maximum number of in-flight requests."""
+
+
+def _counting_pool(pool_cls, on_connect):
+    """Subclass a urllib3 pool class so every TCP connect is reported.
+
+    urllib3 silently reconnects an existing connection object when the
+    backend closed it, so its own per-pool counters overstate reuse.
+    """
+    class CountingConnection(pool_cls.ConnectionCls):
+        def connect(self):
+            super().connect()
+            on_connect()
+
+    return type(pool_cls.__name__, (pool_cls,), {'ConnectionCls': CountingConnection})
+
+
+class Instance:
+    """Connection pool, concurrency limit and circuit breaker for one instance of a service."""
+
+    def __init__(self, name, base_url, weight=1, pool_size=UPSTREAM_POOL_SIZE, max_idle=UPSTREAM_MAX_IDLE,
+                 max_concurrency=UPSTREAM_MAX_CONCURRENCY, queue_timeout=UPSTREAM_QUEUE_TIMEOUT):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.weight = weight
+        self.pool_size = pool_size
+        self.max_idle = max_idle
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        poolmanager = self._adapter.poolmanager
+        poolmanager.pool_classes_by_scheme = {
+            scheme: _counting_pool(pool_cls, self._on_connect)
+            for scheme, pool_cls in poolmanager.pool_classes_by_scheme.items()
+        }
+        self.session = requests.Session()
+        # The session is shared by every client, so never let it keep cookies
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        self.session.mount('http://', self._adapter)
+        self.session.mount('https://', self._adapter)
+
+        self.breaker = breaker_from_env(f"{name} at {self.base_url}")
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._last_used = time.monotonic()
+        self._in_flight = 0
+        self._stats = {
+            'requests': 0,
+            'responses': 0,
+            'rejected': 0,
+            'idle_resets': 0,
+            'new_connections': 0
+        }
+
+    def url_for(self, subpath=""):
+        return f"{self.base_url}/{subpath}" if subpath else self.base_url
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def _on_connect(self):
+        with self._lock:
+            self._stats['new_connections'] += 1
+
+    def _reset_if_idle(self, now):
+        """Drop connections that sat idle long enough for the backend to have closed them."""
+        with self._lock:
+            idle_for = now - self._last_used
+            self._last_used = now
+            if not self.max_idle or idle_for <= self.max_idle:
+                return
+            self._stats['idle_resets'] += 1
+        self._adapter.poolmanager.clear()
+
+    def acquire(self):
+        """Reserve one of the upstream's concurrency slots."""
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            with self._lock:
+                self._stats['rejected'] += 1
+            raise UpstreamBusy(f"Too many in-flight requests to {self.name} at {self.base_url} (limit {self.max_concurrency})")
+        with self._lock:
+            self._in_flight += 1
+            self._stats['requests'] += 1
+
+    def release(self):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def request(self, method, url, stream=False, **kwargs):
+        """Send a request over the pooled session, respecting the concurrency limit and circuit breaker.
+
+        With ``stream=True`` the body is left unread and the concurrency slot
+        stays held: the caller must close the response and call ``release()``.
+        Raises ``CircuitOpen`` without sending anything while the circuit is open.
+        """
+        self.acquire()
+        try:
+            ticket = self.breaker.allow()
+        except CircuitOpen:
+            self.release()
+            raise
+        # Each attempt is its own span, and the instance continues the trace from it
+        ctx = tracing.current()
+        span_id = tracing.new_id()
+        if ctx is not None:
+            kwargs['headers'] = tracing.inject(kwargs.get('headers'), ctx, span_id)
+        wall_started = time.time()
+        started = time.perf_counter()
+        try:
+            self._reset_if_idle(time.monotonic())
+            resp = self.session.request(method, url, stream=stream, **kwargs)
+        except BaseException:
+            elapsed = time.perf_counter() - started
+            self.breaker.record(ticket, False, elapsed)
+            UPSTREAM_SECONDS.observe(elapsed, self.name, 'error')
+            trace_call(ctx, span_id, self, method, url, wall_started, elapsed, 'error')
+            self.release()
+            raise
+        # Time to headers; a streamed body's transfer time isn't the upstream's health
+        elapsed = time.perf_counter() - started
+        self.breaker.record(ticket, resp.status_code < 500, elapsed)
+        UPSTREAM_SECONDS.observe(elapsed, self.name, outcome(resp.status_code))
+        trace_call(ctx, span_id, self, method, url, wall_started, elapsed, resp.status_code)
+        with self._lock:
+            self._stats['responses'] += 1
+        if not stream:
+            self.release()
+        return resp
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = self._in_flight
+        stats.update({
+            'url': self.base_url,
+            'weight': self.weight,
+            'pool_size': self.pool_size,
+            # Every response not preceded by a fresh connect rode a warm one
+            'reused_connections': max(stats['responses'] - stats['new_connections'], 0),
+            'circuit': self.breaker.stats()
+        })
+        return stats
+
+
+class Upstream:
+    """All instances of one backend service."""
+
+    def __init__(self, name, specs, retries=GATEWAY_RETRIES):
+        self.name = name
+        self.retries = retries
+        self.instances = InstanceSet(name, specs, lambda url, weight: Instance(name, url, weight))
+        self._lock = threading.Lock()
+        self._stats = {'retries': 0}
+
+    def request(self, method, subpath="", stream=False, retry=False, tried=None, **kwargs):
+        """Send a request to the best instance; returns ``(resp, instance)``.
+
+        With ``stream=True`` the body is left unread and the instance's
+        concurrency slot stays held: the caller must close the response and
+        call ``instance.release()``. With ``retry=True`` (idempotent requests
+        with a replayable body) failures and RETRY_STATUSES answers are sent
+        again to another instance. Instances tried are appended to ``tried``.
+        """
+        tried = [] if tried is None else tried
+        sent = 0
+        failure = previous = None
+        while True:
+            try:
+                instance = self.instances.choose(tried)
+            except CircuitOpen:
+                if failure is None and previous is None:
+                    raise
+                instance = None
+            if instance is None:
+                if previous is not None:
+                    return previous
+                if failure is not None:
+                    raise failure
+                raise UpstreamBusy(f"No instances of {self.name} are accepting requests")
+            if previous is not None:
+                resp, previous_instance = previous
+                resp.close()
+                if stream:
+                    previous_instance.release()
+                previous = None
+            tried.append(instance)
+            if sent:
+                with self._lock:
+                    self._stats['retries'] += 1
+            try:
+                resp = instance.request(method, instance.url_for(subpath), stream=stream, **kwargs)
+            except (CircuitOpen, UpstreamBusy) as e:
+                # Nothing was sent, so any request may move on to another instance
+                failure = e
+                continue
+            except requests.exceptions.RequestException as e:
+                sent += 1
+                if not retry or sent > self.retries:
+                    raise
+                log.warning("Retrying %s %s/%s: %s", method, self.name, subpath, e)
+                failure = e
+                continue
+            sent += 1
+            if retry and sent <= self.retries and resp.status_code in RETRY_STATUSES:
+                previous = (resp, instance)
+                continue
+            return resp, instance
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update({
+            'policy': self.instances.policy,
+            'instances': [instance.stats() for instance in self.instances.instances]
+        })
+        return stats
+
+
+class UpstreamRegistry:
+    """All upstream services, keyed by name.
+
+    ``service_urls`` maps each service to its instance list (see balancer.py).
+    """
+
+    def __init__(self, service_urls):
+        self.upstreams = {name: Upstream(name, parse_instances(urls)) for name, urls in service_urls.items()}
+        self.instances_file, self.reload_interval = instances_file_from_env()
+
+    def get(self, name):
+        return self.upstreams.get(name)
+
+    def start_health_checks(self):
+        interval, timeout = health_settings_from_env()
+        HealthChecker(self.all_instances, interval=interval, timeout=timeout).start()
+
+    def all_instances(self):
+        return [instance for upstream in list(self.upstreams.values())
+                for instance in upstream.instances.all_instances()]
+
+    def reload(self):
+        """Apply GATEWAY_INSTANCES_FILE if it changed, and close instances that finished draining."""
+        specs = self.instances_file.poll() if self.instances_file else None
+        for name, instances in (specs or {}).items():
+            if name in self.upstreams:
+                self.upstreams[name].instances.update(instances)
+            else:
+                self.upstreams[name] = Upstream(name, instances)
+        for upstream in list(self.upstreams.values()):
+            for instance in upstream.instances.drained():
+                instance.session.close()
+
+    def start_reloading(self):
+        if self.instances_file is None:
+            return
+        self.reload()
+
+        def run():
+            while True:
+                time.sleep(self.reload_interval)
+                try:
+                    self.reload()
+                except Exception as e:
+                    log.error("Instance reload failed: %s", e)
+
+        threading.Thread(target=run, name='instance-reloader', daemon=True).start()
+
+    def stats(self):
+        return {name: upstream.stats() for name, upstream in list(self.upstreams.items())}
@@ -2,36 +2,74 @@ from flask import Flask, jsonify, request
 from flask_cors import CORS
 import mysql.connector
 import os
+import sys
 from datetime import datetime, timedelta
 import secrets
 from dotenv import load_dotenv
 
+# Load .env from project root (two levels up from src/auth-service/) before
+# importing the modules below, which read their settings at import time
+load_dotenv(os.path.join(os.path.dirname(__file__), '..', '..', '.env'))
+
+# Shared modules live in src/common/ (one level up from src/auth-service/)
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from common.db import db_cursor, pool_stats
+from common.metrics import instrument_flask
+from common.tracing import trace_flask
+from common.logs import log_flask
+from common.pagination import KeysetQuery, PageArgumentError
+from common.row_stream import stream_format, stream_rows
+from common.signed_tokens import (RevocationList, SignedTokenVerifier, TokenCodec, claims_expires_at,
+                                  claims_user, is_signed_token, keys_from_env)
+from token_cache import MISS, token_cache_from_env
+from sessions import session_maintenance_from_env, table_metrics
+
 app = Flask(__name__)
 CORS(app)
+# Per-route request and DB metrics on /metrics (see common/metrics.py)
+instrument_flask(app)
+# Request IDs and timing spans for sampled requests (see common/tracing.py)
+trace_flask(app, 'auth-service')
+# One JSON log line per request, written by a background thread (see common/logs.py)
+log_flask(app, 'auth-service')
 
-# Load .env from project root (two levels up from src/auth-service/)
-load_dotenv(os.path.join(os.path.dirname(__file__), '..', '..', '.env'))
+# password_hash is never listed
+USERS = KeysetQuery('auth_users', ['id', 'username', 'email', 'created_at'], order=[('id', 'ASC')])
 
-def get_db_connection():
-    db_host = os.getenv('DB_HOST')
-    db_port = os.getenv('DB_PORT')
-    db_user = os.getenv('DB_USER')
-    db_password = os.getenv('DB_PASSWORD')
-    db_name = os.getenv('DB_NAME')
-    
-    # Check if required variables exist (password can be empty string)
-    if not db_host or not db_port or not db_user or db_password is None or not db_name:
-        raise ValueError("Missing required database environment variables: DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME")
-    
-    return mysql.connector.connect(
-        host=db_host,
-        port=int(db_port),
-        user=db_user,
-        password=db_password,
-        database=db_name,
-        connection_timeout=5,
-        autocommit=False
-    )
+# Expired-session sweeper and optional per-user session cap (see sessions.py)
+SESSIONS = session_maintenance_from_env()
+SESSIONS.start()
+
+# 'opaque' (random token stored in auth_sessions, default) or 'signed'
+# (stateless HMAC token, see common/signed_tokens.py)
+TOKEN_MODE = os.getenv('AUTH_TOKEN_MODE', 'opaque').lower()
+TOKEN_KEYS = keys_from_env()
+if TOKEN_MODE not in ('opaque', 'signed'):
+    raise ValueError(f"Unknown AUTH_TOKEN_MODE '{TOKEN_MODE}' (expected 'opaque' or 'signed')")
+if TOKEN_MODE == 'signed' and not TOKEN_KEYS:
+    raise ValueError("AUTH_TOKEN_MODE=signed requires AUTH_TOKEN_KEYS")
+
+
+def load_revocations():
+    with db_cursor() as (conn, cursor):
+        cursor.execute("SELECT jti, UNIX_TIMESTAMP(expires_at) FROM auth_revoked_tokens WHERE expires_at > NOW()")
+        return [(jti, float(exp)) for jti, exp in cursor.fetchall()]
+
+
+# Signed tokens stay verifiable whenever keys are configured, so switching
+# back to opaque mode doesn't log everyone out
+# Refreshed on a background thread, so verifying never waits for the loader.
+# Holds revoked signed-token ids and logged-out session tokens' hashes
+REVOCATIONS = RevocationList(load_revocations, refresh_interval=float(os.getenv('AUTH_REVOCATION_REFRESH', '5')))
+REVOCATIONS.start()
+
+TOKEN_VERIFIER = None
+if TOKEN_KEYS:
+    TOKEN_VERIFIER = SignedTokenVerifier(TokenCodec(TOKEN_KEYS, ttl=24 * 3600), REVOCATIONS)
+
+# Resolved tokens, so hot tokens skip the session JOIN; a logout on any
+# replica reaches it through REVOCATIONS (see token_cache.py)
+TOKEN_CACHE = token_cache_from_env(REVOCATIONS)
 
 @app.route('/')
 def home():
@@ -39,29 +77,37 @@ def home():
         'service': 'auth-service',
         'status': 'running',
         'timestamp': datetime.now().isoformat(),
-        'endpoints': ['/health', '/users', '/api/auth/login', '/api/auth/register', '/api/auth/users']
+        'endpoints': ['/health', '/metrics', '/users', '/api/auth/login', '/api/auth/logout', '/api/auth/register', '/api/auth/verify', '/api/auth/revoked', '/api/auth/users', '/api/auth/sessions/maintenance']
     })
 
 @app.route('/users', methods=['GET'])
 def get_users_simple():
     """Simple endpoint for dashboard"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT id, username, email, created_at FROM auth_users")
-        users = cursor.fetchall()
-        return jsonify({'users': users}), 200
+        page = USERS.page(request.args)
+        fmt = stream_format(request)
+    except PageArgumentError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    try:
+        if fmt:
+            return stream_rows(page, 'users', fmt)
+        with db_cursor(dictionary=True) as (conn, cursor):
+            users, next_cursor = page.fetch(cursor)
+            return jsonify({'users': users, 'next_cursor': next_cursor}), 200
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
-    finally:
-        if 'cursor' in locals():
-            cursor.close()
-        if 'conn' in locals():
-            conn.close()
 
 @app.route('/health', methods=['GET'])
 def health():
-    return jsonify({'status': 'healthy', 'service': 'auth-service'}), 200
+    return jsonify({
+        'status': 'healthy',
+        'service': 'auth-service',
+        'db_pool': pool_stats(),
+        'token_mode': TOKEN_MODE,
+        'token_cache': TOKEN_CACHE.stats(),
+        'revocations': REVOCATIONS.stats(),
+        'sessions': SESSIONS.stats()
+    }), 200
 
 @app.route('/api/auth/login', methods=['POST'])
 def login():
@@ -70,36 +116,35 @@ def login():
     password = data.get('password')
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM auth_users WHERE username = %s", (username,))
-        user = cursor.fetchone()
-        
-        if user:
-            token = secrets.token_urlsafe(32)
-            expires_at = datetime.now() + timedelta(hours=24)
+        with db_cursor(dictionary=True) as (conn, cursor):
+            cursor.execute("SELECT * FROM auth_users WHERE username = %s", (username,))
+            user = cursor.fetchone()
             
-            cursor.execute(
-                "INSERT INTO auth_sessions (user_id, token, expires_at) VALUES (%s, %s, %s)",
-                (user['id'], token, expires_at)
-            )
-            conn.commit()
-            
-            return jsonify({
-                'success': True,
-                'message': 'Login successful',
-                'token': token,
-                'user': {'id': user['id'], 'username': user['username'], 'email': user['email']}
-            }), 200
-        else:
-            return jsonify({'success': False, 'message': 'Invalid credentials'}), 401
+            if user:
+                if TOKEN_MODE == 'signed':
+                    # Nothing to store: the token itself carries the session
+                    token, _ = TOKEN_VERIFIER.codec.issue(user['id'], user['username'], user['email'])
+                else:
+                    token = secrets.token_urlsafe(32)
+                    expires_at = datetime.now() + timedelta(hours=24)
+                    
+                    cursor.execute(
+                        "INSERT INTO auth_sessions (user_id, token, expires_at) VALUES (%s, %s, %s)",
+                        (user['id'], token, expires_at)
+                    )
+                    TOKEN_CACHE.revoke(cursor, SESSIONS.enforce_cap(cursor, user['id']))
+                    conn.commit()
+                
+                return jsonify({
+                    'success': True,
+                    'message': 'Login successful',
+                    'token': token,
+                    'user': {'id': user['id'], 'username': user['username'], 'email': user['email']}
+                }), 200
+            else:
+                return jsonify({'success': False, 'message': 'Invalid credentials'}), 401
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
-    finally:
-        if 'cursor' in locals():
-            cursor.close()
-        if 'conn' in locals():
-            conn.close()
 
 @app.route('/api/auth/register', methods=['POST'])
 def register():
@@ -109,73 +154,136 @@ def register():
     password = data.get('password')
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO auth_users (username, email, password_hash) VALUES (%s, %s, %s)",
-            (username, email, f"hashed_{password}")
-        )
-        conn.commit()
-        
-        return jsonify({
-            'success': True,
-            'message': 'Registration successful',
-            'username': username
-        }), 201
+        with db_cursor() as (conn, cursor):
+            cursor.execute(
+                "INSERT INTO auth_users (username, email, password_hash) VALUES (%s, %s, %s)",
+                (username, email, f"hashed_{password}")
+            )
+            conn.commit()
+            
+            return jsonify({
+                'success': True,
+                'message': 'Registration successful',
+                'username': username
+            }), 201
     except mysql.connector.IntegrityError:
         return jsonify({'success': False, 'message': 'Username or email already exists'}), 400
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
-    finally:
-        if 'cursor' in locals():
-            cursor.close()
-        if 'conn' in locals():
-            conn.close()
 
-@app.route('/api/auth/verify', methods=['POST'])
-def verify_token():
+@app.route('/api/auth/logout', methods=['POST'])
+def logout():
     data = request.json
     token = data.get('token')
     
+    if is_signed_token(token) and TOKEN_VERIFIER is not None:
+        return revoke_signed_token(token)
+    
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute(
-            "SELECT s.*, u.username, u.email FROM auth_sessions s JOIN auth_users u ON s.user_id = u.id WHERE s.token = %s AND s.expires_at > NOW()",
-            (token,)
-        )
-        session = cursor.fetchone()
+        with db_cursor() as (conn, cursor):
+            cursor.execute("DELETE FROM auth_sessions WHERE token = %s", (token,))
+            revoked = cursor.rowcount > 0
+            if revoked:
+                # Other replicas drop it within AUTH_REVOCATION_REFRESH
+                TOKEN_CACHE.revoke(cursor, [token])
+            conn.commit()
         
-        if session:
-            return jsonify({
-                'valid': True,
-                'user': {'id': session['user_id'], 'username': session['username'], 'email': session['email']}
-            }), 200
+        if revoked:
+            return jsonify({'success': True, 'message': 'Logout successful'}), 200
         else:
-            return jsonify({'valid': False, 'message': 'Invalid or expired token'}), 401
+            return jsonify({'success': False, 'message': 'Invalid or expired token'}), 404
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+def revoke_signed_token(token):
+    claims = TOKEN_VERIFIER.codec.decode(token)
+    if claims is None:
+        return jsonify({'success': False, 'message': 'Invalid or expired token'}), 404
+    
+    try:
+        with db_cursor() as (conn, cursor):
+            cursor.execute(
+                "INSERT INTO auth_revoked_tokens (jti, expires_at) VALUES (%s, %s) ON DUPLICATE KEY UPDATE jti = jti",
+                (claims['jti'], claims_expires_at(claims))
+            )
+            conn.commit()
+        # Other auth replicas and the gateway pick it up on their next refresh
+        TOKEN_VERIFIER.revocations.revoke(claims['jti'], claims['exp'])
+        return jsonify({'success': True, 'message': 'Logout successful'}), 200
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/auth/revoked', methods=['GET'])
+def get_revoked_tokens():
+    """Unexpired revoked signed-token ids, polled by the API gateway"""
+    try:
+        return jsonify({'revoked': [{'jti': jti, 'exp': exp} for jti, exp in load_revocations()]}), 200
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/auth/verify', methods=['POST'])
+def verify_token():
+    data = request.json
+    token = data.get('token')
+    
+    if is_signed_token(token) and TOKEN_VERIFIER is not None:
+        # Pure CPU: signature, expiry and revocation list, no session lookup
+        claims = TOKEN_VERIFIER.verify(token)
+        if claims is not None:
+            return jsonify({'valid': True, 'user': claims_user(claims)}), 200
+        return jsonify({'valid': False, 'message': 'Invalid or expired token'}), 401
+    
+    user = TOKEN_CACHE.get(token)
+    if user is not MISS:
+        if user is not None:
+            return jsonify({'valid': True, 'user': user}), 200
+        return jsonify({'valid': False, 'message': 'Invalid or expired token'}), 401
+    
+    try:
+        with db_cursor(dictionary=True) as (conn, cursor):
+            cursor.execute(
+                "SELECT s.*, u.username, u.email FROM auth_sessions s JOIN auth_users u ON s.user_id = u.id WHERE s.token = %s AND s.expires_at > NOW()",
+                (token,)
+            )
+            session = cursor.fetchone()
+            
+            if session:
+                user = {'id': session['user_id'], 'username': session['username'], 'email': session['email']}
+                TOKEN_CACHE.put(token, user, session['expires_at'])
+                return jsonify({'valid': True, 'user': user}), 200
+            else:
+                TOKEN_CACHE.put_invalid(token)
+                return jsonify({'valid': False, 'message': 'Invalid or expired token'}), 401
     except Exception as e:
         return jsonify({'valid': False, 'error': str(e)}), 500
-    finally:
-        if 'cursor' in locals():
-            cursor.close()
-        if 'conn' in locals():
-            conn.close()
+
+@app.route('/api/auth/sessions/maintenance', methods=['GET'])
+def get_session_maintenance():
+    """Sweeper counters plus current auth_sessions size"""
+    try:
+        with db_cursor() as (conn, cursor):
+            table = table_metrics(cursor)
+        stats = SESSIONS.stats()
+        stats['table'] = table
+        return jsonify({'success': True, 'sessions': stats}), 200
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/auth/users', methods=['GET'])
 def get_users():
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT id, username, email, created_at FROM auth_users")
-        users = cursor.fetchall()
-        return jsonify({'users': users}), 200
+        page = USERS.page(request.args)
+        fmt = stream_format(request)
+    except PageArgumentError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        if fmt:
+            return stream_rows(page, 'users', fmt)
+        with db_cursor(dictionary=True) as (conn, cursor):
+            users, next_cursor = page.fetch(cursor)
+            return jsonify({'users': users, 'next_cursor': next_cursor}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
-    finally:
-        if 'cursor' in locals():
-            cursor.close()
-        if 'conn' in locals():
-            conn.close()
 
 if __name__ == '__main__':
     host = os.getenv('AUTH_SERVICE_HOST', '0.0.0.0')
@@ -0,0 +1,183 @@
+"""Session table maintenance: expiry sweeping and per-user session caps.
+
+Expired ``auth_sessions`` rows (and expired ``auth_revoked_tokens``) are
+deleted by a background thread every SESSION_SWEEP_INTERVAL seconds, in
+batches of SESSION_SWEEP_BATCH_SIZE rows taken in ``expires_at`` order
+(INDEX idx_expires_at) with a short pause between batches, so no single
+DELETE holds locks for long. A MySQL named lock makes sure only one auth
+replica sweeps at a time; the others skip that pass.
+
+With AUTH_MAX_SESSIONS_PER_USER set, logging in evicts the user's oldest
+sessions beyond the cap in the same transaction as the new session.
+
+Tuning (all optional):
+    SESSION_SWEEP_INTERVAL     seconds between sweeps, 0 disables the sweeper (default 60)
+    SESSION_SWEEP_BATCH_SIZE   rows deleted per statement (default 500)
+    SESSION_SWEEP_PAUSE        seconds to pause between batches (default 0.05)
+    AUTH_MAX_SESSIONS_PER_USER active sessions kept per user, 0 for no cap (default 0)
+"""
+import logging
+import os
+import threading
+import time
+
+from common.db import db_cursor, placeholders
+
+log = logging.getLogger(__name__)
+
+SWEEP_LOCK = 'auth_session_sweep'
+
+# Tables with expiring rows and an index on expires_at
+SWEPT_TABLES = ('auth_sessions', 'auth_revoked_tokens')
+
+
+class SessionMaintenance:
+    """Background expiry sweeper plus the per-user session cap."""
+
+    def __init__(self, interval=60.0, batch_size=500, pause=0.05, max_per_user=0):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.max_per_user = max_per_user
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {
+            'passes': 0,
+            'skipped_passes': 0,
+            'batches': 0,
+            'deleted': {table: 0 for table in SWEPT_TABLES},
+            'evicted_by_cap': 0,
+            'errors': 0
+        }
+        self._last_pass = None
+        self._table = None
+
+    def start(self):
+        if self._thread is None and self.interval > 0:
+            self._thread = threading.Thread(target=self._run, name='session-sweeper', daemon=True)
+            self._thread.start()
+            log.info("Session sweeper started (every %gs, batches of %d)", self.interval, self.batch_size)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                with self._lock:
+                    self._stats['errors'] += 1
+                log.error("Session sweep failed: %s", e)
+
+    def sweep(self):
+        """Delete every expired row in small batches; returns rows deleted, or ``None`` if another replica is sweeping."""
+        started = time.perf_counter()
+        deleted = {}
+        with db_cursor() as (conn, cursor):
+            cursor.execute("SELECT GET_LOCK(%s, 0)", (SWEEP_LOCK,))
+            if not cursor.fetchone()[0]:
+                with self._lock:
+                    self._stats['skipped_passes'] += 1
+                return None
+            try:
+                for table in SWEPT_TABLES:
+                    deleted[table] = self._sweep_table(conn, cursor, table)
+                table = table_metrics(cursor)
+            finally:
+                cursor.execute("SELECT RELEASE_LOCK(%s)", (SWEEP_LOCK,))
+                cursor.fetchone()
+
+        seconds = time.perf_counter() - started
+        total = sum(deleted.values())
+        with self._lock:
+            self._stats['passes'] += 1
+            for name, count in deleted.items():
+                self._stats['deleted'][name] += count
+            self._last_pass = {
+                'finished_at': time.time(),
+                'seconds': round(seconds, 3),
+                'deleted': deleted,
+                'rows_per_second': round(total / seconds, 1) if seconds else 0
+            }
+            self._table = table
+        if total:
+            log.info("Swept %d expired rows in %.2fs", total, seconds)
+        return total
+
+    def _sweep_table(self, conn, cursor, table):
+        deleted = 0
+        while True:
+            cursor.execute(f"DELETE FROM {table} WHERE expires_at < NOW() ORDER BY expires_at LIMIT %s",
+                           (self.batch_size,))
+            count = cursor.rowcount
+            conn.commit()
+            deleted += count
+            with self._lock:
+                self._stats['batches'] += 1
+            if count < self.batch_size:
+                return deleted
+            time.sleep(self.pause)
+
+    def enforce_cap(self, cursor, user_id):
+        """Delete ``user_id``'s oldest sessions beyond the cap; returns their tokens.
+
+        Run it on the login's dictionary cursor, after inserting the new session.
+        """
+        if self.max_per_user <= 0:
+            return []
+        # Serialises concurrent logins of the same user; the locking read
+        # below then sees sessions the other login committed
+        cursor.execute("SELECT id FROM auth_users WHERE id = %s FOR UPDATE", (user_id,))
+        cursor.fetchall()
+        cursor.execute(
+            """SELECT id, token FROM auth_sessions WHERE user_id = %s
+               ORDER BY id DESC LIMIT 18446744073709551615 OFFSET %s FOR UPDATE""",
+            (user_id, self.max_per_user)
+        )
+        rows = cursor.fetchall()
+        if not rows:
+            return []
+        ids = [row['id'] for row in rows]
+        cursor.execute(f"DELETE FROM auth_sessions WHERE id IN ({placeholders(ids)})", ids)
+        with self._lock:
+            self._stats['evicted_by_cap'] += len(ids)
+        return [row['token'] for row in rows]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['deleted'] = dict(self._stats['deleted'])
+            stats['last_pass'] = self._last_pass
+            stats['table'] = self._table
+        stats.update({
+            'running': self._thread is not None,
+            'interval': self.interval,
+            'batch_size': self.batch_size,
+            'max_sessions_per_user': self.max_per_user
+        })
+        return stats
+
+
+def table_metrics(cursor):
+    """Size of auth_sessions from table statistics (no scan) plus the expired rows not yet swept."""
+    cursor.execute(
+        """SELECT TABLE_ROWS, DATA_LENGTH, INDEX_LENGTH FROM information_schema.TABLES
+           WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'auth_sessions'"""
+    )
+    row = cursor.fetchone() or (0, 0, 0)
+    # Range count on idx_expires_at; stays small while the sweeper keeps up
+    cursor.execute("SELECT COUNT(*) FROM auth_sessions WHERE expires_at < NOW()")
+    return {
+        'rows_estimate': int(row[0] or 0),
+        'data_bytes': int(row[1] or 0),
+        'index_bytes': int(row[2] or 0),
+        'expired_rows': cursor.fetchone()[0]
+    }
+
+
+def session_maintenance_from_env():
+    return SessionMaintenance(
+        interval=float(os.getenv('SESSION_SWEEP_INTERVAL', '60')),
+        batch_size=int(os.getenv('SESSION_SWEEP_BATCH_SIZE', '500')),
+        pause=float(os.getenv('SESSION_SWEEP_PAUSE', '0.05')),
+        max_per_user=int(os.getenv('AUTH_MAX_SESSIONS_PER_USER', '0'))
+    )
@@ -0,0 +1,128 @@
+"""In-process cache of /api/auth/verify results.
+
+Hot tokens resolve with a dictionary lookup instead of the
+auth_sessions/auth_users JOIN. Valid tokens are cached until the session's
+``expires_at``, capped by TOKEN_CACHE_MAX_TTL; unknown or expired tokens are
+cached briefly to absorb retry and brute-force storms.
+
+Logging out (or evicting a session at the per-user cap) goes through
+``revoke()``, which also records the token's SHA-256 in
+``auth_revoked_tokens`` for TOKEN_CACHE_MAX_TTL. Every replica refreshes
+that list in the background (AUTH_REVOCATION_REFRESH, see
+common/signed_tokens.py) and checks it on each cache hit, so a logged-out
+token stops working everywhere within the refresh interval.
+
+Tuning (all optional):
+    TOKEN_CACHE_SIZE          max cached tokens, LRU-evicted (default 10000)
+    TOKEN_CACHE_MAX_TTL       longest time a valid token is trusted without the DB, seconds (default 300)
+    TOKEN_CACHE_NEGATIVE_TTL  how long an invalid token is remembered, seconds (default 5)
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+# Returned by get() when the token has to be looked up in the database
+MISS = object()
+
+
+def revocation_id(token):
+    """The ``auth_revoked_tokens.jti`` recorded for a logged-out session token."""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class TokenCache:
+    """Thread-safe LRU of token -> user (or ``None`` for invalid tokens)."""
+
+    def __init__(self, max_entries=10000, max_ttl=300.0, negative_ttl=5.0, revocations=None):
+        self.max_entries = max_entries
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        # RevocationList of revocation_id()s, refreshed from auth_revoked_tokens
+        self.revocations = revocations
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'negative_hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'invalidations': 0,
+            'revoked_hits': 0
+        }
+
+    def get(self, token):
+        """Cached user dict, ``None`` for a known-invalid token, or ``MISS``."""
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None or entry[1] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[token]
+                self._stats['misses'] += 1
+                return MISS
+            user = entry[0]
+            if user is not None and self.revocations is not None and self.revocations.is_revoked(revocation_id(token)):
+                # Logged out on another replica: let the database have the final word
+                del self._entries[token]
+                self._stats['revoked_hits'] += 1
+                return MISS
+            self._entries.move_to_end(token)
+            self._stats['hits' if user is not None else 'negative_hits'] += 1
+            return user
+
+    def put(self, token, user, expires_at):
+        """Remember a valid token until its session expires (``expires_at`` is a datetime)."""
+        ttl = min((expires_at - datetime.now()).total_seconds(), self.max_ttl)
+        if ttl > 0:
+            self._store(token, user, ttl)
+
+    def put_invalid(self, token):
+        if self.negative_ttl > 0:
+            self._store(token, None, self.negative_ttl)
+
+    def _store(self, token, user, ttl):
+        with self._lock:
+            self._entries[token] = (user, time.monotonic() + ttl)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def invalidate(self, token):
+        with self._lock:
+            if self._entries.pop(token, None) is not None:
+                self._stats['invalidations'] += 1
+
+    def revoke(self, cursor, tokens):
+        """Stop trusting ``tokens`` on every replica; run it in the transaction that deletes their sessions."""
+        if not tokens:
+            return
+        ids = [revocation_id(token) for token in tokens]
+        # No cached copy anywhere outlives max_ttl, so neither does the entry
+        cursor.executemany(
+            """INSERT INTO auth_revoked_tokens (jti, expires_at) VALUES (%s, NOW() + INTERVAL %s SECOND)
+               ON DUPLICATE KEY UPDATE jti = jti""",
+            [(jti, int(self.max_ttl) + 1) for jti in ids]
+        )
+        exp = time.time() + self.max_ttl + 1
+        for token, jti in zip(tokens, ids):
+            self.invalidate(token)
+            if self.revocations is not None:
+                self.revocations.revoke(jti, exp)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        return stats
+
+
+def token_cache_from_env(revocations=None):
+    return TokenCache(
+        max_entries=int(os.getenv('TOKEN_CACHE_SIZE', '10000')),
+        max_ttl=float(os.getenv('TOKEN_CACHE_MAX_TTL', '300')),
+        negative_ttl=float(os.getenv('TOKEN_CACHE_NEGATIVE_TTL', '5')),
+        revocations=revocations
+    )
@@ -0,0 +1,335 @@
+"""Pooled MySQL access shared by the backend services.
+
+Each service process keeps one bounded pool of open connections instead of
+doing a fresh TCP + auth handshake per request. Routes borrow a connection
+with ``db_cursor()`` and it goes back to the pool when the block exits.
+
+Connect, checkout and per-statement timings are recorded in common/metrics.py;
+statements are labelled with the route being served and their kind
+(select, insert, ...). Checkouts and statements of sampled requests are
+also recorded as spans (common/tracing.py).
+
+Tuning (all optional):
+    DB_POOL_SIZE           max open connections per process (default 10)
+    DB_POOL_TIMEOUT        seconds to wait for a free connection (default 5)
+    DB_POOL_MAX_AGE        recycle connections older than this, seconds (default 1800)
+    DB_POOL_PING_INTERVAL  ping connections idle longer than this, seconds (default 30)
+"""
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import mysql.connector
+
+from common import tracing
+from common.metrics import REGISTRY, current_route
+
+DB_CONNECT_SECONDS = REGISTRY.histogram('db_connect_seconds', 'Time to open a new MySQL connection')
+DB_CHECKOUT_SECONDS = REGISTRY.histogram('db_checkout_seconds',
+                                         'Time to get a pooled connection, including waiting and connecting')
+DB_QUERY_SECONDS = REGISTRY.histogram('db_query_seconds', 'Time spent executing a statement and fetching its rows',
+                                      ('route', 'statement'))
+
+STATEMENT_KINDS = {'select', 'insert', 'update', 'delete', 'replace'}
+
+
+class PoolExhausted(Exception):
+    """No connection became free within the pool wait timeout."""
+
+
+def _db_config():
+    db_host = os.getenv('DB_HOST')
+    db_port = os.getenv('DB_PORT')
+    db_user = os.getenv('DB_USER')
+    db_password = os.getenv('DB_PASSWORD')
+    db_name = os.getenv('DB_NAME')
+
+    # Check if required variables exist (password can be empty string)
+    if not db_host or not db_port or not db_user or db_password is None or not db_name:
+        raise ValueError("Missing required database environment variables: DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME")
+
+    return {
+        'host': db_host,
+        'port': int(db_port),
+        'user': db_user,
+        'password': db_password,
+        'database': db_name,
+        'connection_timeout': 5,
+        'autocommit': False
+    }
+
+
+class _PooledConnection:
+    """A raw connection plus the bookkeeping the pool needs."""
+
+    __slots__ = ('conn', 'created_at', 'last_used')
+
+    def __init__(self, conn):
+        now = time.monotonic()
+        self.conn = conn
+        self.created_at = now
+        self.last_used = now
+
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of MySQL connections."""
+
+    def __init__(self, config, size=10, timeout=5.0, max_age=1800.0, ping_interval=30.0):
+        self.config = config
+        self.size = size
+        self.timeout = timeout
+        self.max_age = max_age
+        self.ping_interval = ping_interval
+
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = deque()
+        self._open = set()
+        self._lock = threading.Lock()
+        self._stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'exhausted': 0,
+            'connects': 0,
+            'reconnects': 0,
+            'discarded': 0
+        }
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def _connect(self):
+        started = time.perf_counter()
+        item = _PooledConnection(mysql.connector.connect(**self.config))
+        DB_CONNECT_SECONDS.observe(time.perf_counter() - started)
+        with self._lock:
+            self._stats['connects'] += 1
+            self._open.add(item)
+        return item
+
+    def _close(self, item):
+        with self._lock:
+            self._open.discard(item)
+        try:
+            item.conn.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, item, now):
+        """Recycle old connections and ping ones that sat idle for a while."""
+        if self.max_age and now - item.created_at > self.max_age:
+            return False
+        if now - item.last_used > self.ping_interval:
+            try:
+                item.conn.ping(reconnect=False)
+            except Exception:
+                return False
+        return True
+
+    def checkout(self):
+        wall_started = time.time()
+        started = time.perf_counter()
+        self._count('checkouts')
+        if not self._slots.acquire(blocking=False):
+            self._count('waits')
+            if not self._slots.acquire(timeout=self.timeout):
+                self._count('exhausted')
+                raise PoolExhausted(f"No database connection available within {self.timeout}s (pool size {self.size})")
+
+        try:
+            now = time.monotonic()
+            while True:
+                try:
+                    item = self._idle.pop()
+                except IndexError:
+                    item = self._connect()
+                    break
+                if self._is_healthy(item, now):
+                    break
+                # Stale or dropped by the server: replace it
+                self._count('reconnects')
+                self._close(item)
+        except Exception:
+            self._slots.release()
+            raise
+
+        item.last_used = now
+        elapsed = time.perf_counter() - started
+        DB_CHECKOUT_SECONDS.observe(elapsed)
+        tracing.record(tracing.current(), 'db.checkout', wall_started, elapsed)
+        return item
+
+    def checkin(self, item, discard=False):
+        try:
+            if not discard:
+                try:
+                    # Never hand the next caller an open transaction
+                    item.conn.rollback()
+                except Exception:
+                    discard = True
+
+            if discard:
+                self._count('discarded')
+                self._close(item)
+            else:
+                item.last_used = time.monotonic()
+                self._idle.append(item)
+        finally:
+            self._slots.release()
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            stats = dict(self._stats)
+            ages = [now - item.created_at for item in self._open]
+        idle = len(self._idle)
+        stats.update({
+            'size': self.size,
+            'open': len(ages),
+            'idle': idle,
+            'in_use': len(ages) - idle,
+            'oldest_connection_age': round(max(ages), 3) if ages else 0,
+            'avg_connection_age': round(sum(ages) / len(ages), 3) if ages else 0
+        })
+        return stats
+
+
+class TimedCursor:
+    """Cursor wrapper that records each statement's execute and fetch time.
+
+    A statement is observed when the next one starts or the cursor closes,
+    so the time spent fetching its rows is included.
+    """
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._labels = None
+        self._elapsed = 0.0
+        self._span = None
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def _timed(self, method, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self._elapsed += time.perf_counter() - started
+
+    def _observe(self):
+        if self._labels is not None:
+            DB_QUERY_SECONDS.observe(self._elapsed, *self._labels)
+            if self._span is not None:
+                ctx, started, operation = self._span
+                tracing.record(ctx, f"db.{self._labels[1]}", started, self._elapsed,
+                               tags={'db.statement': operation[:500]})
+            self._labels = None
+            self._elapsed = 0.0
+
+    def _start(self, operation):
+        self._observe()
+        is_text = isinstance(operation, str)
+        kind = operation.split(None, 1)[0].lower() if is_text and operation.strip() else ''
+        self._labels = (current_route(), kind if kind in STATEMENT_KINDS else 'other')
+        # Captured now: a streamed result may be read after the request's context is gone
+        ctx = tracing.current()
+        self._span = (ctx, time.time(), operation if is_text else '') if ctx is not None and ctx.sampled else None
+
+    def execute(self, operation, *args, **kwargs):
+        self._start(operation)
+        return self._timed(self._cursor.execute, operation, *args, **kwargs)
+
+    def executemany(self, operation, *args, **kwargs):
+        self._start(operation)
+        return self._timed(self._cursor.executemany, operation, *args, **kwargs)
+
+    def fetchone(self):
+        return self._timed(self._cursor.fetchone)
+
+    def fetchmany(self, *args, **kwargs):
+        return self._timed(self._cursor.fetchmany, *args, **kwargs)
+
+    def fetchall(self):
+        return self._timed(self._cursor.fetchall)
+
+    def close(self):
+        self._observe()
+        return self._cursor.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the process-wide pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    _db_config(),
+                    size=int(os.getenv('DB_POOL_SIZE', '10')),
+                    timeout=float(os.getenv('DB_POOL_TIMEOUT', '5')),
+                    max_age=float(os.getenv('DB_POOL_MAX_AGE', '1800')),
+                    ping_interval=float(os.getenv('DB_POOL_PING_INTERVAL', '30'))
+                )
+    return _pool
+
+
+def pool_stats():
+    """Pool counters for health/metrics endpoints (empty until first use)."""
+    return _pool.stats() if _pool is not None else {}
+
+
+def _pool_connections():
+    stats = pool_stats()
+    return {(state,): stats[state] for state in ('open', 'idle', 'in_use') if state in stats}
+
+
+def _pool_counters():
+    stats = pool_stats()
+    return {(event,): stats[event] for event in ('checkouts', 'waits', 'exhausted', 'connects', 'reconnects', 'discarded')
+            if event in stats}
+
+
+REGISTRY.callback('db_pool_connections', 'Pooled MySQL connections by state', 'gauge', ('state',), _pool_connections)
+REGISTRY.callback('db_pool_events_total', 'Connection pool events', 'counter', ('event',), _pool_counters)
+
+
+@contextmanager
+def get_connection():
+    """Borrow a pooled connection for the duration of the block."""
+    pool = get_pool()
+    item = pool.checkout()
+    discard = False
+    try:
+        yield item.conn
+    except (mysql.connector.OperationalError, mysql.connector.InterfaceError):
+        # The connection itself is suspect; don't return it to the pool
+        discard = True
+        raise
+    finally:
+        pool.checkin(item, discard=discard)
+
+
+def placeholders(values):
+    """``%s, %s, ...`` for an ``IN (...)`` list of ``values``."""
+    return ', '.join(['%s'] * len(values))
+
+
+@contextmanager
+def db_cursor(dictionary=False):
+    """Yield ``(conn, cursor)`` on a pooled connection and clean both up."""
+    with get_connection() as conn:
+        cursor = TimedCursor(conn.cursor(dictionary=dictionary))
+        try:
+            yield conn, cursor
+        finally:
+            cursor.close()
@@ -0,0 +1,31 @@
+"""Rolling latency summaries for /health and stats endpoints.
+
+A :class:`LatencyWindow` keeps the most recent ``size`` durations (seconds)
+and summarises them on demand; /metrics histograms (common/metrics.py) are
+the long-term view.
+"""
+import threading
+from collections import deque
+
+
+class LatencyWindow:
+    """The most recent latencies, summarised as mean and percentiles."""
+
+    def __init__(self, size=1000):
+        self._values = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._values.append(seconds)
+
+    def summary(self):
+        with self._lock:
+            values = sorted(self._values)
+        if not values:
+            return {'count': 0}
+        count = len(values)
+        summary = {'count': count, 'avg_ms': round(sum(values) / count * 1000, 1)}
+        for pct in (50, 90, 99):
+            summary[f"p{pct}_ms"] = round(values[min(count - 1, count * pct // 100)] * 1000, 1)
+        return summary
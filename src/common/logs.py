@@ -0,0 +1,171 @@
+"""Structured JSON logs, written to stdout by a background thread.
+
+Every request an app handles becomes one JSON line with its level, route,
+status, latency and request ID (see common/tracing.py). Other records
+logged while handling a request get the same request ID.
+
+A logging call only renders the message and puts the record on a bounded
+queue; a writer thread turns records into JSON and writes them. A slow
+stdout, such as a container log driver whose pipe has backed up, therefore
+never stalls a worker. When the queue is full, records are dropped rather
+than making requests wait, and counted in ``log_records_total`` on /metrics.
+
+Successful requests may be sampled with LOG_SUCCESS_SAMPLE_RATE. Warnings
+and errors are always logged: 4xx and 5xx responses, unhandled exceptions
+and anything logged at WARNING or above.
+
+The settings are read by ``configure()`` (called from ``log_flask()`` and
+the gateway's asyncio setup), after the service has loaded its .env.
+
+Tuning (all optional):
+    LOG_LEVEL                lowest level written (default INFO; DEBUG adds gateway proxy details)
+    LOG_SUCCESS_SAMPLE_RATE  fraction of successful requests logged (default 1)
+    LOG_QUEUE_SIZE           records waiting to be written before new ones are dropped (default 10000)
+    LOG_REQUESTS             "false" turns the per-request lines off (default true)
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+
+from flask import g, request
+
+from common import tracing
+from common.metrics import REGISTRY
+
+LOG_RECORDS = REGISTRY.counter('log_records_total', 'Log records by outcome', ('outcome',))
+
+REQUEST_LOG = logging.getLogger('request')
+
+_listener = None
+
+# Set by configure()
+LOG_REQUESTS = True
+SUCCESS_SAMPLE_RATE = 1.0
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record; ``extra={'fields': {...}}`` adds keys to it."""
+
+    def __init__(self, service_name):
+        super().__init__()
+        self.service_name = service_name
+
+    def format(self, record):
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            'level': record.levelname.lower(),
+            'service': self.service_name,
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        request_id = getattr(record, 'request_id', None)
+        if request_id:
+            entry['request_id'] = request_id
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class QueueingHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread without ever waiting for it."""
+
+    def prepare(self, record):
+        # Same thread, so the record needs no pickling; render the message
+        # now in case its arguments change before the writer gets to it
+        record.msg = record.getMessage()
+        record.args = None
+        if not hasattr(record, 'request_id'):
+            ctx = tracing.current()
+            record.request_id = ctx.request_id if ctx is not None else None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS.inc('dropped')
+        else:
+            LOG_RECORDS.inc('queued')
+
+
+class LogWriter(logging.handlers.QueueListener):
+    """The background thread writing queued records."""
+
+    def enqueue_sentinel(self):
+        # At exit: wait for room instead of failing when the queue is full
+        self.queue.put(self._sentinel)
+
+
+def configure(service_name):
+    """Send the process's log records through the queue to stdout as JSON lines; safe to call twice."""
+    global _listener, LOG_REQUESTS, SUCCESS_SAMPLE_RATE
+    if _listener is not None:
+        return
+    LOG_REQUESTS = os.getenv('LOG_REQUESTS', 'true').lower() == 'true'
+    SUCCESS_SAMPLE_RATE = float(os.getenv('LOG_SUCCESS_SAMPLE_RATE', '1'))
+    records = queue.Queue(int(os.getenv('LOG_QUEUE_SIZE', '10000')))
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JsonFormatter(service_name))
+    _listener = LogWriter(records, stream)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    root = logging.getLogger()
+    root.handlers = [QueueingHandler(records)]
+    root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+    # The request lines below replace werkzeug's own, which it writes synchronously
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+
+def log_request(method, path, route, status, seconds, request_id=None):
+    """The one line for a finished request; successes may be sampled, failures never are."""
+    if not LOG_REQUESTS:
+        return
+    if status >= 500:
+        level = logging.ERROR
+    elif status >= 400:
+        level = logging.WARNING
+    else:
+        level = logging.INFO
+        if SUCCESS_SAMPLE_RATE < 1 and random.random() >= SUCCESS_SAMPLE_RATE:
+            return
+    if not REQUEST_LOG.isEnabledFor(level):
+        return
+    REQUEST_LOG.log(level, f"{method} {path} {status}", extra={
+        'request_id': request_id,
+        'fields': {'method': method, 'route': route, 'status': status, 'latency_ms': round(seconds * 1000, 2)}
+    })
+
+
+def log_flask(app, service_name, route_label=None):
+    """Log one JSON line per request of ``app``; ``route_label`` works as in instrument_flask()."""
+    configure(service_name)
+
+    @app.before_request
+    def _start_request_log():
+        g.log_started = time.perf_counter()
+
+    @app.after_request
+    def _note_log_status(response):
+        g.log_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def _write_request_log(exc):
+        started = g.pop('log_started', None)
+        if started is None:
+            return
+        if route_label is not None:
+            route = route_label(request)
+        else:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        ctx = tracing.current()
+        log_request(request.method, request.path, route, 500 if exc is not None else g.get('log_status', 500),
+                    time.perf_counter() - started, ctx.request_id if ctx is not None else None)
@@ -0,0 +1,286 @@
+"""In-process metrics for the services and the gateway, exposed on /metrics.
+
+Counters, gauges and latency histograms are kept per thread: recording one
+is a dict update in the calling thread's own shard, with no lock and no
+contention. A scrape adds the shards up. When a thread ends its shard is
+folded into a shared total, so the thread-per-request WSGI server doesn't
+leave a shard behind per request.
+
+``instrument_flask(app)`` records request count, errors (5xx or an
+unhandled exception), latency and in-flight requests per route and serves
+everything in the Prometheus text format on ``/metrics``. The request's
+route is also remembered for the thread, so common/db.py can label query
+timings with it.
+
+Tuning (all optional):
+    METRICS_BUCKETS  histogram bucket bounds in seconds, comma separated
+                     (default .001,.0025,.005,.01,.025,.05,.1,.25,.5,1,2.5,5,10)
+"""
+import logging
+import os
+import threading
+import time
+import weakref
+from bisect import bisect_left
+
+from flask import Response, g, request
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = '.001,.0025,.005,.01,.025,.05,.1,.25,.5,1,2.5,5,10'
+
+
+def buckets_from_env():
+    return tuple(float(b) for b in os.getenv('METRICS_BUCKETS', DEFAULT_BUCKETS).split(',') if b.strip())
+
+
+class _ShardAnchor:
+    """Lives in a thread's local storage; its finalizer retires the thread's shard."""
+
+
+class Registry:
+    """Metric families plus the per-thread shards holding their values."""
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = {}
+        self._retired = {}
+        self._families = []
+        self._callbacks = []
+
+    def _values(self):
+        """The calling thread's shard: ``{(family, labels): value}``."""
+        try:
+            return self._local.values
+        except AttributeError:
+            pass
+        values = {}
+        anchor = _ShardAnchor()
+        self._local.values = values
+        self._local.anchor = anchor
+        with self._lock:
+            self._shards[id(values)] = values
+        weakref.finalize(anchor, self._retire, values)
+        return values
+
+    def _retire(self, values):
+        with self._lock:
+            self._shards.pop(id(values), None)
+            _merge(self._retired, values)
+
+    def _register(self, family):
+        with self._lock:
+            self._families.append(family)
+        return family
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(self, name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self._register(Gauge(self, name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=None):
+        return self._register(Histogram(self, name, help, labelnames, buckets))
+
+    def callback(self, name, help, kind, labelnames, collect):
+        """A family read on each scrape: ``collect()`` returns ``{labels: value}``."""
+        with self._lock:
+            self._callbacks.append((name, help, kind, labelnames, collect))
+
+    def collect(self):
+        """``{family: {labels: value}}`` summed over every thread."""
+        with self._lock:
+            totals = {}
+            _merge(totals, self._retired)
+            shards = list(self._shards.values())
+            families = list(self._families)
+            callbacks = list(self._callbacks)
+        for values in shards:
+            # dict.copy() is atomic, so the owning thread can keep writing
+            _merge(totals, values.copy())
+        samples = {family: {} for family in families}
+        for (family, labels), value in totals.items():
+            samples[family][labels] = value
+        return samples, callbacks
+
+    def render(self):
+        """Everything in the Prometheus text exposition format."""
+        samples, callbacks = self.collect()
+        lines = []
+        for family, values in samples.items():
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            if not values and not family.labelnames and family.kind != 'histogram':
+                values = {(): 0}
+            for labels in sorted(values):
+                family.render(lines, _label_pairs(family.labelnames, labels), values[labels])
+        for name, help, kind, labelnames, collect in callbacks:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            try:
+                values = collect()
+            except Exception as e:
+                log.warning("Metric %s unavailable: %s", name, e)
+                continue
+            for labels, value in sorted(values.items()):
+                lines.append(f"{name}{_format_labels(_label_pairs(labelnames, labels))} {_number(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+def _merge(totals, values):
+    for key, value in values.items():
+        current = totals.get(key)
+        if current is None:
+            totals[key] = list(value) if isinstance(value, list) else value
+        elif isinstance(value, list):
+            for i, item in enumerate(value):
+                current[i] += item
+        else:
+            totals[key] = current + value
+
+
+def _label_pairs(labelnames, labels):
+    return list(zip(labelnames, labels))
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, registry, name, help, labelnames):
+        self._registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    def inc(self, *labels, value=1):
+        values = self._registry._values()
+        key = (self, labels)
+        values[key] = values.get(key, 0) + value
+
+    def render(self, lines, pairs, value):
+        lines.append(f"{self.name}{_format_labels(pairs)} {_number(value)}")
+
+
+class Gauge(Counter):
+    """Up/down value; each thread keeps its own delta and a scrape adds them up."""
+
+    kind = 'gauge'
+
+    def add(self, *labels, value=1):
+        self.inc(*labels, value=value)
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help, labelnames, buckets):
+        self._registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        # None: METRICS_BUCKETS, read on first use rather than at import,
+        # so a service's .env is loaded by then
+        self._buckets = tuple(sorted(buckets)) if buckets is not None else None
+
+    @property
+    def buckets(self):
+        if self._buckets is None:
+            self._buckets = tuple(sorted(buckets_from_env()))
+        return self._buckets
+
+    def observe(self, value, *labels):
+        values = self._registry._values()
+        key = (self, labels)
+        counts = values.get(key)
+        if counts is None:
+            # One slot per bucket, one for +Inf, then the sum
+            counts = values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def render(self, lines, pairs, counts):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{_format_labels(pairs + [('le', _number(bound))])} {cumulative}")
+        lines.append(f"{self.name}_sum{_format_labels(pairs)} {_number(counts[-1])}")
+        lines.append(f"{self.name}_count{_format_labels(pairs)} {cumulative}")
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.counter('http_requests_total', 'Requests handled', ('route', 'method', 'status'))
+REQUEST_ERRORS = REGISTRY.counter('http_request_errors_total', 'Requests that ended in a 5xx or an unhandled exception',
+                                  ('route', 'method'))
+REQUEST_SECONDS = REGISTRY.histogram('http_request_duration_seconds',
+                                     'Time until the response was handed to the server', ('route', 'method'))
+IN_FLIGHT = REGISTRY.gauge('http_requests_in_flight', 'Requests being handled')
+
+
+def current_route():
+    """Route label of the request the calling thread is handling, if any."""
+    return getattr(REGISTRY._local, 'route', None) or 'background'
+
+
+def set_current_route(route):
+    REGISTRY._local.route = route
+
+
+def metrics_response():
+    return Response(REGISTRY.render(), headers={'Content-Type': CONTENT_TYPE})
+
+
+def instrument_flask(app, route_label=None):
+    """Record per-route request metrics for ``app`` and serve them on /metrics.
+
+    ``route_label(request)`` names a request's route; by default it's the
+    URL rule (``/api/user/profile/<int:user_id>``), so labels stay bounded.
+    """
+
+    @app.before_request
+    def _start_request_metrics():
+        if route_label is not None:
+            route = route_label(request)
+        else:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        g.metrics_route = route
+        g.metrics_started = time.perf_counter()
+        set_current_route(route)
+        IN_FLIGHT.add()
+
+    @app.after_request
+    def _note_status(response):
+        g.metrics_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def _record_request_metrics(exc):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return
+        route = g.metrics_route
+        status = 500 if exc is not None else g.get('metrics_status', 500)
+        REQUEST_SECONDS.observe(time.perf_counter() - started, route, request.method)
+        REQUESTS.inc(route, request.method, str(status))
+        if status >= 500:
+            REQUEST_ERRORS.inc(route, request.method)
+        IN_FLIGHT.add(value=-1)
+        set_current_route(None)
+
+    app.add_url_rule('/metrics', 'metrics', metrics_response)
@@ -0,0 +1,132 @@
+"""Keyset (cursor) pagination and column projection for list endpoints.
+
+A page is fetched with ``WHERE (key columns) > / < (last row's values)`` on
+an indexed ordering instead of ``OFFSET``, so page 10,000 costs the same as
+page 1. The position is handed to clients as an opaque ``next_cursor``.
+
+Query parameters understood by every paginated endpoint:
+    limit    rows per page (default PAGE_DEFAULT_LIMIT, at most PAGE_MAX_LIMIT)
+    cursor   ``next_cursor`` from the previous page; omit for the first page
+    fields   comma-separated columns to return, e.g. ``fields=id,amount,status``
+"""
+import base64
+import json
+import os
+
+
+class PageArgumentError(ValueError):
+    """Bad ``limit``, ``cursor`` or ``fields`` parameter (answer with 400)."""
+
+
+def encode_cursor(values):
+    data = json.dumps(values, default=str, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def decode_cursor(token, size):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except ValueError:
+        raise PageArgumentError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != size or \
+            not all(isinstance(value, (int, str)) for value in values):
+        raise PageArgumentError("Invalid cursor")
+    return values
+
+
+class KeysetQuery:
+    """A paginated listing of one table.
+
+    ``order`` is a list of ``(column, 'ASC'|'DESC')`` ending in a unique
+    column (normally ``id``) and backed by an index, e.g.
+    ``[('created_at', 'DESC'), ('id', 'DESC')]`` with ``INDEX (created_at)``.
+    """
+
+    def __init__(self, table, columns, order):
+        directions = {direction for _, direction in order}
+        if len(directions) != 1 or not directions <= {'ASC', 'DESC'}:
+            raise ValueError("Keyset order columns must all sort the same way (ASC or DESC)")
+        self.table = table
+        self.columns = list(columns)
+        self.key_columns = [column for column, _ in order]
+        self.direction = directions.pop()
+        self.default_limit = int(os.getenv('PAGE_DEFAULT_LIMIT', '100'))
+        self.max_limit = int(os.getenv('PAGE_MAX_LIMIT', '1000'))
+
+    def page(self, args):
+        """Build a :class:`Page` from request query args."""
+        return Page(self, self._parse_fields(args.get('fields')), self._parse_limit(args.get('limit')),
+                    decode_cursor(args['cursor'], len(self.key_columns)) if args.get('cursor') else None)
+
+    def _parse_limit(self, value):
+        if value is None or value == '':
+            return self.default_limit
+        try:
+            limit = int(value)
+        except ValueError:
+            raise PageArgumentError("limit must be an integer")
+        if limit < 1:
+            raise PageArgumentError("limit must be at least 1")
+        return min(limit, self.max_limit)
+
+    def _parse_fields(self, value):
+        if not value:
+            return list(self.columns)
+        fields = []
+        for name in value.split(','):
+            name = name.strip()
+            if not name or name in fields:
+                continue
+            if name not in self.columns:
+                raise PageArgumentError(f"Unknown field '{name}' (available: {', '.join(self.columns)})")
+            fields.append(name)
+        return fields or list(self.columns)
+
+
+class Page:
+    """One page request: the projected fields, the page size and where to start."""
+
+    def __init__(self, query, fields, limit, after=None):
+        self.query = query
+        self.fields = fields
+        self.limit = limit
+        self.after = after
+        # Key columns are always selected so the next cursor can be built
+        self.select = fields + [column for column in query.key_columns if column not in fields]
+
+    def sql(self, where=None, params=(), limit=None):
+        """``(statement, params)`` for this page, optionally narrowed by ``where``."""
+        query = self.query
+        clauses = [where] if where else []
+        params = list(params)
+        if self.after is not None:
+            keys = ', '.join(query.key_columns)
+            marks = ', '.join(['%s'] * len(query.key_columns))
+            clauses.append(f"({keys}) {'>' if query.direction == 'ASC' else '<'} ({marks})")
+            params.extend(self.after)
+        statement = f"SELECT {', '.join(self.select)} FROM {query.table}"
+        if clauses:
+            statement += " WHERE " + " AND ".join(clauses)
+        statement += " ORDER BY " + ', '.join(f"{column} {query.direction}" for column in query.key_columns)
+        if limit is not None:
+            statement += f" LIMIT {int(limit)}"
+        return statement, params
+
+    def cursor_for(self, row):
+        return encode_cursor([row[column] for column in self.query.key_columns])
+
+    def project(self, row):
+        if len(self.select) == len(self.fields):
+            return row
+        return {field: row[field] for field in self.fields}
+
+    def fetch(self, cursor, where=None, params=()):
+        """Run the page query on a dictionary cursor; returns ``(rows, next_cursor)``."""
+        # One extra row tells us whether another page exists
+        cursor.execute(*self.sql(where, params, limit=self.limit + 1))
+        rows = cursor.fetchall()
+        next_cursor = None
+        if len(rows) > self.limit:
+            rows = rows[:self.limit]
+            next_cursor = self.cursor_for(rows[-1])
+        return [self.project(row) for row in rows], next_cursor
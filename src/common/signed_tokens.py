@@ -0,0 +1,188 @@
+"""Stateless HMAC-signed auth tokens.
+
+A token carries the user's id, username, email and expiry, so anyone holding
+the keys (auth service, API gateway) can verify it with pure CPU work and no
+database lookup. Format::
+
+    v1.<key id>.<base64url JSON claims>.<base64url HMAC-SHA256>
+
+Keys come from AUTH_TOKEN_KEYS as "kid:secret,kid:secret". The first key
+signs new tokens; all listed keys are accepted, so keys are rotated by
+prepending a new one and dropping the old one once its tokens have expired.
+
+Logged-out tokens are tracked by their ``jti`` in a small revocation list
+that a background thread refreshes from its source every few seconds, so
+checking it is a dict lookup.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from datetime import datetime
+
+TOKEN_PREFIX = 'v1.'
+
+log = logging.getLogger(__name__)
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def is_signed_token(token):
+    return isinstance(token, str) and token.startswith(TOKEN_PREFIX)
+
+
+def keys_from_env():
+    """Parse AUTH_TOKEN_KEYS into an ordered {kid: secret bytes} dict (empty if unset)."""
+    keys = {}
+    for item in os.getenv('AUTH_TOKEN_KEYS', '').split(','):
+        if ':' in item:
+            kid, secret = item.split(':', 1)
+            if '.' in kid:
+                raise ValueError(f"AUTH_TOKEN_KEYS key id '{kid}' must not contain '.'")
+            keys[kid.strip()] = secret.strip().encode()
+    return keys
+
+
+class TokenCodec:
+    """Issues and verifies signed tokens."""
+
+    def __init__(self, keys, ttl=24 * 3600):
+        if not keys:
+            raise ValueError("At least one signing key is required (AUTH_TOKEN_KEYS)")
+        self.keys = dict(keys)
+        self.signing_kid = next(iter(self.keys))
+        self.ttl = ttl
+
+    def _sign(self, kid, signing_input):
+        return hmac.new(self.keys[kid], signing_input.encode(), hashlib.sha256).digest()
+
+    def issue(self, user_id, username, email=None):
+        """Return ``(token, claims)`` for a freshly logged-in user."""
+        claims = {
+            'sub': user_id,
+            'usr': username,
+            'eml': email,
+            'exp': int(time.time()) + self.ttl,
+            'jti': secrets.token_urlsafe(12)
+        }
+        payload = _b64encode(json.dumps(claims, separators=(',', ':')).encode())
+        signing_input = f"{TOKEN_PREFIX}{self.signing_kid}.{payload}"
+        return f"{signing_input}.{_b64encode(self._sign(self.signing_kid, signing_input))}", claims
+
+    def decode(self, token, verify_exp=True):
+        """Claims of a well-formed, correctly signed, unexpired token, else ``None``."""
+        if not is_signed_token(token):
+            return None
+        parts = token.split('.')
+        if len(parts) != 4 or parts[1] not in self.keys:
+            return None
+        signing_input = '.'.join(parts[:3])
+        try:
+            signature = _b64decode(parts[3])
+        except ValueError:
+            return None
+        if not hmac.compare_digest(signature, self._sign(parts[1], signing_input)):
+            return None
+        try:
+            claims = json.loads(_b64decode(parts[2]))
+        except ValueError:
+            return None
+        if verify_exp and claims.get('exp', 0) <= time.time():
+            return None
+        return claims
+
+
+def claims_user(claims):
+    """The user dict /api/auth/verify returns, built from token claims."""
+    return {'id': claims['sub'], 'username': claims['usr'], 'email': claims.get('eml')}
+
+
+def claims_expires_at(claims):
+    return datetime.fromtimestamp(claims['exp'])
+
+
+class RevocationList:
+    """Revoked token ids, merged from a shared source every ``refresh_interval`` seconds.
+
+    ``loader`` returns an iterable of ``(jti, exp)`` pairs (exp as a Unix
+    timestamp); entries are dropped once the token would have expired anyway.
+    ``start()`` runs it on a daemon thread; without a loader the owner
+    calls ``merge()`` itself (the asyncio gateway does, from a task).
+    """
+
+    def __init__(self, loader=None, refresh_interval=5.0):
+        self.loader = loader
+        self.refresh_interval = refresh_interval
+        self._revoked = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stats = {'refreshes': 0, 'refresh_errors': 0}
+
+    def start(self):
+        if self._thread is None and self.loader is not None:
+            self._thread = threading.Thread(target=self._run, name='revocation-refresh', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self.refresh()
+            time.sleep(self.refresh_interval)
+
+    def revoke(self, jti, exp):
+        with self._lock:
+            self._revoked[jti] = exp
+
+    def is_revoked(self, jti):
+        return jti in self._revoked
+
+    def refresh(self):
+        try:
+            loaded = list(self.loader())
+        except Exception as e:
+            with self._lock:
+                self._stats['refresh_errors'] += 1
+            log.warning("Revocation list refresh failed: %s", e)
+            return
+        self.merge(loaded)
+        with self._lock:
+            self._stats['refreshes'] += 1
+
+    def merge(self, pairs):
+        """Add ``(jti, exp)`` pairs from the shared source and forget expired ones."""
+        now = time.time()
+        with self._lock:
+            revoked = dict(self._revoked)
+            revoked.update(pairs)
+            self._revoked = {jti: exp for jti, exp in revoked.items() if exp > now}
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['revoked'] = len(self._revoked)
+        return stats
+
+
+class SignedTokenVerifier:
+    """Codec plus revocation check: the full CPU-only verify path."""
+
+    def __init__(self, codec, revocations):
+        self.codec = codec
+        self.revocations = revocations
+
+    def verify(self, token):
+        """Claims for a valid, unrevoked token, else ``None``."""
+        claims = self.codec.decode(token)
+        if claims is None or self.revocations.is_revoked(claims.get('jti')):
+            return None
+        return claims
@@ -0,0 +1,278 @@
+"""Request IDs and timing spans that follow a request from the gateway to the database.
+
+Every request gets an ``X-Request-ID``; the gateway keeps a well-formed one
+sent by the client and makes one up otherwise. It is forwarded upstream
+together with a W3C ``traceparent`` header, and echoed on the response.
+
+Spans are recorded for the handler of every service, for the gateway's
+calls to its upstreams and for pooled-connection checkout and each SQL
+statement (common/db.py). They're exported in the Zipkin v2 JSON format,
+either appended to a file (one span per line) or POSTed in batches to a
+Zipkin-compatible collector. A background thread does the exporting, so
+requests only put spans on a bounded queue. When the queue is full, spans
+are dropped rather than making requests wait.
+
+Sampling is decided once, where a trace starts (normally the gateway),
+and carried in ``traceparent``: a trace is either recorded in every
+service or in none, and TRACE_SAMPLE_RATE bounds the cost of keeping
+tracing on.
+
+The settings are read by ``configure()`` (called from ``trace_flask()`` and
+the gateway's asyncio setup), after the service has loaded its .env.
+
+Tuning (all optional):
+    TRACE_EXPORT        file path or http(s) collector URL, e.g. http://zipkin:9411/api/v2/spans
+                        (unset: no spans are recorded; request IDs are still propagated)
+    TRACE_SAMPLE_RATE   fraction of new traces recorded (default 0.1)
+    TRACE_QUEUE_SIZE    spans waiting for export before new ones are dropped (default 10000)
+    TRACE_BATCH_SIZE    spans written or sent at a time (default 100)
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+import urllib.request
+from contextvars import ContextVar
+
+from flask import g, request
+
+from common.metrics import REGISTRY
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+TRACEPARENT_HEADER = 'traceparent'
+
+_REQUEST_ID = re.compile(r'^[A-Za-z0-9._:-]{1,128}$')
+_TRACEPARENT = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+_current = ContextVar('trace_context', default=None)
+
+log = logging.getLogger(__name__)
+
+
+def new_id(bits=64):
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+
+class TraceContext:
+    """The trace a request belongs to and the span that is its handler."""
+
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'sampled', 'request_id')
+
+    def __init__(self, trace_id, span_id, parent_id, sampled, request_id):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.request_id = request_id
+
+    def headers(self, span_id):
+        """Headers for an outgoing call made in the span ``span_id``."""
+        return {
+            REQUEST_ID_HEADER: self.request_id,
+            TRACEPARENT_HEADER: f"00-{self.trace_id}-{span_id}-{'01' if self.sampled else '00'}"
+        }
+
+
+def incoming(headers):
+    """The context of a request being received, continuing the caller's trace if it sent one."""
+    request_id = headers.get(REQUEST_ID_HEADER, '')
+    if not _REQUEST_ID.match(request_id):
+        request_id = new_id(128)
+    parent = _TRACEPARENT.match(headers.get(TRACEPARENT_HEADER, ''))
+    if parent is not None:
+        trace_id, parent_id, flags = parent.groups()
+        sampled = bool(int(flags, 16) & 1)
+    else:
+        trace_id, parent_id = new_id(128), None
+        sampled = random.random() < SAMPLE_RATE
+    return TraceContext(trace_id, new_id(), parent_id, sampled, request_id)
+
+
+def current():
+    """The context of the request being handled, or ``None`` outside one."""
+    return _current.get()
+
+
+def activate(ctx):
+    return _current.set(ctx)
+
+
+def deactivate(token):
+    _current.reset(token)
+
+
+def inject(headers, ctx, span_id):
+    """``headers`` with the trace headers of an outgoing call replacing any sent by the client."""
+    own = ctx.headers(span_id)
+    names = {name.lower() for name in own}
+    merged = {name: value for name, value in (headers or {}).items() if name.lower() not in names}
+    merged.update(own)
+    return merged
+
+
+def record(ctx, name, started, duration, kind=None, span_id=None, parent_id=None, tags=None):
+    """Queue a finished span of a sampled trace; ``started`` is a ``time.time()`` value."""
+    if ctx is None or not ctx.sampled or EXPORTER is None:
+        return
+    span = {
+        'traceId': ctx.trace_id,
+        'id': span_id or new_id(),
+        'name': name,
+        'timestamp': int(started * 1_000_000),
+        'duration': max(int(duration * 1_000_000), 1),
+        'localEndpoint': {'serviceName': SERVICE_NAME},
+        'tags': {key: str(value) for key, value in (tags or {}).items()}
+    }
+    span['tags']['request_id'] = ctx.request_id
+    parent_id = parent_id or (ctx.span_id if span_id != ctx.span_id else ctx.parent_id)
+    if parent_id:
+        span['parentId'] = parent_id
+    if kind:
+        span['kind'] = kind
+    EXPORTER.submit(span)
+
+
+class SpanExporter:
+    """Background thread writing queued spans to a file or POSTing them to a collector."""
+
+    def __init__(self, target, queue_size=10000, batch_size=100, interval=1.0):
+        self.target = target
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue = queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._export_lock = threading.Lock()
+        self._thread = None
+        self._stats = {'exported': 0, 'dropped': 0, 'failed': 0}
+
+    def submit(self, span):
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self._count('dropped')
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='span-exporter', daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self._stats[key] += n
+
+    def _drain(self, limit):
+        batch = []
+        while len(batch) < limit:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _export(self, batch):
+        try:
+            if self.target.startswith(('http://', 'https://')):
+                req = urllib.request.Request(self.target, data=json.dumps(batch).encode(),
+                                             headers={'Content-Type': 'application/json'}, method='POST')
+                with urllib.request.urlopen(req, timeout=5):
+                    pass
+            else:
+                with open(self.target, 'a') as f:
+                    f.write(''.join(json.dumps(span) + '\n' for span in batch))
+            self._count('exported', len(batch))
+        except Exception as e:
+            log.warning("Exporting %d spans to %s failed: %s", len(batch), self.target, e)
+            self._count('failed', len(batch))
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            with self._export_lock:
+                batch = [first] + self._drain(self.batch_size - 1)
+                while batch:
+                    self._export(batch)
+                    batch = self._drain(self.batch_size)
+            # Let spans pile up into batches instead of writing them one at a time
+            time.sleep(self.interval)
+
+    def flush(self):
+        """Export whatever is still queued (at exit)."""
+        with self._export_lock:
+            batch = self._drain(self.batch_size)
+            while batch:
+                self._export(batch)
+                batch = self._drain(self.batch_size)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+def exporter_from_env():
+    target = os.getenv('TRACE_EXPORT')
+    if not target:
+        return None
+    return SpanExporter(
+        target,
+        queue_size=int(os.getenv('TRACE_QUEUE_SIZE', '10000')),
+        batch_size=int(os.getenv('TRACE_BATCH_SIZE', '100'))
+    )
+
+
+# Set by configure(): until then nothing is sampled or exported
+EXPORTER = None
+SAMPLE_RATE = 0.0
+SERVICE_NAME = 'unknown'
+
+
+def configure(service_name):
+    """Read the tracing settings and name the process's spans; the exporter is only built once."""
+    global EXPORTER, SAMPLE_RATE, SERVICE_NAME
+    SERVICE_NAME = service_name
+    SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0.1'))
+    if EXPORTER is None:
+        EXPORTER = exporter_from_env()
+        if EXPORTER is not None:
+            REGISTRY.callback('trace_spans_total', 'Spans by export outcome', 'counter', ('outcome',),
+                              lambda: {(outcome,): count for outcome, count in EXPORTER.stats().items()})
+
+
+def trace_flask(app, service_name):
+    """Give every request of ``app`` a request ID and a handler span, and echo the ID back."""
+    configure(service_name)
+
+    @app.before_request
+    def _start_trace():
+        ctx = incoming(request.headers)
+        g.trace = ctx
+        g.trace_token = activate(ctx)
+        g.trace_started = (time.time(), time.perf_counter())
+
+    @app.after_request
+    def _echo_request_id(response):
+        ctx = g.get('trace')
+        if ctx is not None:
+            response.headers[REQUEST_ID_HEADER] = ctx.request_id
+            g.trace_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def _finish_trace(exc):
+        ctx = g.pop('trace', None)
+        if ctx is None:
+            return
+        started, perf_started = g.trace_started
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        record(ctx, f"{request.method} {route}", started, time.perf_counter() - perf_started, kind='SERVER',
+               span_id=ctx.span_id, tags={'http.method': request.method, 'http.path': request.path,
+                                          'http.status_code': 500 if exc is not None else g.get('trace_status', 500)})
+        deactivate(g.trace_token)
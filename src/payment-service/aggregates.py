@@ -0,0 +1,193 @@
+"""Running payment totals, maintained alongside the payments table.
+
+Every change to a payment's status applies a +1/-1 count and +/-amount delta
+to two small tables in the same transaction as the change itself:
+
+    payment_totals        all-time totals per (status, currency, payment_method)
+    payment_daily_totals  the same per DATE(created_at)
+
+so /api/payment/stats reads a handful of rows instead of scanning payments.
+Each key is spread over TOTAL_SLOTS rows (``slot = id % TOTAL_SLOTS``),
+summed on read, so concurrent payment writes land on different rows instead
+of all queueing for one row lock. The tables can always be rebuilt from
+payments (which is also how to apply a change of TOTAL_SLOTS):
+
+    python aggregates.py verify   # report rows that disagree with payments
+    python aggregates.py repair   # rebuild both tables from payments
+"""
+import os
+import sys
+
+# Rows each aggregate key is spread over
+TOTAL_SLOTS = 16
+
+AGGREGATE_TABLES = {
+    'payment_totals': ['status', 'currency', 'payment_method', 'slot'],
+    'payment_daily_totals': ['day', 'status', 'currency', 'payment_method', 'slot']
+}
+
+# How each key column is derived from a payments row
+KEY_EXPRESSIONS = {
+    'day': 'DATE(created_at)',
+    'status': 'status',
+    'currency': "COALESCE(currency, '')",
+    'payment_method': "COALESCE(payment_method, '')",
+    'slot': f'MOD(id, {TOTAL_SLOTS})'
+}
+
+
+def apply_delta(cursor, payment_ids, status, sign):
+    """Add (sign=1) or remove (sign=-1) payments ``payment_ids`` under ``status``.
+
+    Reads the payments' own day/currency/method/amount so the delta always
+    lands on the same keys a rebuild would use. Run it in the transaction
+    that inserts the payments or changes their status.
+    """
+    if not payment_ids:
+        return
+    marks = ', '.join(['%s'] * len(payment_ids))
+    for table, keys in AGGREGATE_TABLES.items():
+        columns = ', '.join(keys)
+        values = ', '.join(('%s' if key == 'status' else KEY_EXPRESSIONS[key]) + f' AS {key}' for key in keys)
+        group_by = ', '.join(KEY_EXPRESSIONS[key] for key in keys if key != 'status')
+        # The derived table's alias replaces VALUES(), deprecated since MySQL 8.0.20
+        cursor.execute(
+            f"""INSERT INTO {table} ({columns}, payment_count, total_amount)
+                SELECT * FROM (
+                    SELECT {values}, %s * COUNT(*) AS delta_count, %s * SUM(amount) AS delta_amount
+                    FROM payments WHERE id IN ({marks}) GROUP BY {group_by}
+                ) AS delta
+                ON DUPLICATE KEY UPDATE payment_count = payment_count + delta.delta_count,
+                                        total_amount = total_amount + delta.delta_amount""",
+            [status, sign, sign] + list(payment_ids)
+        )
+
+
+def record_new_payment(cursor, payment_id, status):
+    apply_delta(cursor, [payment_id], status, 1)
+
+
+def record_status_change(cursor, payment_id, old_status, new_status):
+    record_status_changes(cursor, [payment_id], old_status, new_status)
+
+
+def record_status_changes(cursor, payment_ids, old_status, new_status):
+    """Move several payments from ``old_status`` to ``new_status`` with two statements per table."""
+    if old_status != new_status:
+        apply_delta(cursor, payment_ids, old_status, -1)
+        apply_delta(cursor, payment_ids, new_status, 1)
+
+
+def _rebuild_select(keys):
+    expressions = ', '.join(KEY_EXPRESSIONS[key] for key in keys)
+    return f"SELECT {expressions}, COUNT(*), SUM(amount) FROM payments GROUP BY {expressions}"
+
+
+def verify(cursor):
+    """Rows where the stored totals differ from payments, as dicts (empty when consistent)."""
+    mismatches = []
+    for table, keys in AGGREGATE_TABLES.items():
+        cursor.execute(_rebuild_select(keys))
+        expected = {tuple(row[:-2]): (row[-2], row[-1]) for row in cursor.fetchall()}
+        cursor.execute(f"SELECT {', '.join(keys)}, payment_count, total_amount FROM {table}")
+        stored = {tuple(row[:-2]): (row[-2], row[-1]) for row in cursor.fetchall()}
+        for key in set(expected) | set(stored):
+            want = expected.get(key, (0, 0))
+            have = stored.get(key, (0, 0))
+            if want[0] != have[0] or want[1] != have[1]:
+                mismatches.append({
+                    'table': table,
+                    'key': dict(zip(keys, (str(part) for part in key))),
+                    'expected': {'payment_count': want[0], 'total_amount': str(want[1])},
+                    'stored': {'payment_count': have[0], 'total_amount': str(have[1])}
+                })
+    return mismatches
+
+
+def repair(conn, cursor):
+    """Rebuild both tables from payments in one transaction.
+
+    INSERT ... SELECT locks the scanned payments rows, so concurrent payment
+    writes wait for the rebuild instead of being lost by it.
+    """
+    for table, keys in AGGREGATE_TABLES.items():
+        cursor.execute(f"DELETE FROM {table}")
+        cursor.execute(f"INSERT INTO {table} ({', '.join(keys)}, payment_count, total_amount) {_rebuild_select(keys)}")
+    conn.commit()
+
+
+def _totals(rows, key):
+    totals = {}
+    for row in rows:
+        bucket = totals.setdefault(row[key] or 'unknown', {'count': 0, 'amount': 0.0, 'by_status': {}})
+        bucket['count'] += int(row['payment_count'])
+        bucket['amount'] = round(bucket['amount'] + float(row['total_amount']), 2)
+        status = bucket['by_status'].setdefault(row['status'], {'count': 0, 'amount': 0.0})
+        status['count'] += int(row['payment_count'])
+        status['amount'] = round(status['amount'] + float(row['total_amount']), 2)
+    return totals
+
+
+def read_stats(cursor, days=30):
+    """Stats payload for /api/payment/stats from the aggregate tables."""
+    cursor.execute("SELECT status, currency, payment_method, payment_count, total_amount FROM payment_totals "
+                   "WHERE payment_count <> 0")
+    rows = cursor.fetchall()
+
+    by_status = {}
+    for row in rows:
+        bucket = by_status.setdefault(row['status'], {'count': 0, 'amount': 0.0})
+        bucket['count'] += int(row['payment_count'])
+        bucket['amount'] = round(bucket['amount'] + float(row['total_amount']), 2)
+    completed = by_status.get('completed', {'count': 0, 'amount': 0.0})
+    failed = by_status.get('failed', {'count': 0})['count']
+    settled = completed['count'] + failed
+
+    cursor.execute("""SELECT day, status, SUM(payment_count) AS payment_count, SUM(total_amount) AS total_amount
+                      FROM payment_daily_totals
+                      WHERE day >= CURDATE() - INTERVAL %s DAY AND payment_count <> 0
+                      GROUP BY day, status ORDER BY day""", (max(days - 1, 0),))
+    daily = {}
+    for row in cursor.fetchall():
+        day = daily.setdefault(row['day'].isoformat(), {'day': row['day'].isoformat(), 'by_status': {}})
+        day['by_status'][row['status']] = {'count': int(row['payment_count']), 'amount': float(row['total_amount'])}
+
+    return {
+        # Kept from the original endpoint: completed payments only, all currencies
+        'total_payments': completed['count'],
+        'total_amount': completed['amount'],
+        'failure_rate': round(failed / settled, 4) if settled else 0,
+        'by_status': by_status,
+        'by_currency': _totals(rows, 'currency'),
+        'by_payment_method': _totals(rows, 'payment_method'),
+        'daily': list(daily.values())
+    }
+
+
+def main(argv):
+    if len(argv) != 2 or argv[1] not in ('verify', 'repair'):
+        print("usage: python aggregates.py verify|repair")
+        return 2
+
+    from dotenv import load_dotenv
+    # Same layout as app.py: shared code in src/common/, .env in the project root
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+    load_dotenv(os.path.join(os.path.dirname(__file__), '..', '..', '.env'))
+    from common.db import db_cursor
+
+    with db_cursor() as (conn, cursor):
+        if argv[1] == 'repair':
+            repair(conn, cursor)
+            print("✅ Payment aggregates rebuilt from payments")
+        mismatches = verify(cursor)
+    for mismatch in mismatches:
+        print(f"❌ {mismatch['table']} {mismatch['key']}: expected {mismatch['expected']}, stored {mismatch['stored']}")
+    if mismatches:
+        print(f"❌ {len(mismatches)} aggregate rows out of sync; run 'python aggregates.py repair'")
+        return 1
+    print("✅ Payment aggregates match payments")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
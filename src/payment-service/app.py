@@ -1,217 +1,329 @@
 from flask import Flask, jsonify, request
 from flask_cors import CORS
-import mysql.connector
+from werkzeug.exceptions import HTTPException
 import os
+import sys
 import secrets
 from dotenv import load_dotenv
 
-# Load .env from project root (two levels up from src/payment-service/)
+# Load .env from project root (two levels up from src/payment-service/) before
+# importing the modules below, which read their settings at import time
 load_dotenv(os.path.join(os.path.dirname(__file__), '..', '..', '.env'))
 
+# Shared modules live in src/common/ (one level up from src/payment-service/)
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from common.db import db_cursor, pool_stats
+from common.metrics import instrument_flask
+from common.tracing import trace_flask
+from common.logs import log_flask
+from common.pagination import KeysetQuery, PageArgumentError
+from common.row_stream import stream_format, stream_rows
+from aggregates import read_stats, record_new_payment, record_status_change
+from settlement import processor_from_env, queue_depth, settlement_from_env
+from idempotency import idempotency_from_env, mark_committed
+from bulk_charge import bulk_charger_from_env, read_charges
+
 app = Flask(__name__)
 CORS(app)
+# Per-route request and DB metrics on /metrics (see common/metrics.py)
+instrument_flask(app)
+# Request IDs and timing spans for sampled requests (see common/tracing.py)
+trace_flask(app, 'payment-service')
+# One JSON log line per request, written by a background thread (see common/logs.py)
+log_flask(app, 'payment-service')
 
-def get_db_connection():
-    db_host = os.getenv('DB_HOST')
-    db_port = os.getenv('DB_PORT')
-    db_user = os.getenv('DB_USER')
-    db_password = os.getenv('DB_PASSWORD')
-    db_name = os.getenv('DB_NAME')
-    
-    # Check if required variables exist (password can be empty string)
-    if not db_host or not db_port or not db_user or db_password is None or not db_name:
-        raise ValueError("Missing required database environment variables: DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME")
-    
-    return mysql.connector.connect(
-        host=db_host,
-        port=int(db_port),
-        user=db_user,
-        password=db_password,
-        database=db_name,
-        connection_timeout=5,
-        autocommit=False
-    )
+PAYMENTS = KeysetQuery(
+    'payments',
+    ['id', 'user_id', 'amount', 'currency', 'status', 'payment_method', 'transaction_id', 'created_at', 'updated_at'],
+    order=[('created_at', 'DESC'), ('id', 'DESC')]
+)
+# Per-user listing walks INDEX (user_id), which ends in the primary key
+USER_PAYMENTS = KeysetQuery('payments', PAYMENTS.columns, order=[('id', 'DESC')])
+
+# Charges are settled by background workers unless PAYMENT_SETTLEMENT=sync
+# (see settlement.py); in sync mode the workers still retry charges whose
+# processor call errored
+SETTLEMENT_MODE = os.getenv('PAYMENT_SETTLEMENT', 'async').lower()
+if SETTLEMENT_MODE not in ('async', 'sync'):
+    raise ValueError(f"Unknown PAYMENT_SETTLEMENT '{SETTLEMENT_MODE}' (expected 'async' or 'sync')")
+PROCESSOR = processor_from_env()
+SETTLEMENT = settlement_from_env(PROCESSOR)
+SETTLEMENT.start()
+
+# Charges sent with an Idempotency-Key run once per key (see idempotency.py)
+IDEMPOTENCY = idempotency_from_env()
+IDEMPOTENCY.start()
+# Billing runs charge many users per request (see bulk_charge.py)
+BULK_CHARGES = bulk_charger_from_env(PROCESSOR)
 
 @app.route('/')
 def home():
     return jsonify({
         'service': 'payment-service',
         'status': 'running',
-        'endpoints': ['/health', '/payments', '/api/payment/payments', '/api/payment/charge']
+        'endpoints': ['/health', '/metrics', '/payments', '/api/payment/payments', '/api/payment/charge',
+                      '/api/payment/charge/bulk', '/api/payment/settlement']
     })
 
 @app.route('/payments', methods=['GET'])
 def get_payments_simple():
     """Simple endpoint for dashboard"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM payments ORDER BY created_at DESC")
-        payments = cursor.fetchall()
-        return jsonify({'payments': payments}), 200
+        page = PAYMENTS.page(request.args)
+        fmt = stream_format(request)
+    except PageArgumentError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    try:
+        if fmt:
+            return stream_rows(page, 'payments', fmt)
+        with db_cursor(dictionary=True) as (conn, cursor):
+            payments, next_cursor = page.fetch(cursor)
+            return jsonify({'payments': payments, 'next_cursor': next_cursor}), 200
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
-    finally:
-        if 'cursor' in locals():
-            cursor.close()
-        if 'conn' in locals():
-            conn.close()
 
 @app.route('/health', methods=['GET'])
 def health():
-    return jsonify({'status': 'healthy', 'service': 'payment-service'}), 200
+    return jsonify({'status': 'healthy', 'service': 'payment-service', 'db_pool': pool_stats(),
+                    'settlement': SETTLEMENT.stats(), 'idempotency': IDEMPOTENCY.stats(),
+                    'bulk_charge': BULK_CHARGES.stats()}), 200
 
 @app.route('/api/payment/payments', methods=['GET'])
 def get_payments():
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM payments ORDER BY created_at DESC")
-        payments = cursor.fetchall()
-        return jsonify({'payments': payments}), 200
+        page = PAYMENTS.page(request.args)
+        fmt = stream_format(request)
+    except PageArgumentError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        if fmt:
+            return stream_rows(page, 'payments', fmt)
+        with db_cursor(dictionary=True) as (conn, cursor):
+            payments, next_cursor = page.fetch(cursor)
+            return jsonify({'payments': payments, 'next_cursor': next_cursor}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
-    finally:
-        if 'cursor' in locals():
-            cursor.close()
-        if 'conn' in locals():
-            conn.close()
 
 @app.route('/api/payment/payments/<int:payment_id>', methods=['GET'])
 def get_payment(payment_id):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM payments WHERE id = %s", (payment_id,))
-        payment = cursor.fetchone()
-        
-        if payment:
-            return jsonify({'success': True, 'payment': payment}), 200
-        else:
-            return jsonify({'success': False, 'message': 'Payment not found'}), 404
+        with db_cursor(dictionary=True) as (conn, cursor):
+            cursor.execute("SELECT * FROM payments WHERE id = %s", (payment_id,))
+            payment = cursor.fetchone()
+            
+            if payment:
+                return jsonify({'success': True, 'payment': payment}), 200
+            else:
+                return jsonify({'success': False, 'message': 'Payment not found'}), 404
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
-    finally:
-        if 'cursor' in locals():
-            cursor.close()
-        if 'conn' in locals():
-            conn.close()
 
 @app.route('/api/payment/payments/user/<int:user_id>', methods=['GET'])
 def get_user_payments(user_id):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM payments WHERE user_id = %s ORDER BY created_at DESC", (user_id,))
-        payments = cursor.fetchall()
-        return jsonify({'success': True, 'payments': payments}), 200
+        page = USER_PAYMENTS.page(request.args)
+        fmt = stream_format(request)
+    except PageArgumentError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    try:
+        if fmt:
+            return stream_rows(page, 'payments', fmt, "user_id = %s", (user_id,))
+        with db_cursor(dictionary=True) as (conn, cursor):
+            payments, next_cursor = page.fetch(cursor, "user_id = %s", (user_id,))
+            return jsonify({'success': True, 'payments': payments, 'next_cursor': next_cursor}), 200
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
-    finally:
-        if 'cursor' in locals():
-            cursor.close()
-        if 'conn' in locals():
-            conn.close()
 
 @app.route('/api/payment/charge', methods=['POST'])
 def create_payment():
+    # Parsed before the key is claimed: a malformed body is a 400 and leaves the key unused
     data = request.json
+    if not isinstance(data, dict):
+        return jsonify({'success': False, 'error': 'Expected a JSON object'}), 400
+    key = request.headers.get('Idempotency-Key')
+    if key is None:
+        return charge(data)
+    try:
+        # Retries with the same key get the first response back instead of a new payment
+        return IDEMPOTENCY.run(key, request.get_data(), lambda: charge(data))
+    except HTTPException:
+        raise
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+def charge(data):
     user_id = data.get('user_id')
     amount = data.get('amount')
     currency = data.get('currency', 'USD')  # Request parameter default
     payment_method = data.get('payment_method', 'credit_card')  # Request parameter default
+    committed = False
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Generate unique transaction ID
-        transaction_id = f"TXN{secrets.token_hex(8).upper()}"
-        
-        cursor.execute(
-            """INSERT INTO payments (user_id, amount, currency, status, payment_method, transaction_id) 
-               VALUES (%s, %s, %s, %s, %s, %s)""",
-            (user_id, amount, currency, 'pending', payment_method, transaction_id)
-        )
-        conn.commit()
-        payment_id = cursor.lastrowid
-        
-        # Simulate payment processing
-        import random
-        success = random.choice([True, True, True, False])  # 75% success rate
-        
-        status = 'completed' if success else 'failed'
-        cursor.execute("UPDATE payments SET status = %s WHERE id = %s", (status, payment_id))
-        conn.commit()
-        
-        return jsonify({
-            'success': success,
-            'message': f'Payment {status}',
-            'payment_id': payment_id,
-            'transaction_id': transaction_id,
-            'status': status
-        }), 201 if success else 402
+        with db_cursor() as (conn, cursor):
+            
+            # Generate unique transaction ID
+            transaction_id = f"TXN{secrets.token_hex(8).upper()}"
+            
+            # In sync mode this request holds the settlement claim while it
+            # calls the processor, so the background workers leave it alone
+            claim = (SETTLEMENT.owner, SETTLEMENT.lease) if SETTLEMENT_MODE == 'sync' else (None, None)
+            cursor.execute(
+                """INSERT INTO payments (user_id, amount, currency, status, payment_method, transaction_id,
+                                         claimed_by, claimed_until)
+                   VALUES (%s, %s, %s, %s, %s, %s, %s, NOW() + INTERVAL %s SECOND)""",
+                (user_id, amount, currency, 'pending', payment_method, transaction_id) + claim
+            )
+            payment_id = cursor.lastrowid
+            record_new_payment(cursor, payment_id, 'pending')
+            # From here on a retry with the same Idempotency-Key replays this response
+            mark_committed(cursor)
+            conn.commit()
+            committed = True
+            
+            if SETTLEMENT_MODE == 'async':
+                SETTLEMENT.notify()
+                status_url = f'/api/payment/payments/{payment_id}'
+                return jsonify({
+                    'success': True,
+                    'message': 'Payment accepted',
+                    'payment_id': payment_id,
+                    'transaction_id': transaction_id,
+                    'status': 'pending',
+                    'status_url': status_url
+                }), 202, {'Location': status_url}
+            
+            # On the settlement pool, which renews our claim while the processor call runs
+            [(_, status)] = SETTLEMENT.process([{
+                'id': payment_id,
+                'user_id': user_id,
+                'amount': amount,
+                'currency': currency,
+                'payment_method': payment_method,
+                'transaction_id': transaction_id
+            }])
+            if status is None:
+                # Released to the background workers, which retry it after SETTLEMENT_RETRY_DELAY
+                SETTLEMENT.release(cursor, [payment_id])
+                conn.commit()
+                return jsonify({
+                    'success': False,
+                    'message': 'Payment processor unavailable',
+                    'payment_id': payment_id,
+                    'transaction_id': transaction_id,
+                    'status': 'pending'
+                }), 503
+            success = status == 'completed'
+            cursor.execute(
+                """UPDATE payments SET status = %s, claimed_by = NULL, claimed_until = NULL
+                   WHERE id = %s AND status = 'pending' AND claimed_by = %s""",
+                (status, payment_id, SETTLEMENT.owner)
+            )
+            if cursor.rowcount == 0:
+                # Our claim lapsed and a settlement worker owns the payment now:
+                # its outcome is the one recorded, so report it as still pending
+                conn.commit()
+                status_url = f'/api/payment/payments/{payment_id}'
+                return jsonify({
+                    'success': True,
+                    'message': 'Payment accepted',
+                    'payment_id': payment_id,
+                    'transaction_id': transaction_id,
+                    'status': 'pending',
+                    'status_url': status_url
+                }), 202, {'Location': status_url}
+            record_status_change(cursor, payment_id, 'pending', status)
+            conn.commit()
+            
+            return jsonify({
+                'success': success,
+                'message': f'Payment {status}',
+                'payment_id': payment_id,
+                'transaction_id': transaction_id,
+                'status': status
+            }), 201 if success else 402
+    except Exception as e:
+        body = {'success': False, 'error': str(e)}
+        if committed:
+            # The payment exists (and settlement will finish it), so say which one
+            body.update({'payment_id': payment_id, 'transaction_id': transaction_id})
+        return jsonify(body), 500
+
+@app.route('/api/payment/charge/bulk', methods=['POST'])
+def create_payments_bulk():
+    """Charge many users in one request; each item gets its own result (see bulk_charge.py)"""
+    try:
+        items = read_charges(request)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    if len(items) > BULK_CHARGES.max_items:
+        return jsonify({'success': False,
+                        'error': f'At most {BULK_CHARGES.max_items} charges per request'}), 413
+    key = request.headers.get('Idempotency-Key')
+    try:
+        if key is None:
+            return charge_bulk(items)
+        return IDEMPOTENCY.run(key, request.get_data(), lambda: charge_bulk(items))
+    except HTTPException:
+        raise
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
-    finally:
-        if 'cursor' in locals():
-            cursor.close()
-        if 'conn' in locals():
-            conn.close()
+
+def charge_bulk(items):
+    results = BULK_CHARGES.run(items)
+    counts = {}
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+    return jsonify({'success': True, 'total': len(results), 'counts': counts, 'results': results}), 200
 
 @app.route('/api/payment/refund/<int:payment_id>', methods=['POST'])
 def refund_payment(payment_id):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        
-        cursor.execute("SELECT * FROM payments WHERE id = %s", (payment_id,))
-        payment = cursor.fetchone()
-        
-        if not payment:
-            return jsonify({'success': False, 'message': 'Payment not found'}), 404
-        
-        if payment['status'] != 'completed':
-            return jsonify({'success': False, 'message': 'Cannot refund non-completed payment'}), 400
-        
-        cursor.execute("UPDATE payments SET status = %s WHERE id = %s", ('refunded', payment_id))
-        conn.commit()
-        
-        return jsonify({
-            'success': True,
-            'message': 'Payment refunded successfully',
-            'payment_id': payment_id
-        }), 200
+        with db_cursor(dictionary=True) as (conn, cursor):
+            
+            # Lock the row so two refunds can't both move it out of 'completed'
+            cursor.execute("SELECT * FROM payments WHERE id = %s FOR UPDATE", (payment_id,))
+            payment = cursor.fetchone()
+            
+            if not payment:
+                return jsonify({'success': False, 'message': 'Payment not found'}), 404
+            
+            if payment['status'] != 'completed':
+                return jsonify({'success': False, 'message': 'Cannot refund non-completed payment'}), 400
+            
+            cursor.execute("UPDATE payments SET status = %s WHERE id = %s", ('refunded', payment_id))
+            record_status_change(cursor, payment_id, 'completed', 'refunded')
+            conn.commit()
+            
+            return jsonify({
+                'success': True,
+                'message': 'Payment refunded successfully',
+                'payment_id': payment_id
+            }), 200
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/payment/settlement', methods=['GET'])
+def get_settlement_status():
+    """Settlement queue depth plus this instance's worker counters and latencies"""
+    try:
+        with db_cursor() as (conn, cursor):
+            queue = queue_depth(cursor)
+        return jsonify({'success': True, 'mode': SETTLEMENT_MODE, 'queue': queue, 'workers': SETTLEMENT.stats()}), 200
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
-    finally:
-        if 'cursor' in locals():
-            cursor.close()
-        if 'conn' in locals():
-            conn.close()
 
 @app.route('/api/payment/stats', methods=['GET'])
 def get_stats():
+    """Totals from the running aggregates (see aggregates.py); ?days= sets the daily window"""
+    try:
+        days = min(max(int(request.args.get('days', '30')), 1), 366)
+    except ValueError:
+        return jsonify({'success': False, 'error': 'days must be an integer'}), 400
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT COUNT(*) as total_payments, SUM(amount) as total_amount FROM payments WHERE status = 'completed'")
-        stats = cursor.fetchone()
-        
-        return jsonify({
-            'success': True,
-            'stats': {
-                'total_payments': stats['total_payments'],
-                'total_amount': float(stats['total_amount']) if stats['total_amount'] else 0
-            }
-        }), 200
+        with db_cursor(dictionary=True) as (conn, cursor):
+            return jsonify({'success': True, 'stats': read_stats(cursor, days)}), 200
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
-    finally:
-        if 'cursor' in locals():
-            cursor.close()
-        if 'conn' in locals():
-            conn.close()
 
 if __name__ == '__main__':
     host = os.getenv('PAYMENT_SERVICE_HOST', '0.0.0.0')
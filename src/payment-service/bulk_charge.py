@@ -0,0 +1,214 @@
+"""Bulk charges for billing runs.
+
+``POST /api/payment/charge/bulk`` takes a JSON array (or ``{"charges":
+[...]}``) of ``{"user_id", "amount", "currency", "payment_method"}`` items.
+They are handled PAYMENT_BULK_BATCH_SIZE at a time: transaction ids are
+generated for the whole batch at once, the payments go in with one multi-row
+INSERT and one commit, the processor calls run concurrently on a dedicated
+settlement pool and the outcomes are written back with one UPDATE per status
+(see ``SettlementWorkers.write_results``).
+
+Items succeed or fail on their own; every item gets one result, in order:
+
+    completed / failed  charged or declined; carries ``payment_id`` and ``transaction_id``
+    pending             stored, but the processor errored; background settlement retries it
+    invalid             bad fields or unknown user; nothing was stored
+    error               its batch could not be stored (e.g. database error); safe to resend
+
+With an Idempotency-Key, every batch checks in its own transaction that the
+request still holds the key (``mark_committed``); if it was taken over, the
+run stops with ``ClaimLost`` before storing anything more.
+
+Tuning (all optional):
+    PAYMENT_BULK_BATCH_SIZE  charges per INSERT/transaction (default 500)
+    PAYMENT_BULK_MAX_ITEMS   charges accepted per request (default 10000)
+    PAYMENT_BULK_WORKERS     concurrent processor calls for bulk requests (default 16)
+"""
+import logging
+import os
+import secrets
+import threading
+import time
+from decimal import Decimal, InvalidOperation
+
+from common.db import db_cursor, placeholders
+from aggregates import apply_delta
+from settlement import SettlementWorkers
+from idempotency import ClaimLost, mark_committed
+
+log = logging.getLogger(__name__)
+
+MAX_AMOUNT = Decimal('99999999.99')  # DECIMAL(10, 2)
+# Column widths of payments.currency and payments.payment_method
+TEXT_FIELDS = (('currency', 'USD', 10), ('payment_method', 'credit_card', 50))
+
+INSERT_SQL = """INSERT INTO payments (user_id, amount, currency, status, payment_method, transaction_id,
+                                      claimed_by, claimed_until)
+                VALUES (%s, %s, %s, 'pending', %s, %s, %s, NOW() + INTERVAL %s SECOND)"""
+
+
+def transaction_ids(count):
+    """``count`` unique-enough transaction ids from a single call into the OS random source."""
+    raw = secrets.token_hex(8 * count).upper()
+    return [f"TXN{raw[i * 16:(i + 1) * 16]}" for i in range(count)]
+
+
+def read_charges(req):
+    """The uploaded charge items, or ``ValueError`` for a body that isn't a list of charges."""
+    data = req.get_json(silent=True)
+    if isinstance(data, dict):
+        data = data.get('charges')
+    if not isinstance(data, list):
+        raise ValueError("Expected a JSON array of charges or {\"charges\": [...]}")
+    return data
+
+
+def _validate(item):
+    """``(user_id, amount, currency, payment_method)`` for a well-formed item, else an error message."""
+    if not isinstance(item, dict):
+        return "Item is not a JSON object"
+    user_id = item.get('user_id')
+    if isinstance(user_id, bool) or not isinstance(user_id, (int, str)):
+        return "user_id is required"
+    try:
+        user_id = int(user_id)
+    except ValueError:
+        return "user_id must be an integer"
+    amount = item.get('amount')
+    if isinstance(amount, bool) or not isinstance(amount, (int, float, str)):
+        return "amount is required"
+    try:
+        amount = Decimal(str(amount))
+    except InvalidOperation:
+        return "amount must be a number"
+    if not amount.is_finite() or amount <= 0 or amount > MAX_AMOUNT or amount != amount.quantize(Decimal('0.01')):
+        return f"amount must be between 0.01 and {MAX_AMOUNT} with at most two decimals"
+    # Checked here so one bad value can't fail the multi-row INSERT of its whole batch
+    texts = []
+    for field, default, width in TEXT_FIELDS:
+        value = item.get(field, default)
+        if not isinstance(value, str) or not 1 <= len(value) <= width:
+            return f"{field} must be a string of 1-{width} characters"
+        texts.append(value)
+    return (user_id, amount) + tuple(texts)
+
+
+class BulkCharger:
+    """Stores and settles bulk charge requests batch by batch."""
+
+    def __init__(self, processor, batch_size=500, max_items=10000, workers=16, lease=300, retry_delay=5):
+        self.batch_size = batch_size
+        self.max_items = max_items
+        # Never started: only its pool and write-back are used, for payments
+        # claimed at insert time so background settlement leaves them alone
+        self.settlement = SettlementWorkers(processor, workers=workers, batch_size=batch_size,
+                                            lease=lease, retry_delay=retry_delay)
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0, 'items': 0, 'seconds': 0.0}
+
+    def run(self, items):
+        """Charge ``items``; returns one result dict per item, in order."""
+        started = time.perf_counter()
+        results = [None] * len(items)
+        for start in range(0, len(items), self.batch_size):
+            self._run_batch(items, start, results)
+        with self._lock:
+            self._stats['requests'] += 1
+            self._stats['items'] += len(items)
+            self._stats['seconds'] += time.perf_counter() - started
+        return results
+
+    def _run_batch(self, items, start, results):
+        rows = []
+        for index in range(start, min(start + self.batch_size, len(items))):
+            parsed = _validate(items[index])
+            if isinstance(parsed, str):
+                results[index] = {'index': index, 'status': 'invalid', 'error': parsed}
+            else:
+                rows.append((index, parsed))
+        if not rows:
+            return
+
+        try:
+            payments = self._insert(rows, results)
+        except ClaimLost:
+            # Another request owns the Idempotency-Key now: stop the whole run
+            raise
+        except Exception as e:
+            log.error("Bulk charge batch at item %d failed: %s", start, e)
+            for index, _ in rows:
+                results[index] = {'index': index, 'status': 'error', 'error': str(e)}
+            return
+
+        settled = {}
+        try:
+            outcomes = self.settlement.process([payment for _, payment in payments])
+            settled = {payment['id']: status for payment, status in self.settlement.write_results(outcomes)}
+        except Exception as e:
+            # Stored and claimed: background settlement picks these up once the claim expires
+            log.error("Bulk charge settlement at item %d failed: %s", start, e)
+        for index, payment in payments:
+            results[index] = {
+                'index': index,
+                'status': settled.get(payment['id'], 'pending'),
+                'payment_id': payment['id'],
+                'transaction_id': payment['transaction_id']
+            }
+
+    def _insert(self, rows, results):
+        """Insert the valid rows of one batch; returns ``[(index, payment)]`` for those stored."""
+        # The connection goes back to the pool before the processor calls
+        with db_cursor() as (conn, cursor):
+            user_ids = sorted({row[0] for _, row in rows})
+            cursor.execute(f"SELECT id FROM auth_users WHERE id IN ({placeholders(user_ids)})", user_ids)
+            users = {row[0] for row in cursor.fetchall()}
+
+            pending = []
+            for index, row in rows:
+                if row[0] in users:
+                    pending.append((index, row))
+                else:
+                    results[index] = {'index': index, 'status': 'invalid', 'error': f"User {row[0]} not found"}
+            if not pending:
+                return []
+
+            owner, lease = self.settlement.owner, self.settlement.lease
+            txns = transaction_ids(len(pending))
+            # mysql-connector turns this into a single multi-row INSERT
+            cursor.executemany(INSERT_SQL, [(row[0], row[1], row[2], row[3], txn, owner, lease)
+                                            for (_, row), txn in zip(pending, txns)])
+            cursor.execute(f"SELECT id, transaction_id FROM payments WHERE transaction_id IN ({placeholders(txns)})", txns)
+            ids = {txn: payment_id for payment_id, txn in cursor.fetchall()}
+            apply_delta(cursor, sorted(ids.values()), 'pending', 1)
+            mark_committed(cursor)
+            conn.commit()
+
+        accepted_at = time.time()
+        return [(index, {
+            'id': ids[txn],
+            'user_id': row[0],
+            'amount': row[1],
+            'currency': row[2],
+            'payment_method': row[3],
+            'transaction_id': txn,
+            'accepted_at': accepted_at
+        }) for (index, row), txn in zip(pending, txns)]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['charges_per_second'] = round(stats['items'] / stats['seconds'], 1) if stats['seconds'] else 0
+        stats['seconds'] = round(stats['seconds'], 3)
+        stats['settlement'] = self.settlement.stats()
+        return stats
+
+
+def bulk_charger_from_env(processor):
+    return BulkCharger(
+        processor,
+        batch_size=int(os.getenv('PAYMENT_BULK_BATCH_SIZE', '500')),
+        max_items=int(os.getenv('PAYMENT_BULK_MAX_ITEMS', '10000')),
+        workers=int(os.getenv('PAYMENT_BULK_WORKERS', '16')),
+        lease=int(os.getenv('SETTLEMENT_LEASE', '300')),
+        retry_delay=int(os.getenv('SETTLEMENT_RETRY_DELAY', '5'))
+    )
@@ -0,0 +1,335 @@
+"""Idempotency-Key support for POST endpoints.
+
+The first request with a given key claims it by inserting a row in
+``payment_idempotency_keys``; when it finishes, its response (status, body,
+Location) is stored on that row and in a small in-memory LRU. A retry with
+the same key gets the stored response back (``Idempotent-Replayed: true``)
+without running the handler or touching payments.
+
+Concurrent duplicates don't race the original: in the same process they wait
+on it directly; on another replica they poll the key row. If the original
+is still running after IDEMPOTENCY_WAIT seconds the duplicate gets 409.
+
+A claim is a lease (``locked_until``) that a heartbeat thread renews every
+third of IDEMPOTENCY_LOCK_TIMEOUT for as long as its request runs, however
+long that is; only a claim whose lease ran out (the replica died) may be
+taken over. Handlers call ``mark_committed(cursor)`` inside the transaction
+that writes payments: that flags the key row in the same commit, so a claim
+that has written payments is never taken over, and it raises ``ClaimLost``
+(rolling the payments back) if the claim was taken over already.
+
+Reusing a key with a different request body is answered 422. A 500 (or an
+exception) releases the key instead of storing it, so the client may retry,
+but only if the handler hadn't written payments yet; after that a failure
+is stored as a 500 and replayed like any other response.
+
+Tuning (all optional):
+    IDEMPOTENCY_KEY_TTL       seconds a key is remembered (default 86400)
+    IDEMPOTENCY_CACHE_SIZE    recent keys kept in memory (default 10000)
+    IDEMPOTENCY_WAIT          seconds a duplicate waits for the original request (default 10)
+    IDEMPOTENCY_LOCK_TIMEOUT  seconds a claim outlives its last heartbeat (default 60)
+"""
+import hashlib
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+import mysql.connector
+from flask import Response, g, has_request_context, jsonify, make_response
+
+from common.db import db_cursor, placeholders
+
+MAX_KEY_LENGTH = 191
+DUPLICATE_KEY = 1062
+POLL_INTERVAL = 0.1
+PURGE_INTERVAL = 60
+
+log = logging.getLogger(__name__)
+
+
+class ClaimLost(Exception):
+    """The request's claim on its key was taken over, so it must not write payments."""
+
+
+def mark_committed(cursor):
+    """Flag the running request's key as having written payments; call before committing them."""
+    claim = g.get('idempotency_claim') if has_request_context() else None
+    if claim is None:
+        return
+    key, token = claim
+    cursor.execute("SELECT claim_token FROM payment_idempotency_keys WHERE idempotency_key = %s FOR UPDATE", (key,))
+    row = cursor.fetchone()
+    if row is None or row[0] != token:
+        raise ClaimLost(f"Idempotency-Key {key} was claimed by another request")
+    cursor.execute("UPDATE payment_idempotency_keys SET payments_written = TRUE WHERE idempotency_key = %s", (key,))
+    # Set before the commit: if the commit fails we can't tell whether it
+    # went through, so the key is kept rather than released either way
+    g.idempotency_committed = True
+
+
+class StoredResponse:
+    __slots__ = ('request_hash', 'status', 'body', 'location', 'expires_at')
+
+    def __init__(self, request_hash, status, body, location, expires_at):
+        self.request_hash = request_hash
+        self.status = status
+        self.body = body
+        self.location = location
+        self.expires_at = expires_at
+
+
+class IdempotencyStore:
+    """Runs a handler at most once per key and replays its response afterwards."""
+
+    def __init__(self, ttl=86400, cache_size=10000, wait_timeout=10.0, lock_timeout=60):
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.wait_timeout = wait_timeout
+        self.lock_timeout = lock_timeout
+        self._recent = OrderedDict()
+        self._in_flight = {}
+        # Claim tokens of the keys this process is running, renewed by the heartbeat
+        self._held = {}
+        self._thread = None
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        self._stats = {
+            'requests': 0,
+            'memory_hits': 0,
+            'db_hits': 0,
+            'waited': 0,
+            'in_progress': 0,
+            'mismatches': 0,
+            'stored': 0,
+            'released': 0,
+            'abandoned': 0,
+            'heartbeat_errors': 0
+        }
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._heartbeat, name='idempotency-heartbeat', daemon=True)
+            self._thread.start()
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(self.lock_timeout / 3)
+            with self._lock:
+                tokens = list(self._held.values())
+            if not tokens:
+                continue
+            try:
+                with db_cursor() as (conn, cursor):
+                    cursor.execute(
+                        f"""UPDATE payment_idempotency_keys SET locked_until = NOW() + INTERVAL %s SECOND
+                            WHERE claim_token IN ({placeholders(tokens)}) AND response_status IS NULL""",
+                        [self.lock_timeout] + tokens
+                    )
+                    conn.commit()
+            except Exception as e:
+                self._count('heartbeat_errors')
+                log.warning("Idempotency claim heartbeat failed: %s", e)
+
+    def run(self, key, payload, handler):
+        """Response for this request: the handler's, or the stored one for a repeated key."""
+        if not key or len(key) > MAX_KEY_LENGTH:
+            return jsonify({'success': False, 'error': f'Idempotency-Key must be 1-{MAX_KEY_LENGTH} characters'}), 400
+        self._count('requests')
+        request_hash = hashlib.sha256(payload).hexdigest()
+        deadline = time.monotonic() + self.wait_timeout
+
+        while True:
+            stored = self._remembered(key)
+            if stored is not None:
+                self._count('memory_hits')
+                return self._replay(stored, request_hash)
+
+            with self._lock:
+                event = self._in_flight.get(key)
+                if event is None:
+                    self._in_flight[key] = threading.Event()
+            if event is None:
+                break
+            # Same key already running in this process: wait for it, then
+            # replay its response (or take over if it wasn't stored)
+            self._count('waited')
+            if not event.wait(max(0.0, deadline - time.monotonic())):
+                return self._busy()
+
+        try:
+            return self._run_owned(key, request_hash, handler, deadline)
+        finally:
+            with self._lock:
+                event = self._in_flight.pop(key)
+            event.set()
+
+    def _run_owned(self, key, request_hash, handler, deadline):
+        token = secrets.token_hex(16)
+        while True:
+            stored = self._claim(key, request_hash, token)
+            if stored is None:
+                break
+            if stored.expires_at is None:
+                # Its replica died after writing payments: never run it again
+                self._count('abandoned')
+                return self._replay(stored, request_hash)
+            if stored.status is not None:
+                self._count('db_hits')
+                self._remember(key, stored)
+                return self._replay(stored, request_hash)
+            # Claimed by another replica that hasn't finished yet
+            if time.monotonic() >= deadline:
+                return self._busy()
+            time.sleep(POLL_INTERVAL)
+
+        with self._lock:
+            self._held[key] = token
+        try:
+            return self._run_claimed(key, token, request_hash, handler)
+        finally:
+            with self._lock:
+                del self._held[key]
+
+    def _run_claimed(self, key, token, request_hash, handler):
+        g.idempotency_claim = (key, token)
+        g.idempotency_committed = False
+        try:
+            response = make_response(handler())
+        except Exception as e:
+            if not g.idempotency_committed:
+                self._release(key, token)
+                raise
+            # Payments were written: a retry must get this back rather than write them again
+            response = make_response(jsonify({'success': False, 'error': str(e)}), 500)
+        if response.status_code == 500 and not g.idempotency_committed:
+            self._release(key, token)
+            return response
+
+        stored = StoredResponse(request_hash, response.status_code, response.get_data(as_text=True),
+                                response.headers.get('Location'), time.time() + self.ttl)
+        # If this fails after payments were written the row keeps its flag, so
+        # the key is never taken over once its lease runs out
+        with db_cursor() as (conn, cursor):
+            cursor.execute(
+                """UPDATE payment_idempotency_keys
+                   SET response_status = %s, response_body = %s, response_location = %s
+                   WHERE idempotency_key = %s AND claim_token = %s""",
+                (stored.status, stored.body, stored.location, key, token)
+            )
+            conn.commit()
+        self._count('stored')
+        self._remember(key, stored)
+        return response
+
+    def _claim(self, key, request_hash, token):
+        """``None`` if we now own the key, else what the row holds (status ``None`` = still running,
+        ``expires_at`` ``None`` = abandoned after writing payments, answered 500 but not cached)."""
+        with db_cursor() as (conn, cursor):
+            self._purge_expired(conn, cursor)
+            # A claim is only abandoned once its heartbeat stopped, and never
+            # once its request wrote payments
+            cursor.execute(
+                """DELETE FROM payment_idempotency_keys WHERE idempotency_key = %s AND (expires_at < NOW()
+                   OR (response_status IS NULL AND NOT payments_written AND locked_until < NOW()))""",
+                (key,)
+            )
+            try:
+                cursor.execute(
+                    """INSERT INTO payment_idempotency_keys (idempotency_key, request_hash, claim_token, locked_until, expires_at)
+                       VALUES (%s, %s, %s, NOW() + INTERVAL %s SECOND, NOW() + INTERVAL %s SECOND)""",
+                    (key, request_hash, token, self.lock_timeout, self.ttl)
+                )
+                conn.commit()
+                return None
+            except mysql.connector.IntegrityError as e:
+                if e.errno != DUPLICATE_KEY:
+                    raise
+                conn.rollback()
+            cursor.execute(
+                """SELECT request_hash, response_status, response_body, response_location, UNIX_TIMESTAMP(expires_at),
+                          payments_written AND locked_until < NOW() FROM payment_idempotency_keys WHERE idempotency_key = %s""",
+                (key,)
+            )
+            row = cursor.fetchone()
+        if row is None:
+            # Released or expired between our INSERT and SELECT: try again
+            return StoredResponse(request_hash, None, None, None, 0)
+        if row[1] is None and row[5]:
+            body = {'success': False,
+                    'error': 'The request with this Idempotency-Key stopped after writing payments; look them up instead of retrying'}
+            return StoredResponse(row[0], 500, json.dumps(body), None, None)
+        return StoredResponse(row[0], row[1], row[2], row[3], float(row[4]))
+
+    def _release(self, key, token):
+        """Forget a key whose request failed so the client can retry it."""
+        with db_cursor() as (conn, cursor):
+            cursor.execute("""DELETE FROM payment_idempotency_keys
+                              WHERE idempotency_key = %s AND claim_token = %s AND response_status IS NULL""",
+                           (key, token))
+            conn.commit()
+        self._count('released')
+
+    def _purge_expired(self, conn, cursor):
+        now = time.monotonic()
+        if now - self._last_purge < PURGE_INTERVAL:
+            return
+        self._last_purge = now
+        # Small batches keep the purge from holding locks for long (INDEX (expires_at))
+        cursor.execute("DELETE FROM payment_idempotency_keys WHERE expires_at < NOW() LIMIT 1000")
+        conn.commit()
+
+    def _remembered(self, key):
+        with self._lock:
+            stored = self._recent.get(key)
+            if stored is None:
+                return None
+            if stored.expires_at <= time.time():
+                del self._recent[key]
+                return None
+            self._recent.move_to_end(key)
+            return stored
+
+    def _remember(self, key, stored):
+        with self._lock:
+            self._recent[key] = stored
+            self._recent.move_to_end(key)
+            while len(self._recent) > self.cache_size:
+                self._recent.popitem(last=False)
+
+    def _replay(self, stored, request_hash):
+        if stored.request_hash != request_hash:
+            self._count('mismatches')
+            return jsonify({'success': False, 'error': 'Idempotency-Key was already used with a different request'}), 422
+        headers = {'Idempotent-Replayed': 'true'}
+        if stored.location:
+            headers['Location'] = stored.location
+        return Response(stored.body, status=stored.status, headers=headers, mimetype='application/json')
+
+    def _busy(self):
+        self._count('in_progress')
+        return jsonify({'success': False, 'error': 'A request with this Idempotency-Key is still in progress'}), 409, \
+            {'Retry-After': '1'}
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['cached_keys'] = len(self._recent)
+            stats['in_flight'] = len(self._in_flight)
+        return stats
+
+
+def idempotency_from_env():
+    return IdempotencyStore(
+        ttl=int(os.getenv('IDEMPOTENCY_KEY_TTL', '86400')),
+        cache_size=int(os.getenv('IDEMPOTENCY_CACHE_SIZE', '10000')),
+        wait_timeout=float(os.getenv('IDEMPOTENCY_WAIT', '10')),
+        lock_timeout=int(os.getenv('IDEMPOTENCY_LOCK_TIMEOUT', '60'))
+    )
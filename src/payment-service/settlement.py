@@ -0,0 +1,286 @@
+"""Background settlement of pending payments.
+
+``/api/payment/charge`` only records the payment as ``pending`` and answers
+202. A dispatcher thread claims pending payments in batches (a short lease
+in ``claimed_by``/``claimed_until``, taken with ``FOR UPDATE SKIP LOCKED`` so
+several service replicas can share the queue), runs them through the
+payment processor on a worker pool and writes the outcomes back with one
+UPDATE per resulting status. While a batch's processor calls run, the lease
+on the payments still being charged is renewed every third of
+SETTLEMENT_LEASE, so a slow batch is never handed to another worker
+mid-charge. Payments whose processor call raised are released and retried
+after SETTLEMENT_RETRY_DELAY seconds.
+
+With PAYMENT_SETTLEMENT=sync the request charges the payment itself through
+``process()`` while holding its claim (renewed the same way), and writes the
+outcome only if it still holds it. The workers only see the payments it
+released after a processor error, or whose request died before settling them.
+
+The processor is pluggable: anything with ``charge(payment) -> bool``
+(``payment`` is a dict of the row's columns). PAYMENT_PROCESSOR=fake (the
+default) uses :class:`FakeProcessor`; ``module:Class`` loads another one.
+
+Tuning (all optional):
+    PAYMENT_SETTLEMENT            "async" (default) or "sync" to settle inside the request
+    SETTLEMENT_WORKERS            concurrent processor calls (default 4)
+    SETTLEMENT_BATCH_SIZE         payments claimed per pass (default 20)
+    SETTLEMENT_POLL_INTERVAL      seconds between passes when the queue is empty (default 0.5)
+    SETTLEMENT_LEASE              seconds a claim is held before others may retry it (default 300)
+    SETTLEMENT_RETRY_DELAY        seconds before a payment whose processor call failed is retried (default 5)
+    FAKE_PROCESSOR_LATENCY        average seconds per fake processor call (default 0)
+    FAKE_PROCESSOR_FAILURE_RATE   share of fake charges declined (default 0.25)
+"""
+import importlib
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from common.db import db_cursor, placeholders
+from common.latency import LatencyWindow
+from aggregates import record_status_changes
+
+log = logging.getLogger(__name__)
+
+# Columns handed to the processor
+PAYMENT_COLUMNS = 'id, user_id, amount, currency, payment_method, transaction_id'
+
+
+class FakeProcessor:
+    """Local stand-in for a card processor: waits about ``latency`` seconds and
+    declines ``failure_rate`` of charges."""
+
+    def __init__(self, latency=0.0, failure_rate=0.25):
+        self.latency = latency
+        self.failure_rate = failure_rate
+
+    def charge(self, payment):
+        if self.latency:
+            time.sleep(random.uniform(0.5, 1.5) * self.latency)
+        return random.random() >= self.failure_rate
+
+
+def processor_from_env():
+    name = os.getenv('PAYMENT_PROCESSOR', 'fake')
+    if name == 'fake':
+        return FakeProcessor(
+            latency=float(os.getenv('FAKE_PROCESSOR_LATENCY', '0')),
+            failure_rate=float(os.getenv('FAKE_PROCESSOR_FAILURE_RATE', '0.25'))
+        )
+    module_name, _, class_name = name.partition(':')
+    if not class_name:
+        raise ValueError(f"Unknown PAYMENT_PROCESSOR '{name}' (expected 'fake' or 'module:Class')")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+def charge_status(processor, payment):
+    """'completed' or 'failed', or ``None`` when the processor errored and the charge should be retried."""
+    try:
+        return 'completed' if processor.charge(payment) else 'failed'
+    except Exception as e:
+        log.warning("Processor error for payment %s: %s", payment.get('id'), e)
+        return None
+
+
+class SettlementWorkers:
+    """Claims pending payments in batches and settles them on a thread pool."""
+
+    def __init__(self, processor, workers=4, batch_size=20, poll_interval=0.5, lease=300, retry_delay=5):
+        self.processor = processor
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.retry_delay = retry_delay
+        self.owner = f"{socket.gethostname()}-{os.getpid()}"
+
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='settlement')
+        self._thread = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._stats = {
+            'batches': 0,
+            'claimed': 0,
+            'completed': 0,
+            'failed': 0,
+            'retried': 0,
+            'lost_claims': 0,
+            'errors': 0
+        }
+        # Processor call time, and accepted-to-settled time per payment
+        self._processor_latency = LatencyWindow()
+        self._settlement_latency = LatencyWindow()
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='settlement-dispatcher', daemon=True)
+            self._thread.start()
+            log.info("Settlement workers started (%d workers, batches of %d)", self.workers, self.batch_size)
+
+    def notify(self):
+        """A payment was just accepted: start the next pass now instead of at the next poll."""
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            try:
+                claimed = self.run_once()
+            except Exception as e:
+                self._count('errors')
+                log.error("Settlement pass failed: %s", e)
+                # Don't spin against a database that is down
+                time.sleep(max(self.poll_interval, self.retry_delay))
+                continue
+            # A full batch means there is probably more waiting
+            if claimed < self.batch_size:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def run_once(self):
+        """Claim, process and write back one batch; returns how many payments were claimed."""
+        payments = self.claim()
+        if payments:
+            self.write_results(self.process(payments))
+        return len(payments)
+
+    def claim(self):
+        with db_cursor(dictionary=True) as (conn, cursor):
+            cursor.execute(
+                f"""SELECT {PAYMENT_COLUMNS}, UNIX_TIMESTAMP(created_at) AS accepted_at FROM payments
+                    WHERE status = 'pending' AND (claimed_until IS NULL OR claimed_until < NOW())
+                    ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED""",
+                (self.batch_size,)
+            )
+            payments = cursor.fetchall()
+            if payments:
+                ids = [payment['id'] for payment in payments]
+                cursor.execute(
+                    f"UPDATE payments SET claimed_by = %s, claimed_until = NOW() + INTERVAL %s SECOND WHERE id IN ({placeholders(ids)})",
+                    [self.owner, self.lease] + ids
+                )
+            conn.commit()
+        if payments:
+            self._count('batches')
+            self._count('claimed', len(payments))
+        return payments
+
+    def process(self, payments):
+        """Run the processor for each payment concurrently; returns ``[(payment, status)]``."""
+        futures = [self._executor.submit(self._charge, payment) for payment in payments]
+        while True:
+            _, running = wait(futures, timeout=self.lease / 3)
+            if not running:
+                break
+            self.renew([payment['id'] for payment, future in zip(payments, futures) if future in running])
+        return [(payment, future.result()) for payment, future in zip(payments, futures)]
+
+    def renew(self, ids):
+        """Extend our lease on payments whose processor calls are still running."""
+        try:
+            with db_cursor() as (conn, cursor):
+                cursor.execute(
+                    f"""UPDATE payments SET claimed_until = NOW() + INTERVAL %s SECOND
+                        WHERE id IN ({placeholders(ids)}) AND status = 'pending' AND claimed_by = %s""",
+                    [self.lease] + ids + [self.owner]
+                )
+                conn.commit()
+        except Exception as e:
+            self._count('errors')
+            log.error("Settlement lease renewal failed: %s", e)
+
+    def _charge(self, payment):
+        with self._lock:
+            self._in_flight += 1
+        started = time.perf_counter()
+        try:
+            return charge_status(self.processor, payment)
+        finally:
+            self._processor_latency.add(time.perf_counter() - started)
+            with self._lock:
+                self._in_flight -= 1
+
+    def release(self, cursor, ids):
+        """Hand claimed payments back to the queue; they're retried after the retry delay."""
+        cursor.execute(
+            f"""UPDATE payments SET claimed_by = NULL, claimed_until = NOW() + INTERVAL %s SECOND
+                WHERE id IN ({placeholders(ids)}) AND claimed_by = %s""",
+            [self.retry_delay] + ids + [self.owner]
+        )
+        self._count('retried', len(ids))
+
+    def write_results(self, results):
+        """Store ``[(payment, status)]`` outcomes; returns the ``(payment, status)`` pairs actually settled."""
+        by_status = {}
+        for payment, status in results:
+            by_status.setdefault(status, []).append(payment)
+
+        settled = []
+        with db_cursor() as (conn, cursor):
+            for status, payments in by_status.items():
+                ids = [payment['id'] for payment in payments]
+                if status is None:
+                    self.release(cursor, ids)
+                    continue
+                # Skip rows whose lease ran out and were claimed by someone else
+                cursor.execute(
+                    f"SELECT id FROM payments WHERE id IN ({placeholders(ids)}) AND status = 'pending' AND claimed_by = %s FOR UPDATE",
+                    ids + [self.owner]
+                )
+                owned = {row[0] for row in cursor.fetchall()}
+                self._count('lost_claims', len(ids) - len(owned))
+                if not owned:
+                    continue
+                owned_ids = sorted(owned)
+                cursor.execute(
+                    f"UPDATE payments SET status = %s, claimed_by = NULL, claimed_until = NULL WHERE id IN ({placeholders(owned_ids)})",
+                    [status] + owned_ids
+                )
+                record_status_changes(cursor, owned_ids, 'pending', status)
+                settled.extend((payment, status) for payment in payments if payment['id'] in owned)
+            conn.commit()
+
+        now = time.time()
+        for payment, status in settled:
+            self._count(status)
+            self._settlement_latency.add(max(0.0, now - float(payment['accepted_at'])))
+        return settled
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = self._in_flight
+        stats.update({
+            'running': self._thread is not None,
+            'workers': self.workers,
+            'batch_size': self.batch_size,
+            'processor_latency': self._processor_latency.summary(),
+            'settlement_latency': self._settlement_latency.summary()
+        })
+        return stats
+
+
+def queue_depth(cursor):
+    """Pending payments and the age of the oldest one (walks INDEX (status))."""
+    cursor.execute("""SELECT COUNT(*), COALESCE(UNIX_TIMESTAMP() - UNIX_TIMESTAMP(MIN(created_at)), 0)
+                      FROM payments WHERE status = 'pending'""")
+    pending, oldest = cursor.fetchone()
+    return {'pending': pending, 'oldest_pending_seconds': int(oldest)}
+
+
+def settlement_from_env(processor):
+    return SettlementWorkers(
+        processor,
+        workers=int(os.getenv('SETTLEMENT_WORKERS', '4')),
+        batch_size=int(os.getenv('SETTLEMENT_BATCH_SIZE', '20')),
+        poll_interval=float(os.getenv('SETTLEMENT_POLL_INTERVAL', '0.5')),
+        lease=int(os.getenv('SETTLEMENT_LEASE', '300')),
+        retry_delay=int(os.getenv('SETTLEMENT_RETRY_DELAY', '5'))
+    )
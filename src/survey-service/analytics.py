@@ -0,0 +1,316 @@
+"""Per-survey answer analytics, cached and updated incrementally.
+
+For each question in ``response_data`` we keep the number of answers, a
+histogram of the values given (list answers count every item) and, for
+numeric answers, mean/min/max/percentiles. A survey is built once by
+reading its responses in batches, each folded in a question at a time;
+after that:
+
+* ``submit_response`` folds the new answer into the cached survey directly;
+* reads check ``COUNT(*)/MAX(id)`` at most every SURVEY_ANALYTICS_REFRESH
+  seconds and fold in only rows with a higher id (written by other
+  replicas). If the counts still disagree (e.g. commits landed out of id
+  order) the survey is rebuilt, so results never drift.
+
+Count, mean, min and max are exact. Percentiles come from a uniform sample
+of at most SURVEY_ANALYTICS_SAMPLE_SIZE numbers per question (a reservoir),
+so memory stays bounded however many responses a survey gets: they're exact
+up to that many answers, and beyond it a percentile is typically within
+about 1/sqrt(sample size) of its true rank (under 2% at the default).
+
+Tuning (all optional):
+    SURVEY_ANALYTICS_CACHE_SIZE    surveys kept in memory, LRU (default 100)
+    SURVEY_ANALYTICS_REFRESH       seconds between database consistency checks (default 2)
+    SURVEY_ANALYTICS_MAX_DISTINCT  distinct answers tracked per question; the rest count as "other" (default 50)
+    SURVEY_ANALYTICS_SAMPLE_SIZE   numbers sampled per question for percentiles (default 4096)
+"""
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+from array import array
+from collections import Counter, OrderedDict
+
+log = logging.getLogger(__name__)
+
+PERCENTILES = (25, 50, 75, 90, 99)
+BATCH_SIZE = 1000
+
+
+def _histogram_key(value):
+    """Histogram bucket for one answer value, or ``None`` if it isn't countable."""
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if isinstance(value, (int, float, str)):
+        return str(value)
+    return None
+
+
+def _uniform():
+    """Uniform in (0, 1): never 0, so its log is defined."""
+    return random.random() or 1e-300
+
+
+class Reservoir:
+    """A uniform sample of at most ``size`` numbers out of all those added.
+
+    Uses Algorithm L: once the sample is full, the number of values to skip
+    before the next replacement is drawn directly, so adding a batch costs
+    one random draw per replacement rather than per value.
+    """
+
+    __slots__ = ('size', 'values', 'seen', 'is_sorted', '_w', '_next')
+
+    def __init__(self, size):
+        self.size = size
+        self.values = array('d')
+        self.seen = 0
+        self.is_sorted = True
+        self._w = 1.0
+        self._next = 0
+
+    def _skip(self):
+        self._w *= math.exp(math.log(_uniform()) / self.size)
+        self._next += int(math.log(_uniform()) / math.log(1.0 - self._w)) + 1
+
+    def extend(self, numbers):
+        start = self.seen
+        room = self.size - len(self.values)
+        if room > 0:
+            self.values.extend(numbers[:room])
+            self.is_sorted = False
+            if len(self.values) == self.size:
+                # Sample full: ``_next`` is the position of the next value to keep
+                self._next = start + room - 1
+                self._skip()
+        self.seen += len(numbers)
+        while self._next < self.seen and len(self.values) == self.size:
+            self.values[random.randrange(self.size)] = numbers[self._next - start]
+            self.is_sorted = False
+            self._skip()
+
+    def sorted_values(self):
+        # Sorted lazily, in place: one sort per read, however many values arrived
+        if not self.is_sorted:
+            self.values = array('d', sorted(self.values))
+            self.is_sorted = True
+        return self.values
+
+
+class QuestionStats:
+    __slots__ = ('answers', 'histogram', 'other', 'count', 'total', 'min', 'max', 'sample', 'max_distinct')
+
+    def __init__(self, max_distinct, sample_size):
+        self.answers = 0
+        self.histogram = {}
+        self.other = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.sample = Reservoir(sample_size)
+        self.max_distinct = max_distinct
+
+    def add_many(self, values):
+        """Fold in a batch of answers to this question."""
+        self.answers += len(values)
+        items = []
+        for value in values:
+            if isinstance(value, list):
+                items.extend(value)
+            else:
+                items.append(value)
+        numbers = [float(item) for item in items if type(item) in (int, float)]
+        if numbers:
+            low, high = min(numbers), max(numbers)
+            self.min = low if self.min is None else min(self.min, low)
+            self.max = high if self.max is None else max(self.max, high)
+            self.count += len(numbers)
+            self.total += sum(numbers)
+            self.sample.extend(numbers)
+        counts = Counter(map(_histogram_key, items))
+        counts.pop(None, None)
+        for key, n in counts.items():
+            if key in self.histogram:
+                self.histogram[key] += n
+            elif len(self.histogram) < self.max_distinct:
+                self.histogram[key] = n
+            else:
+                self.other += n
+
+    def summary(self):
+        result = {'answers': self.answers, 'histogram': dict(self.histogram), 'other': self.other}
+        if self.count:
+            numbers = self.sample.sorted_values()
+            size = len(numbers)
+            result['numeric'] = {
+                'count': self.count,
+                'mean': round(self.total / self.count, 4),
+                'min': self.min,
+                'max': self.max,
+                'percentiles': {f"p{pct}": numbers[min(size - 1, size * pct // 100)] for pct in PERCENTILES},
+                # Fewer than ``count`` means the percentiles are estimates
+                'percentile_sample': size
+            }
+        return result
+
+
+class SurveyAnalytics:
+    """Running analytics for one survey."""
+
+    def __init__(self, max_distinct, sample_size):
+        self.max_distinct = max_distinct
+        self.sample_size = sample_size
+        self.lock = threading.Lock()
+        self.checked_at = None
+        self.reset()
+
+    def reset(self):
+        self.questions = {}
+        self.responses = 0
+        self.last_id = 0
+
+    def add(self, rows):
+        """Fold in ``(response_id, response_data)`` rows, grouped so each question takes one batch."""
+        answers = {}
+        for response_id, data in rows:
+            self.responses += 1
+            self.last_id = max(self.last_id, response_id)
+            if isinstance(data, dict):
+                for question, value in data.items():
+                    answers.setdefault(question, []).append(value)
+        for question, values in answers.items():
+            stats = self.questions.get(question)
+            if stats is None:
+                stats = self.questions[question] = QuestionStats(self.max_distinct, self.sample_size)
+            stats.add_many(values)
+
+    def summary(self, survey_id):
+        return {
+            'survey_id': survey_id,
+            'responses': self.responses,
+            'last_response_id': self.last_id,
+            'questions': {question: stats.summary() for question, stats in self.questions.items()}
+        }
+
+
+class AnalyticsCache:
+    """LRU of :class:`SurveyAnalytics`, kept in step with survey_responses."""
+
+    def __init__(self, max_surveys=100, refresh_interval=2.0, max_distinct=50, sample_size=4096):
+        self.max_surveys = max_surveys
+        self.refresh_interval = refresh_interval
+        self.max_distinct = max_distinct
+        self.sample_size = sample_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'checks': 0,
+            'recorded': 0,
+            'rows_folded': 0,
+            'rebuilds': 0,
+            'evictions': 0,
+            'record_errors': 0
+        }
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def record(self, survey_id, response_id, response_data):
+        """Fold a just-committed response into its survey, if that survey is cached.
+
+        Never raises: the response is already stored, so a failure here only
+        drops the survey from the cache and the next read rebuilds it.
+        """
+        try:
+            survey_id = int(survey_id)
+            with self._lock:
+                entry = self._entries.get(survey_id)
+            if entry is None:
+                return
+            with entry.lock:
+                # A lower id may already have been folded by a concurrent check;
+                # the next check notices anything skipped here
+                if entry.checked_at is not None and response_id > entry.last_id:
+                    entry.add([(response_id, response_data)])
+                    self._count('recorded')
+        except Exception as e:
+            self._count('record_errors')
+            log.warning("Analytics update for survey %s failed, dropping it from the cache: %s", survey_id, e)
+            self.invalidate(survey_id)
+
+    def invalidate(self, survey_id):
+        with self._lock:
+            self._entries.pop(survey_id, None)
+
+    def get(self, survey_id, cursor):
+        """Analytics summary for a survey; ``cursor`` is a plain (tuple) cursor."""
+        with self._lock:
+            entry = self._entries.get(survey_id)
+            if entry is None:
+                entry = self._entries[survey_id] = SurveyAnalytics(self.max_distinct, self.sample_size)
+                while len(self._entries) > self.max_surveys:
+                    self._entries.popitem(last=False)
+                    self._stats['evictions'] += 1
+            else:
+                self._entries.move_to_end(survey_id)
+
+        # One request per survey builds or syncs; the others wait for its result
+        with entry.lock:
+            now = time.monotonic()
+            if entry.checked_at is None or now - entry.checked_at >= self.refresh_interval:
+                self._sync(entry, survey_id, cursor)
+                entry.checked_at = now
+            else:
+                self._count('hits')
+            return entry.summary(survey_id)
+
+    def _sync(self, entry, survey_id, cursor):
+        self._count('checks')
+        cursor.execute("SELECT COUNT(*), COALESCE(MAX(id), 0) FROM survey_responses WHERE survey_id = %s",
+                       (survey_id,))
+        count, max_id = cursor.fetchone()
+        if count == entry.responses and max_id == entry.last_id:
+            return
+        if count > entry.responses:
+            self._fold(entry, survey_id, cursor)
+        if count != entry.responses or max_id != entry.last_id:
+            self._count('rebuilds')
+            entry.reset()
+            self._fold(entry, survey_id, cursor)
+
+    def _fold(self, entry, survey_id, cursor):
+        """Read responses after ``entry.last_id`` in batches and add them."""
+        cursor.execute("SELECT id, response_data FROM survey_responses WHERE survey_id = %s AND id > %s ORDER BY id",
+                       (survey_id, entry.last_id))
+        folded = 0
+        while True:
+            rows = cursor.fetchmany(BATCH_SIZE)
+            if not rows:
+                break
+            entry.add([(response_id, json.loads(response_data) if response_data else None)
+                       for response_id, response_data in rows])
+            folded += len(rows)
+        self._count('rows_folded', folded)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['surveys'] = len(self._entries)
+        return stats
+
+
+def analytics_from_env():
+    return AnalyticsCache(
+        max_surveys=int(os.getenv('SURVEY_ANALYTICS_CACHE_SIZE', '100')),
+        refresh_interval=float(os.getenv('SURVEY_ANALYTICS_REFRESH', '2')),
+        max_distinct=int(os.getenv('SURVEY_ANALYTICS_MAX_DISTINCT', '50')),
+        sample_size=int(os.getenv('SURVEY_ANALYTICS_SAMPLE_SIZE', '4096'))
+    )
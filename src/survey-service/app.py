@@ -1,101 +1,120 @@
 from flask import Flask, jsonify, request
 from flask_cors import CORS
-import mysql.connector
 import os
+import sys
 import json
+import time
 from dotenv import load_dotenv
 
-# Load .env from project root (two levels up from src/survey-service/)
+# Load .env from project root (two levels up from src/survey-service/) before
+# importing the modules below, which read their settings at import time
 load_dotenv(os.path.join(os.path.dirname(__file__), '..', '..', '.env'))
 
+# Shared modules live in src/common/ (one level up from src/survey-service/)
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from common.db import db_cursor, pool_stats
+from common.metrics import instrument_flask
+from common.tracing import trace_flask
+from common.logs import log_flask
+from common.pagination import KeysetQuery, PageArgumentError
+from common.row_stream import stream_format, stream_rows
+from analytics import analytics_from_env
+from ingest import BulkIngest, IngestStats, bulk_settings_from_env, read_items
+
 app = Flask(__name__)
 CORS(app)
+# Per-route request and DB metrics on /metrics (see common/metrics.py)
+instrument_flask(app)
+# Request IDs and timing spans for sampled requests (see common/tracing.py)
+trace_flask(app, 'survey-service')
+# One JSON log line per request, written by a background thread (see common/logs.py)
+log_flask(app, 'survey-service')
 
-def get_db_connection():
-    db_host = os.getenv('DB_HOST')
-    db_port = os.getenv('DB_PORT')
-    db_user = os.getenv('DB_USER')
-    db_password = os.getenv('DB_PASSWORD')
-    db_name = os.getenv('DB_NAME')
-    
-    # Check if required variables exist (password can be empty string)
-    if not db_host or not db_port or not db_user or db_password is None or not db_name:
-        raise ValueError("Missing required database environment variables: DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME")
-    
-    return mysql.connector.connect(
-        host=db_host,
-        port=int(db_port),
-        user=db_user,
-        password=db_password,
-        database=db_name,
-        connection_timeout=5,
-        autocommit=False
-    )
+# Per-survey answer statistics, updated as responses arrive (see analytics.py)
+ANALYTICS = analytics_from_env()
+
+# Rows/second for single and bulk submissions, reported on /health
+INGEST_STATS = IngestStats()
+BULK_BATCH_SIZE, BULK_MAX_ITEMS = bulk_settings_from_env()
+
+SURVEYS = KeysetQuery(
+    'surveys',
+    ['id', 'title', 'description', 'created_by', 'is_active', 'created_at', 'updated_at'],
+    order=[('created_at', 'DESC'), ('id', 'DESC')]
+)
+# Per-survey listing walks INDEX (survey_id), which ends in the primary key
+SURVEY_RESPONSES = KeysetQuery(
+    'survey_responses',
+    ['id', 'survey_id', 'user_id', 'response_data', 'submitted_at'],
+    order=[('id', 'ASC')]
+)
+
+def parse_response_data(response):
+    """Decode the JSON response_data column in place"""
+    if response.get('response_data'):
+        response['response_data'] = json.loads(response['response_data'])
+    return response
 
 @app.route('/')
 def home():
     return jsonify({
         'service': 'survey-service',
         'status': 'running',
-        'endpoints': ['/health', '/surveys', '/api/survey/surveys', '/api/survey/responses']
+        'endpoints': ['/health', '/metrics', '/surveys', '/api/survey/surveys', '/api/survey/surveys/<id>/analytics',
+                      '/api/survey/responses', '/api/survey/responses/bulk']
     })
 
 @app.route('/surveys', methods=['GET'])
 def get_surveys_simple():
     """Simple endpoint for dashboard"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM surveys ORDER BY created_at DESC")
-        surveys = cursor.fetchall()
-        return jsonify({'surveys': surveys}), 200
+        page = SURVEYS.page(request.args)
+        fmt = stream_format(request)
+    except PageArgumentError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    try:
+        if fmt:
+            return stream_rows(page, 'surveys', fmt)
+        with db_cursor(dictionary=True) as (conn, cursor):
+            surveys, next_cursor = page.fetch(cursor)
+            return jsonify({'surveys': surveys, 'next_cursor': next_cursor}), 200
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
-    finally:
-        if 'cursor' in locals():
-            cursor.close()
-        if 'conn' in locals():
-            conn.close()
 
 @app.route('/health', methods=['GET'])
 def health():
-    return jsonify({'status': 'healthy', 'service': 'survey-service'}), 200
+    return jsonify({'status': 'healthy', 'service': 'survey-service', 'db_pool': pool_stats(),
+                    'analytics': ANALYTICS.stats(), 'ingest': INGEST_STATS.stats()}), 200
 
 @app.route('/api/survey/surveys', methods=['GET'])
 def get_surveys():
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM surveys ORDER BY created_at DESC")
-        surveys = cursor.fetchall()
-        return jsonify({'surveys': surveys}), 200
+        page = SURVEYS.page(request.args)
+        fmt = stream_format(request)
+    except PageArgumentError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        if fmt:
+            return stream_rows(page, 'surveys', fmt)
+        with db_cursor(dictionary=True) as (conn, cursor):
+            surveys, next_cursor = page.fetch(cursor)
+            return jsonify({'surveys': surveys, 'next_cursor': next_cursor}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
-    finally:
-        if 'cursor' in locals():
-            cursor.close()
-        if 'conn' in locals():
-            conn.close()
 
 @app.route('/api/survey/surveys/<int:survey_id>', methods=['GET'])
 def get_survey(survey_id):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM surveys WHERE id = %s", (survey_id,))
-        survey = cursor.fetchone()
-        
-        if survey:
-            return jsonify({'success': True, 'survey': survey}), 200
-        else:
-            return jsonify({'success': False, 'message': 'Survey not found'}), 404
+        with db_cursor(dictionary=True) as (conn, cursor):
+            cursor.execute("SELECT * FROM surveys WHERE id = %s", (survey_id,))
+            survey = cursor.fetchone()
+            
+            if survey:
+                return jsonify({'success': True, 'survey': survey}), 200
+            else:
+                return jsonify({'success': False, 'message': 'Survey not found'}), 404
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
-    finally:
-        if 'cursor' in locals():
-            cursor.close()
-        if 'conn' in locals():
-            conn.close()
 
 @app.route('/api/survey/surveys', methods=['POST'])
 def create_survey():
@@ -105,26 +124,32 @@ def create_survey():
     created_by = data.get('created_by', 1)
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO surveys (title, description, created_by) VALUES (%s, %s, %s)",
-            (title, description, created_by)
-        )
-        conn.commit()
-        
-        return jsonify({
-            'success': True,
-            'message': 'Survey created successfully',
-            'survey_id': cursor.lastrowid
-        }), 201
+        with db_cursor() as (conn, cursor):
+            cursor.execute(
+                "INSERT INTO surveys (title, description, created_by) VALUES (%s, %s, %s)",
+                (title, description, created_by)
+            )
+            conn.commit()
+            
+            return jsonify({
+                'success': True,
+                'message': 'Survey created successfully',
+                'survey_id': cursor.lastrowid
+            }), 201
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/survey/surveys/<int:survey_id>/analytics', methods=['GET'])
+def get_survey_analytics(survey_id):
+    """Per-question answer counts, histograms and numeric summaries"""
+    try:
+        with db_cursor() as (conn, cursor):
+            cursor.execute("SELECT id FROM surveys WHERE id = %s", (survey_id,))
+            if cursor.fetchone() is None:
+                return jsonify({'success': False, 'message': 'Survey not found'}), 404
+            return jsonify({'success': True, 'analytics': ANALYTICS.get(survey_id, cursor)}), 200
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
-    finally:
-        if 'cursor' in locals():
-            cursor.close()
-        if 'conn' in locals():
-            conn.close()
 
 @app.route('/api/survey/responses', methods=['POST'])
 def submit_response():
@@ -134,73 +159,100 @@ def submit_response():
     response_data = data.get('response_data')
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO survey_responses (survey_id, user_id, response_data) VALUES (%s, %s, %s)",
-            (survey_id, user_id, json.dumps(response_data))
-        )
-        conn.commit()
-        
-        return jsonify({
-            'success': True,
-            'message': 'Response submitted successfully',
-            'response_id': cursor.lastrowid
-        }), 201
+        started = time.perf_counter()
+        with db_cursor() as (conn, cursor):
+            cursor.execute(
+                "INSERT INTO survey_responses (survey_id, user_id, response_data) VALUES (%s, %s, %s)",
+                (survey_id, user_id, json.dumps(response_data))
+            )
+            conn.commit()
+            response_id = cursor.lastrowid
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
-    finally:
-        if 'cursor' in locals():
-            cursor.close()
-        if 'conn' in locals():
-            conn.close()
+    
+    # Stored: nothing below may turn this into an error the client would retry
+    INGEST_STATS.record('single', 1, time.perf_counter() - started)
+    ANALYTICS.record(survey_id, response_id, response_data)
+    
+    return jsonify({
+        'success': True,
+        'message': 'Response submitted successfully',
+        'response_id': response_id
+    }), 201
+
+@app.route('/api/survey/responses/bulk', methods=['POST'])
+def submit_responses_bulk():
+    """Many responses per call: a JSON array or NDJSON, written in batched multi-row INSERTs"""
+    started = time.perf_counter()
+    try:
+        # Each batch borrows a connection only while it is written (see ingest.py)
+        ingest = BulkIngest(BULK_BATCH_SIZE)
+        results = ingest.run(read_items(request), BULK_MAX_ITEMS)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+    INGEST_STATS.record('bulk', len(ingest.created), time.perf_counter() - started)
+    for survey_id, response_id, response_data in ingest.created:
+        ANALYTICS.record(survey_id, response_id, response_data)
+
+    counts = {'created': 0, 'duplicate': 0, 'invalid': 0, 'error': 0}
+    for result in results:
+        counts[result['status']] += 1
+    # Batches that failed are listed as 'error'; the rest were stored
+    body = {
+        'success': not ingest.truncated and not counts['error'],
+        'created': counts['created'],
+        'duplicates': counts['duplicate'],
+        'invalid': counts['invalid'],
+        'errors': counts['error'],
+        'results': results
+    }
+    if ingest.truncated:
+        # Everything listed in results was processed; the rest was not read
+        body['error'] = f"At most {BULK_MAX_ITEMS} responses per request"
+        return jsonify(body), 413
+    return jsonify(body), 200
 
 @app.route('/api/survey/responses/<int:survey_id>', methods=['GET'])
 def get_survey_responses(survey_id):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM survey_responses WHERE survey_id = %s", (survey_id,))
-        responses = cursor.fetchall()
-        
-        # Parse JSON response_data
-        for response in responses:
-            if response.get('response_data'):
-                response['response_data'] = json.loads(response['response_data'])
-        
-        return jsonify({'success': True, 'responses': responses}), 200
+        page = SURVEY_RESPONSES.page(request.args)
+        fmt = stream_format(request)
+    except PageArgumentError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    try:
+        if fmt:
+            return stream_rows(page, 'responses', fmt, "survey_id = %s", (survey_id,), transform=parse_response_data)
+        with db_cursor(dictionary=True) as (conn, cursor):
+            responses, next_cursor = page.fetch(cursor, "survey_id = %s", (survey_id,))
+            
+            for response in responses:
+                parse_response_data(response)
+            
+            return jsonify({'success': True, 'responses': responses, 'next_cursor': next_cursor}), 200
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
-    finally:
-        if 'cursor' in locals():
-            cursor.close()
-        if 'conn' in locals():
-            conn.close()
 
 @app.route('/api/survey/stats', methods=['GET'])
 def get_stats():
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT COUNT(*) as total_surveys FROM surveys")
-        surveys = cursor.fetchone()
-        cursor.execute("SELECT COUNT(*) as total_responses FROM survey_responses")
-        responses = cursor.fetchone()
-        
-        return jsonify({
-            'success': True,
-            'stats': {
-                'total_surveys': surveys['total_surveys'],
-                'total_responses': responses['total_responses']
-            }
-        }), 200
+        with db_cursor(dictionary=True) as (conn, cursor):
+            cursor.execute("SELECT COUNT(*) as total_surveys FROM surveys")
+            surveys = cursor.fetchone()
+            cursor.execute("SELECT COUNT(*) as total_responses FROM survey_responses")
+            responses = cursor.fetchone()
+            
+            return jsonify({
+                'success': True,
+                'stats': {
+                    'total_surveys': surveys['total_surveys'],
+                    'total_responses': responses['total_responses']
+                }
+            }), 200
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
-    finally:
-        if 'cursor' in locals():
-            cursor.close()
-        if 'conn' in locals():
-            conn.close()
 
 if __name__ == '__main__':
     host = os.getenv('SURVEY_SERVICE_HOST', '0.0.0.0')
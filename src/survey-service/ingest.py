@@ -0,0 +1,240 @@
+"""Bulk survey response ingestion.
+
+``POST /api/survey/responses/bulk`` takes a JSON array (or ``{"responses":
+[...]}``) or an NDJSON stream (``Content-Type: application/x-ndjson``) of
+``{"survey_id", "user_id", "response_data"}`` items. Items are written
+SURVEY_BULK_BATCH_SIZE at a time, one transaction and one multi-row INSERT
+per batch, and every item gets its own result:
+
+    created     inserted; carries ``response_id``
+    duplicate   this user already answered the survey (``unique_survey_user``),
+                in the database or earlier in the same upload
+    invalid     missing/bad fields, unknown survey or user
+    error       its batch could not be written (e.g. database error); nothing
+                of it was stored, so it is safe to resend
+
+A pooled connection is only borrowed while a batch is written. Reading and
+parsing the next batch off a slow upload holds no connection and no open
+transaction.
+
+Tuning (all optional):
+    SURVEY_BULK_BATCH_SIZE  items per INSERT/transaction (default 500)
+    SURVEY_BULK_MAX_ITEMS   items accepted per request (default 10000)
+"""
+import json
+import logging
+import os
+import threading
+
+import mysql.connector
+
+from common.db import db_cursor, placeholders
+
+log = logging.getLogger(__name__)
+
+DUPLICATE_KEY = 1062
+
+INSERT_SQL = "INSERT INTO survey_responses (survey_id, user_id, response_data) VALUES (%s, %s, %s)"
+
+
+def _placeholders(count, width):
+    row = '(' + ', '.join(['%s'] * width) + ')'
+    return ', '.join([row] * count)
+
+
+def read_items(req):
+    """Yield the uploaded items one by one; NDJSON is read line by line off the socket."""
+    if req.mimetype == 'application/x-ndjson':
+        for line in req.stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+        return
+
+    data = req.get_json(silent=True)
+    if isinstance(data, dict):
+        data = data.get('responses')
+    if not isinstance(data, list):
+        raise ValueError("Expected a JSON array of responses, {\"responses\": [...]} or NDJSON")
+    yield from data
+
+
+def _validate(item):
+    """``(survey_id, user_id, response_json, response_data)`` for a well-formed item, else an error message."""
+    if not isinstance(item, dict):
+        return "Item is not a JSON object"
+    ids = []
+    for field in ('survey_id', 'user_id'):
+        value = item.get(field)
+        if isinstance(value, bool) or not isinstance(value, (int, str)):
+            return f"{field} is required"
+        try:
+            ids.append(int(value))
+        except ValueError:
+            return f"{field} must be an integer"
+    return ids[0], ids[1], json.dumps(item.get('response_data')), item.get('response_data')
+
+
+def _existing_ids(cursor, table, ids):
+    if not ids:
+        return set()
+    ids = sorted(ids)
+    cursor.execute(f"SELECT id FROM {table} WHERE id IN ({placeholders(ids)})", ids)
+    return {row[0] for row in cursor.fetchall()}
+
+
+def _existing_pairs(cursor, pairs):
+    if not pairs:
+        return set()
+    params = [value for pair in pairs for value in pair]
+    cursor.execute(
+        f"SELECT survey_id, user_id FROM survey_responses WHERE (survey_id, user_id) IN ({_placeholders(len(pairs), 2)})",
+        params
+    )
+    return {tuple(row) for row in cursor.fetchall()}
+
+
+class BulkIngest:
+    """Writes one upload batch by batch and collects per-item results."""
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.results = []
+        self.created = []
+        self.truncated = False
+        # (survey_id, user_id) pairs written by earlier batches of this upload
+        self._seen = set()
+
+    def run(self, items, max_items):
+        """Write ``items``; stops (setting ``truncated``) after ``max_items``."""
+        batch = []
+        for index, item in enumerate(items):
+            if index >= max_items:
+                self.truncated = True
+                break
+            batch.append((index, item))
+            if len(batch) >= self.batch_size:
+                self._write_batch(batch)
+                batch = []
+        if batch:
+            self._write_batch(batch)
+        self.results.sort(key=lambda result: result['index'])
+        return self.results
+
+    def _result(self, index, status, **extra):
+        result = {'index': index, 'status': status}
+        result.update(extra)
+        self.results.append(result)
+
+    def _write_batch(self, batch):
+        rows = []
+        for index, item in batch:
+            parsed = _validate(item)
+            if isinstance(parsed, str):
+                self._result(index, 'invalid', error=parsed)
+            else:
+                rows.append((index, parsed))
+        if not rows:
+            return
+        results_mark, created_mark = len(self.results), len(self.created)
+        try:
+            with db_cursor() as (conn, cursor):
+                self._write_rows_batch(conn, cursor, rows)
+        except Exception as e:
+            # Rolled back: drop what this batch reported and mark it all as failed
+            log.error("Bulk survey batch at item %d failed: %s", rows[0][0], e)
+            del self.results[results_mark:]
+            del self.created[created_mark:]
+            for index, _ in rows:
+                self._result(index, 'error', error=str(e))
+
+    def _write_rows_batch(self, conn, cursor, rows):
+        surveys = _existing_ids(cursor, 'surveys', {row[0] for _, row in rows})
+        users = _existing_ids(cursor, 'auth_users', {row[1] for _, row in rows})
+        existing = _existing_pairs(cursor, list({(row[0], row[1]) for _, row in rows}))
+
+        pending = []
+        # Only added to self._seen once the batch is committed
+        seen = set()
+        for index, row in rows:
+            pair = (row[0], row[1])
+            if row[0] not in surveys:
+                self._result(index, 'invalid', error=f"Survey {row[0]} not found")
+            elif row[1] not in users:
+                self._result(index, 'invalid', error=f"User {row[1]} not found")
+            elif pair in existing or pair in self._seen or pair in seen:
+                self._result(index, 'duplicate')
+            else:
+                seen.add(pair)
+                pending.append((index, row))
+
+        if pending:
+            try:
+                # mysql-connector turns this into a single multi-row INSERT
+                cursor.executemany(INSERT_SQL, [row[:3] for _, row in pending])
+                ids = self._ids_for(cursor, [row for _, row in pending])
+                for index, row in pending:
+                    self._created(index, row, ids[(row[0], row[1])])
+            except mysql.connector.IntegrityError:
+                # Lost a race with a concurrent insert: redo the batch row by row
+                conn.rollback()
+                self._write_rows(cursor, pending)
+        conn.commit()
+        self._seen |= seen
+
+    def _ids_for(self, cursor, rows):
+        """Our own inserts are the only rows with these keys, so their ids are exact."""
+        pairs = [(row[0], row[1]) for row in rows]
+        params = [value for pair in pairs for value in pair]
+        cursor.execute(
+            f"SELECT survey_id, user_id, id FROM survey_responses WHERE (survey_id, user_id) IN ({_placeholders(len(pairs), 2)})",
+            params
+        )
+        return {(row[0], row[1]): row[2] for row in cursor.fetchall()}
+
+    def _write_rows(self, cursor, pending):
+        for index, row in pending:
+            try:
+                cursor.execute(INSERT_SQL, row[:3])
+            except mysql.connector.IntegrityError as e:
+                if e.errno == DUPLICATE_KEY:
+                    self._result(index, 'duplicate')
+                else:
+                    self._result(index, 'invalid', error=e.msg)
+                continue
+            self._created(index, row, cursor.lastrowid)
+
+    def _created(self, index, row, response_id):
+        self._result(index, 'created', response_id=response_id)
+        self.created.append((row[0], response_id, row[3]))
+
+
+class IngestStats:
+    """Rows and seconds spent per ingestion path, for /health."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._paths = {}
+
+    def record(self, path, rows, seconds):
+        with self._lock:
+            stats = self._paths.setdefault(path, {'requests': 0, 'rows': 0, 'seconds': 0.0})
+            stats['requests'] += 1
+            stats['rows'] += rows
+            stats['seconds'] += seconds
+
+    def stats(self):
+        with self._lock:
+            paths = {path: dict(stats) for path, stats in self._paths.items()}
+        for stats in paths.values():
+            stats['rows_per_second'] = round(stats['rows'] / stats['seconds'], 1) if stats['seconds'] else 0
+            stats['seconds'] = round(stats['seconds'], 3)
+        return paths
+
+
+def bulk_settings_from_env():
+    return int(os.getenv('SURVEY_BULK_BATCH_SIZE', '500')), int(os.getenv('SURVEY_BULK_MAX_ITEMS', '10000'))
@@ -0,0 +1,35 @@
+"""Puts the shared package and each service's modules on the import path.
+
+Only modules that don't need a running MySQL are tested here; service
+module names are unique across src/*-service and src/api-gateway.
+"""
+import os
+import sys
+import time
+
+import pytest
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+for directory in ('api-gateway', 'auth-service', 'payment-service', 'survey-service'):
+    sys.path.insert(0, os.path.join(SRC, directory))
+sys.path.insert(0, SRC)
+
+
+class Clock:
+    """Stand-in for ``time.monotonic`` that only moves when told to."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, 'monotonic', clock)
+    return clock
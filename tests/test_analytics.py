@@ -0,0 +1,52 @@
+import random
+
+import pytest
+
+from analytics import Reservoir
+
+
+@pytest.fixture(autouse=True)
+def seeded():
+    random.seed(1234)
+
+
+def test_exact_below_capacity():
+    reservoir = Reservoir(10)
+    reservoir.extend([5.0, 1.0, 3.0])
+    reservoir.extend([2.0])
+    assert list(reservoir.sorted_values()) == [1.0, 2.0, 3.0, 5.0]
+    assert reservoir.seen == 4
+
+
+def test_fills_exactly_to_capacity_in_one_batch():
+    reservoir = Reservoir(4)
+    reservoir.extend([4.0, 3.0, 2.0, 1.0])
+    assert list(reservoir.sorted_values()) == [1.0, 2.0, 3.0, 4.0]
+
+
+def test_size_stays_bounded():
+    reservoir = Reservoir(100)
+    for start in range(0, 100000, 777):
+        reservoir.extend([float(n) for n in range(start, min(start + 777, 100000))])
+    assert len(reservoir.values) == 100
+    assert reservoir.seen == 100000
+    assert len(set(reservoir.values)) == 100
+    assert all(0 <= value < 100000 for value in reservoir.values)
+
+
+def test_sample_is_uniform():
+    reservoir = Reservoir(1000)
+    reservoir.extend([float(n) for n in range(100000)])
+    values = reservoir.sorted_values()
+    # Median of a uniform sample of 1000 is within a few percent of the true one
+    assert abs(values[500] - 50000) < 5000
+    # Later values must get in as often as early ones
+    assert abs(sum(1 for value in values if value >= 50000) - 500) < 100
+
+
+def test_sorted_values_resorts_after_new_values():
+    reservoir = Reservoir(3)
+    reservoir.extend([3.0, 1.0])
+    assert list(reservoir.sorted_values()) == [1.0, 3.0]
+    reservoir.extend([2.0])
+    assert list(reservoir.sorted_values()) == [1.0, 2.0, 3.0]
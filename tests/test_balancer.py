@@ -0,0 +1,95 @@
+import pytest
+
+from balancer import LEAST_OUTSTANDING, ROUND_ROBIN, InstanceSet, parse_instances
+from breaker import CircuitBreaker, CircuitOpen
+
+
+class FakeInstance:
+    def __init__(self, url, weight):
+        self.base_url = url
+        self.weight = weight
+        self.in_flight = 0
+        self.breaker = CircuitBreaker(url, window=2, min_calls=2, open_seconds=30)
+
+
+def instance_set(specs, policy=LEAST_OUTSTANDING):
+    return InstanceSet('user', parse_instances(specs), FakeInstance, policy=policy)
+
+
+def eject(instance):
+    for _ in range(2):
+        instance.breaker.record(instance.breaker.allow(), False, 0.01)
+
+
+def test_parse_instances():
+    assert parse_instances('http://a:1/api/, http://b:1/api;weight=3,') == [
+        ('http://a:1/api', 1), ('http://b:1/api', 3)]
+    with pytest.raises(ValueError):
+        parse_instances('http://a:1/api;weigth=2')
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        instance_set('http://a', policy='random')
+
+
+def test_least_outstanding_weighs_in_flight_requests():
+    instances = instance_set('http://a,http://b;weight=2')
+    a, b = instances.instances
+    a.in_flight, b.in_flight = 1, 1
+    assert instances.choose() is b
+    b.in_flight = 3
+    assert instances.choose() is a
+
+
+def test_least_outstanding_spreads_ties():
+    instances = instance_set('http://a,http://b')
+    chosen = {instances.choose().base_url for _ in range(100)}
+    assert chosen == {'http://a', 'http://b'}
+
+
+def test_round_robin_interleaves_by_weight():
+    instances = instance_set('http://a;weight=2,http://b', policy=ROUND_ROBIN)
+    picks = [instances.choose().base_url for _ in range(6)]
+    assert picks == ['http://a', 'http://b', 'http://a'] * 2
+
+
+def test_tried_and_drained_instances_are_skipped():
+    instances = instance_set('http://a,http://b,http://c;weight=0')
+    a, b, _ = instances.instances
+    assert instances.choose(tried=[a]) is b
+    assert instances.choose(tried=[a, b]) is None
+
+
+def test_ejected_instances_are_skipped(clock):
+    instances = instance_set('http://a,http://b')
+    a, b = instances.instances
+    eject(a)
+    assert all(instances.choose() is b for _ in range(10))
+
+
+def test_all_ejected_raises_circuit_open(clock):
+    instances = instance_set('http://a,http://b')
+    a, b = instances.instances
+    eject(a)
+    clock.advance(20)
+    eject(b)
+    with pytest.raises(CircuitOpen) as refused:
+        instances.choose()
+    # The instance that will be retried first decides Retry-After
+    assert refused.value.retry_after == 10
+    # Once every instance was tried there is nothing left to refuse
+    assert instances.choose(tried=[a, b]) is None
+
+
+def test_update_keeps_surviving_instances_and_retires_the_rest():
+    instances = instance_set('http://a,http://b')
+    a, b = instances.instances
+    b.in_flight = 1
+    instances.update(parse_instances('http://a;weight=3,http://c'))
+    assert instances.instances[0] is a and a.weight == 3
+    assert [i.base_url for i in instances.all_instances()] == ['http://a', 'http://c', 'http://b']
+    assert instances.drained() == []
+    b.in_flight = 0
+    assert instances.drained() == [b]
+    assert len(instances.all_instances()) == 2
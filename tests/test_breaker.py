@@ -0,0 +1,106 @@
+import pytest
+
+from breaker import CALL, CLOSED, HALF_OPEN, OPEN, PROBE, CircuitBreaker, CircuitOpen
+
+
+def new_breaker(**kwargs):
+    settings = dict(window=4, min_calls=4, failure_rate=0.5, slow_seconds=1.0, open_seconds=10.0,
+                    half_open_calls=2, health_failures=2)
+    settings.update(kwargs)
+    return CircuitBreaker('user', **settings)
+
+
+def trip(breaker):
+    for _ in range(breaker.min_calls):
+        breaker.record(breaker.allow(), False, 0.01)
+
+
+def test_stays_closed_below_min_calls():
+    breaker = new_breaker()
+    for _ in range(3):
+        breaker.record(breaker.allow(), False, 0.01)
+    assert breaker.state == CLOSED
+
+
+def test_opens_at_failure_rate(clock):
+    breaker = new_breaker()
+    for ok in (True, True, False):
+        breaker.record(breaker.allow(), ok, 0.01)
+    assert breaker.state == CLOSED
+    breaker.record(breaker.allow(), False, 0.01)
+    assert breaker.state == OPEN
+    assert not breaker.available()
+    with pytest.raises(CircuitOpen) as refused:
+        breaker.allow()
+    assert refused.value.retry_after == 10
+    assert breaker.stats()['rejected'] == 1
+
+
+def test_slow_calls_count_as_failures(clock):
+    breaker = new_breaker()
+    for _ in range(4):
+        breaker.record(breaker.allow(), True, 1.5)
+    assert breaker.state == OPEN
+    assert breaker.stats()['slow_calls'] == 4
+
+
+def test_half_open_probes_close_the_circuit(clock):
+    breaker = new_breaker()
+    trip(breaker)
+    clock.advance(10)
+    assert breaker.available()
+    first, second = breaker.allow(), breaker.allow()
+    assert first == second == PROBE
+    assert breaker.state == HALF_OPEN
+    # Only half_open_calls trial requests at a time
+    assert not breaker.available()
+    with pytest.raises(CircuitOpen):
+        breaker.allow()
+    breaker.record(first, True, 0.01)
+    assert breaker.state == HALF_OPEN
+    breaker.record(second, True, 0.01)
+    assert breaker.state == CLOSED
+    assert breaker.allow() == CALL
+    assert breaker.stats()['recent_calls'] == 0
+
+
+def test_failed_probe_reopens(clock):
+    breaker = new_breaker()
+    trip(breaker)
+    clock.advance(10)
+    breaker.record(breaker.allow(), False, 0.01)
+    assert breaker.state == OPEN
+    assert breaker.retry_after() == 10
+    assert breaker.stats()['opened'] == 2
+
+
+def test_discarded_probe_frees_its_slot(clock):
+    breaker = new_breaker(half_open_calls=1)
+    trip(breaker)
+    clock.advance(10)
+    ticket = breaker.allow()
+    assert not breaker.available()
+    breaker.discard(ticket)
+    assert breaker.available()
+
+
+def test_health_failures_hold_the_circuit_open(clock):
+    breaker = new_breaker()
+    breaker.record_health(False, 0.01)
+    assert breaker.state == CLOSED
+    breaker.record_health(False, 0.01)
+    assert breaker.state == OPEN
+    clock.advance(60)
+    # Still failing health checks: the open timeout alone doesn't let traffic back
+    assert not breaker.available()
+    breaker.record_health(True, 0.01)
+    assert breaker.state == HALF_OPEN
+    assert breaker.available()
+
+
+def test_disabled_breaker_lets_everything_through():
+    breaker = new_breaker(enabled=False)
+    trip(breaker)
+    assert breaker.available()
+    assert breaker.allow() == CALL
+    assert breaker.stats()['state'] == 'disabled'
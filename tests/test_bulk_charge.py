@@ -0,0 +1,44 @@
+from decimal import Decimal
+
+import pytest
+
+from bulk_charge import _validate
+
+
+def test_valid_item_with_defaults():
+    assert _validate({'user_id': '7', 'amount': 12.5}) == (7, Decimal('12.5'), 'USD', 'credit_card')
+
+
+def test_valid_item_with_explicit_fields():
+    item = {'user_id': 7, 'amount': '0.01', 'currency': 'EUR', 'payment_method': 'paypal'}
+    assert _validate(item) == (7, Decimal('0.01'), 'EUR', 'paypal')
+
+
+@pytest.mark.parametrize('item,error', [
+    ([1, 2], "Item is not a JSON object"),
+    ({'amount': 1}, "user_id is required"),
+    ({'user_id': True, 'amount': 1}, "user_id is required"),
+    ({'user_id': 'seven', 'amount': 1}, "user_id must be an integer"),
+    ({'user_id': 1}, "amount is required"),
+    ({'user_id': 1, 'amount': False}, "amount is required"),
+    ({'user_id': 1, 'amount': 'ten'}, "amount must be a number"),
+])
+def test_malformed_items(item, error):
+    assert _validate(item) == error
+
+
+@pytest.mark.parametrize('amount', [0, -5, '0.001', 'NaN', 'Infinity', '100000000'])
+def test_amount_out_of_range(amount):
+    assert _validate({'user_id': 1, 'amount': amount}).startswith("amount must be between 0.01 and")
+
+
+@pytest.mark.parametrize('field,value,width', [
+    ('currency', '', 10),
+    ('currency', 'X' * 11, 10),
+    ('currency', 840, 10),
+    ('currency', None, 10),
+    ('payment_method', 'x' * 51, 50),
+])
+def test_text_fields_checked_per_item(field, value, width):
+    item = {'user_id': 1, 'amount': 1, field: value}
+    assert _validate(item) == f"{field} must be a string of 1-{width} characters"
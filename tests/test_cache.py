@@ -0,0 +1,77 @@
+import pytest
+
+from cache import (DEFAULT_ROUTE_TTLS, ResponseCache, cache_from_env, etag_matches, make_etag,
+                   parse_route_ttls, route_matches)
+
+
+def response_cache(route_ttls=DEFAULT_ROUTE_TTLS, enabled=True):
+    return ResponseCache(route_ttls, max_bytes=1024, max_entry_bytes=256, vary_headers=['Authorization'],
+                         enabled=enabled)
+
+
+@pytest.mark.parametrize('pattern,route,expected', [
+    ('payment/payments', 'payment/payments', True),
+    ('payment/payments', 'payment/payments/user/5', True),
+    ('payment/payments', 'payment/paymentsx', False),
+    ('payment/payments/<id>', 'payment/payments/17', True),
+    ('payment/payments/<id>', 'payment/payments/user', False),
+    ('payment/payments/<id>', 'payment/payments', False),
+])
+def test_route_matches(pattern, route, expected):
+    assert route_matches(pattern, route) is expected
+
+
+@pytest.mark.parametrize('service,subpath,ttl', [
+    ('auth', 'users', 10),
+    ('survey', 'surveys/3/responses', 30),
+    ('payment', 'payments', 5),
+    ('payment', 'payments/user/5', 5),
+    # A single payment's status changes behind the gateway's back
+    ('payment', 'payments/5', 0),
+    ('payment', 'payments/5/', 0),
+    ('payment', 'charge', 0),
+    ('user', 'unknown', 0),
+])
+def test_ttl_for_default_routes(service, subpath, ttl):
+    assert response_cache().ttl_for(service, subpath) == ttl
+
+
+def test_ttl_for_disabled_cache():
+    assert response_cache(enabled=False).ttl_for('auth', 'users') == 0
+
+
+def test_configured_ttls_override_defaults(monkeypatch):
+    monkeypatch.setenv('GATEWAY_CACHE_TTLS', '/payment/payments/=60, survey/stats=0')
+    cache = cache_from_env()
+    assert cache.ttl_for('payment', 'payments/user/5') == 60
+    assert cache.ttl_for('payment', 'payments/5') == 0
+    assert cache.ttl_for('survey', 'stats') == 0
+
+
+def test_parse_route_ttls():
+    assert parse_route_ttls('a/b=1.5,,c=2') == {'a/b': 1.5, 'c': 2.0}
+
+
+def test_make_etag_is_quoted_and_content_based():
+    etag = make_etag(b'{"id": 1}')
+    assert etag.startswith('"') and etag.endswith('"')
+    assert etag == make_etag(b'{"id": 1}')
+    assert etag != make_etag(b'{"id": 2}')
+
+
+@pytest.mark.parametrize('if_none_match,expected', [
+    (None, False),
+    ('', False),
+    ('*', True),
+    ('"abc"', True),
+    ('W/"abc"', True),
+    ('"xyz", W/"abc"', True),
+    ('"xyz"', False),
+    ('abc', False),
+])
+def test_etag_matches(if_none_match, expected):
+    assert etag_matches(if_none_match, '"abc"') is expected
+
+
+def test_weak_etag_matches_strong_validator():
+    assert etag_matches('"abc"', 'W/"abc"')
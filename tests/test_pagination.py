@@ -0,0 +1,97 @@
+import pytest
+
+from common.pagination import KeysetQuery, PageArgumentError, decode_cursor, encode_cursor
+
+
+def payments_query():
+    return KeysetQuery('payments', ['id', 'user_id', 'amount', 'created_at'],
+                       [('created_at', 'DESC'), ('id', 'DESC')])
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+        self.executed = []
+
+    def execute(self, statement, params):
+        self.executed.append((statement, params))
+
+    def fetchall(self):
+        return self.rows
+
+
+def test_cursor_round_trip():
+    values = ['2024-01-02 03:04:05', 42]
+    token = encode_cursor(values)
+    assert '=' not in token
+    assert decode_cursor(token, 2) == values
+
+
+@pytest.mark.parametrize('token', ['not base64!', encode_cursor({'id': 1})[:-1], 'bm90IGpzb24'])
+def test_malformed_cursor(token):
+    with pytest.raises(PageArgumentError):
+        decode_cursor(token, 1)
+
+
+@pytest.mark.parametrize('values,size', [([1], 2), ([1, 2], 1), ([[1], 2], 2), ([None, 2], 2), ({'id': 1}, 1)])
+def test_cursor_of_wrong_shape(values, size):
+    with pytest.raises(PageArgumentError):
+        decode_cursor(encode_cursor(values), size)
+
+
+def test_mixed_directions_rejected():
+    with pytest.raises(ValueError):
+        KeysetQuery('payments', ['id'], [('created_at', 'DESC'), ('id', 'ASC')])
+
+
+def test_page_defaults():
+    page = payments_query().page({})
+    assert page.fields == ['id', 'user_id', 'amount', 'created_at']
+    assert page.limit == 100
+    assert page.after is None
+
+
+def test_limit_capped(monkeypatch):
+    monkeypatch.setenv('PAGE_MAX_LIMIT', '50')
+    assert payments_query().page({'limit': '500'}).limit == 50
+
+
+@pytest.mark.parametrize('limit', ['ten', '0', '-1'])
+def test_bad_limit(limit):
+    with pytest.raises(PageArgumentError):
+        payments_query().page({'limit': limit})
+
+
+def test_fields_projection_keeps_key_columns_selected():
+    page = payments_query().page({'fields': 'amount, amount,user_id'})
+    assert page.fields == ['amount', 'user_id']
+    assert page.select == ['amount', 'user_id', 'created_at', 'id']
+    row = {'amount': 5, 'user_id': 1, 'created_at': 'x', 'id': 9}
+    assert page.project(row) == {'amount': 5, 'user_id': 1}
+
+
+def test_unknown_field():
+    with pytest.raises(PageArgumentError, match="Unknown field 'secret'"):
+        payments_query().page({'fields': 'id,secret'})
+
+
+def test_sql_after_cursor():
+    page = payments_query().page({'cursor': encode_cursor(['2024-01-02', 7]), 'fields': 'id'})
+    statement, params = page.sql('user_id = %s', [3], limit=11)
+    assert statement == ("SELECT id, created_at FROM payments WHERE user_id = %s AND (created_at, id) < (%s, %s) "
+                         "ORDER BY created_at DESC, id DESC LIMIT 11")
+    assert params == [3, '2024-01-02', 7]
+
+
+def test_fetch_sets_next_cursor_only_when_more_rows():
+    page = payments_query().page({'limit': '2', 'fields': 'amount'})
+    rows = [{'amount': n, 'created_at': '2024-01-01', 'id': 10 - n} for n in range(3)]
+    cursor = FakeCursor(rows)
+    fetched, next_cursor = page.fetch(cursor)
+    assert fetched == [{'amount': 0}, {'amount': 1}]
+    assert cursor.executed[0][0].endswith('LIMIT 3')
+    assert decode_cursor(next_cursor, 2) == ['2024-01-01', 9]
+
+    fetched, next_cursor = page.fetch(FakeCursor(rows[:2]))
+    assert len(fetched) == 2
+    assert next_cursor is None
@@ -0,0 +1,105 @@
+from datetime import datetime, timedelta
+
+from token_cache import MISS, TokenCache, revocation_id
+
+USER = {'id': 1, 'username': 'alice'}
+
+
+class FakeRevocations:
+    def __init__(self):
+        self.revoked = {}
+
+    def is_revoked(self, jti):
+        return jti in self.revoked
+
+    def revoke(self, jti, exp):
+        self.revoked[jti] = exp
+
+
+class FakeCursor:
+    def __init__(self):
+        self.rows = []
+
+    def executemany(self, statement, rows):
+        self.rows.extend(rows)
+
+
+def test_valid_token_capped_by_max_ttl(clock):
+    cache = TokenCache(max_ttl=60)
+    cache.put('t', USER, datetime.now() + timedelta(hours=1))
+    assert cache.get('t') == USER
+    clock.advance(59)
+    assert cache.get('t') == USER
+    clock.advance(2)
+    assert cache.get('t') is MISS
+
+
+def test_valid_token_capped_by_session_expiry(clock):
+    cache = TokenCache(max_ttl=300)
+    cache.put('t', USER, datetime.now() + timedelta(seconds=30))
+    clock.advance(29)
+    assert cache.get('t') == USER
+    clock.advance(2)
+    assert cache.get('t') is MISS
+
+
+def test_expired_session_not_cached():
+    cache = TokenCache()
+    cache.put('t', USER, datetime.now() - timedelta(seconds=1))
+    assert cache.get('t') is MISS
+    assert cache.stats()['entries'] == 0
+
+
+def test_invalid_token_cached_for_negative_ttl(clock):
+    cache = TokenCache(negative_ttl=5)
+    cache.put_invalid('bad')
+    assert cache.get('bad') is None
+    clock.advance(6)
+    assert cache.get('bad') is MISS
+    assert cache.stats()['negative_hits'] == 1
+
+
+def test_negative_caching_disabled():
+    cache = TokenCache(negative_ttl=0)
+    cache.put_invalid('bad')
+    assert cache.get('bad') is MISS
+
+
+def test_lru_eviction():
+    cache = TokenCache(max_entries=2)
+    expires = datetime.now() + timedelta(hours=1)
+    cache.put('a', USER, expires)
+    cache.put('b', USER, expires)
+    cache.get('a')
+    cache.put('c', USER, expires)
+    assert cache.get('b') is MISS
+    assert cache.get('a') == USER
+    assert cache.stats()['evictions'] == 1
+
+
+def test_revoke_records_and_invalidates():
+    revocations = FakeRevocations()
+    cache = TokenCache(max_ttl=300, revocations=revocations)
+    cache.put('t', USER, datetime.now() + timedelta(hours=1))
+    cursor = FakeCursor()
+    cache.revoke(cursor, ['t'])
+    # The database row outlives any cached copy on another replica
+    assert cursor.rows == [(revocation_id('t'), 301)]
+    assert revocation_id('t') in revocations.revoked
+    assert cache.get('t') is MISS
+
+
+def test_token_revoked_elsewhere_is_not_trusted():
+    revocations = FakeRevocations()
+    cache = TokenCache(revocations=revocations)
+    cache.put('t', USER, datetime.now() + timedelta(hours=1))
+    revocations.revoke(revocation_id('t'), 0)
+    assert cache.get('t') is MISS
+    assert cache.stats()['revoked_hits'] == 1
+    assert cache.stats()['entries'] == 0
+
+
+def test_revoke_nothing_skips_the_database():
+    cursor = FakeCursor()
+    TokenCache().revoke(cursor, [])
+    assert cursor.rows == []